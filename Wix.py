@@ -1,30 +1,11 @@
-import requests
 import json
+from utils.wix import WixClient
 
-# Step 1: Retrieve the access token using the "anonymous" grant type
-token_url = "https://www.wixapis.com/oauth2/token"
-payload = {
-    "clientId": "9fa0f271-1600-4282-9fae-d841be6aaff6",
-    "grantType": "anonymous"
-}
-headers = {"Content-Type": "application/json"}
-
-response = requests.post(token_url, json=payload, headers=headers)
-if response.status_code != 200:
-    print(f"Error getting token: {response.status_code} - {response.text}")
-    exit()
-
-token_data = response.json()
-access_token = token_data["access_token"]
-print(f"Access Token: {access_token}")
-
-# Step 2: Function to fetch products with pagination
+# Step 1: Client for the store; it fetches and caches the anonymous access token itself
+client = WixClient("9fa0f271-1600-4282-9fae-d841be6aaff6")
 products_url = "https://www.wixapis.com/stores-reader/v1/products/query"
-headers = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {access_token}"
-}
 
+# Step 2: Function to fetch products with pagination
 def fetch_products(limit=100, offset=0, last_numeric_id=None):
     # Base query payload from your earlier request
     query_payload = {
@@ -42,11 +23,11 @@ def fetch_products(limit=100, offset=0, last_numeric_id=None):
         query_payload["query"]["sort"] = [{"numericId": "asc"}]
         query_payload["query"]["filter"] = {"numericId": {"$gt": last_numeric_id}}
 
-    response = requests.post(products_url, headers=headers, json=query_payload)
-    if response.status_code != 200:
-        print(f"Error fetching products: {response.status_code} - {response.text}")
+    try:
+        return client.post(products_url, query_payload)
+    except Exception as e:
+        print(f"Error fetching products: {str(e)}")
         return None
-    return response.json()
 
 # Step 3: Paginate through products
 all_products = []
@@ -85,4 +66,4 @@ if len(all_products) >= 10000 or not all_products:
 
 # Step 4: Output all fetched products
 print(f"\nTotal products fetched: {len(all_products)}")
-print(json.dumps(all_products, indent=2))  # Pretty-print all products
\ No newline at end of file
+print(json.dumps(all_products, indent=2))  # Pretty-print all products
@@ -1,10 +1,14 @@
 from flask import Blueprint, render_template, request, jsonify, current_app, session, redirect, url_for
-from utils.auth import login_required, load_users_settings, save_users_settings, generate_token, decode_token, login_user, generate_code
-from utils.config import load_config
+from utils.auth import login_required, generate_token, decode_token, login_user, generate_code
+from utils.users import get_user_settings, save_user_settings, find_user_by_email
+from utils.config import get_config
+from utils.passwords import check_password, hash_password, PasswordBusyError
+from utils.event_store import record_event
+from utils.outbound import outbound
+from utils.http import get_session
 import logging
 import datetime
 import json
-import bcrypt
 import jwt
 import hashlib
 import random
@@ -12,6 +16,10 @@ import string
 import requests
 import stripe
 
+# Stripe's client waits 80s by default; calls go through the outbound guard with its timeout instead.
+# It retries on its own (with idempotency keys), so it gets the pooled session without retries.
+stripe.default_http_client = stripe.RequestsClient(timeout=outbound("stripe").timeout, session=get_session(retries=0))
+
 # Blueprint Setup
 authentication_bp = Blueprint('authentication_bp', __name__)
 
@@ -42,14 +50,15 @@ def signup():
             logging.warning(f"Invalid signup_type: {signup_type}")
             return jsonify({"status": "error", "message": "Invalid signup type"}), 400
 
-        site_settings = load_config()
+        site_settings = get_config()
         stripe.api_key = site_settings.get('stripe', {}).get('API_KEY')
 
         # Determine business type based on role
         business_type = 'individual' if signup_type in ['community', 'partner'] else 'company'
 
         # Create Stripe account for the new user
-        account = stripe.Account.create(
+        account = outbound("stripe").call(
+            stripe.Account.create,
             type='express',
             business_type=business_type,
             capabilities={'transfers': {'requested': True}}
@@ -57,7 +66,8 @@ def signup():
 
         # Create Stripe account link with return URL including role and section
         return_url = f"https://clubmadeira.io/?section=completeSignup&role={signup_type}&account_id={account.id}"
-        account_link = stripe.AccountLink.create(
+        account_link = outbound("stripe").call(
+            stripe.AccountLink.create,
             account=account.id,
             refresh_url='https://clubmadeira.io/?section=failSignup',
             return_url=return_url,
@@ -84,7 +94,7 @@ def complete_signup():
     """Handle password setup after Stripe onboarding to complete user account creation."""
     try:
         # Load the configuration
-        config = load_config()
+        config = get_config()
         
         # Check if Stripe API key exists in the config
         if "stripe" not in config or "API_KEY" not in config["stripe"]:
@@ -112,7 +122,7 @@ def complete_signup():
 
         # Fetch Stripe account details
         try:
-            stripe_account = stripe.Account.retrieve(stripe_account_id)
+            stripe_account = outbound("stripe").call(stripe.Account.retrieve, stripe_account_id)
         except stripe.error.StripeError as e:
             logging.error(f"Stripe error: {str(e)}")
             return jsonify({"status": "error", "message": "Failed to retrieve Stripe account"}), 400
@@ -126,7 +136,7 @@ def complete_signup():
         email = email_from_stripe if email_from_stripe is not None else (email_from_form if email_from_form else f"{user_id}@example.com")
 
         # Hash the password
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        hashed_password = hash_password(password)
 
         # Prepare user data
         user_data = {
@@ -164,9 +174,7 @@ def complete_signup():
             })
 
         # Save the user to user_settings
-        users_settings = load_users_settings()
-        users_settings[user_id] = user_data
-        save_users_settings(users_settings)
+        save_user_settings(user_id, user_data)
         logging.info(f"User {user_id} created successfully after Stripe onboarding")
 
         # Record signup event in PostHog using the new utility
@@ -176,6 +184,7 @@ def complete_signup():
             "role": role,
             "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
         }
+        record_event("signup", user_id, signup_data)
         if posthog_client:
             try:
                 posthog_client.capture(
@@ -210,6 +219,8 @@ def complete_signup():
         response.set_cookie('authToken', token, secure=True, max_age=604800, path='/')
         return response, 200
 
+    except PasswordBusyError as e:
+        return jsonify({"status": "error", "message": str(e)}), e.status_code
     except Exception as e:
         logging.error(f"Complete signup error: {str(e)}", exc_info=True)
         return jsonify({"status": "error", "message": "Server error"}), 500
@@ -219,11 +230,10 @@ def complete_signup():
 @login_required(['partner', 'admin'])
 def link_stripe():
     try:
-        site_settings = load_config()
+        site_settings = get_config()
         stripe.api_key = site_settings.get('stripe', {}).get('API_KEY')
         user_id = request.user_id
-        users_settings = load_users_settings()
-        user = users_settings.get(user_id)
+        user = get_user_settings(user_id)
         if not user:
             logging.warning(f"User not found: {user_id}")
             return jsonify({"status": "error", "message": "User not found"}), 404
@@ -233,19 +243,21 @@ def link_stripe():
             return jsonify({"status": "error", "message": "Stripe account already linked"}), 400
 
         # Create Stripe account for linking
-        account = stripe.Account.create(
+        account = outbound("stripe").call(
+            stripe.Account.create,
             type='express',
             business_type='individual',
             capabilities={'transfers': {'requested': True}}
         )
-        account_link = stripe.AccountLink.create(
+        account_link = outbound("stripe").call(
+            stripe.AccountLink.create,
             account=account.id,
             refresh_url='https://clubmadeira.io/refresh',
             return_url='https://clubmadeira.io/stripe-return',
             type='account_onboarding'
         )
         user['stripe_account_id'] = account.id
-        save_users_settings(users_settings)
+        save_user_settings(user_id, user)
         logging.info(f"Stripe account linked for user {user_id}")
         return jsonify({"status": "success", "account_link": account_link.url, "redirect": "/"}), 200
 
@@ -260,7 +272,7 @@ def link_stripe():
 @authentication_bp.route('/reset-password', methods=['POST'])
 def reset_password():
     try:
-        site_settings = load_config()
+        site_settings = get_config()
         request_data = {
             "method": request.method,
             "url": request.full_path,
@@ -279,10 +291,9 @@ def reset_password():
             return jsonify({"status": "error", "message": "Email is required"}), 400
         
         email = data.get("email").lower()
-        users_settings = load_users_settings()
-        matching_user_id = next((uid for uid, settings in users_settings.items() if settings.get("email_address", "").lower() == email), None)
+        user_entry = find_user_by_email(email)
         
-        if not matching_user_id:
+        if not user_entry:
             logging.warning(f"Reset password failed - Email not found: {email}")
             return jsonify({"status": "error", "message": "Email not found"}), 404
 
@@ -294,8 +305,9 @@ def reset_password():
             'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=15)
         }, site_settings.get('jwt', {}).get('SECRET_KEY'), algorithm='HS256')
 
+        matching_user_id, user = user_entry
         try:
-            send_otp_via_sms(users_settings[matching_user_id]['phone_number'], otp)
+            send_otp_via_sms(user['phone_number'], otp)
         except Exception as e:
             logging.error(f"Failed to send OTP: {str(e)}")
             return jsonify({"status": "error", "message": f"Failed to send SMS: {str(e)}"}), 500
@@ -318,7 +330,7 @@ def send_otp_via_sms(phone_number, otp):
         Exception: If TextMagic credentials are not configured or if the SMS fails to send.
     """
     try:
-        site_settings = load_config()
+        site_settings = get_config()
         username = site_settings.get('textmagic', {}).get('USERNAME')
         api_key = site_settings.get('textmagic', {}).get('API_KEY')
 
@@ -336,7 +348,7 @@ def send_otp_via_sms(phone_number, otp):
         }
 
         logging.info(f"Sending OTP {otp} to +44{phone_number} via SMS")
-        response = requests.post(url, data=payload, headers=headers)
+        response = outbound("textmagic").request("POST", url, data=payload, headers=headers)
         
         if response.status_code != 201:
             logging.error(f"Failed to send SMS to +44{phone_number}: {response.text}")
@@ -361,7 +373,7 @@ def verify_reset_code():
     Returns a new authentication token on success.
     """
     try:
-        site_settings = load_config()
+        site_settings = get_config()
         request_data = {
             "method": request.method,
             "url": request.full_path,
@@ -407,16 +419,15 @@ def verify_reset_code():
             return jsonify({"status": "error", "message": "Invalid OTP"}), 400
 
         # Load user settings and find the user
-        users_settings = load_users_settings()
-        matching_user_id = next((uid for uid, settings in users_settings.items() if settings.get("email_address", "").lower() == email), None)
-        if not matching_user_id:
+        user_entry = find_user_by_email(email)
+        if not user_entry:
             logging.warning(f"User not found for email: {email}")
             return jsonify({"status": "error", "message": "User not found"}), 404
 
-        user = users_settings[matching_user_id]
+        matching_user_id, user = user_entry
         
         # Hash the new password with consistent encoding
-        hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        hashed_password = hash_password(new_password)
         user["password"] = hashed_password
         
         # Add 'verified' permission if not present
@@ -425,7 +436,7 @@ def verify_reset_code():
         
         # Save the updated settings with error handling
         try:
-            save_users_settings(users_settings)
+            save_user_settings(matching_user_id, user)
             logging.info(f"Password reset successful for user {matching_user_id}")
         except Exception as save_error:
             logging.error(f"Failed to save updated password for user {matching_user_id}: {str(save_error)}")
@@ -455,6 +466,8 @@ def verify_reset_code():
         response.set_cookie('authToken', token, secure=True, max_age=604800, path='/')
         return response, 200
 
+    except PasswordBusyError as e:
+        return jsonify({"status": "error", "message": str(e)}), e.status_code
     except Exception as e:
         logging.error(f"Verify reset code error: {str(e)}", exc_info=True)
         return jsonify({"status": "error", "message": "Server error"}), 500
@@ -486,22 +499,23 @@ def update_password():
         current_password = data["current_password"].strip()
         new_password = data["new_password"].strip()
 
-        users_settings = load_users_settings()
         user_id = request.user_id
-        user = users_settings.get(user_id)
+        user = get_user_settings(user_id)
         if not user:
             logging.warning(f"User {user_id} not found")
             return jsonify({"status": "error", "message": "User not found"}), 404
 
-        if not bcrypt.checkpw(current_password.encode('utf-8'), user["password"].encode('utf-8')):
+        if not check_password(current_password, user["password"]):
             logging.warning(f"Current password incorrect for user {user_id}")
             return jsonify({"status": "error", "message": "Current password is incorrect"}), 403
 
-        hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-        users_settings[user_id]["password"] = hashed_password
-        save_users_settings(users_settings)
+        hashed_password = hash_password(new_password)
+        user["password"] = hashed_password
+        save_user_settings(user_id, user)
         logging.info(f"Password updated for user {user_id}")
         return jsonify({"status": "success", "message": "Password updated successfully", "redirect": "/"}), 200
+    except PasswordBusyError as e:
+        return jsonify({"status": "error", "message": str(e)}), e.status_code
     except Exception as e:
         logging.error(f"Update password error: {str(e)}", exc_info=True)
         return jsonify({"status": "error", "message": "Server error"}), 500
@@ -513,8 +527,7 @@ def debug_password(user_id):
     - GET: Check if a provided password matches the stored hash.
     - POST: Update the password hash with a new password.
     """
-    users_settings = load_users_settings()
-    user = users_settings.get(user_id)
+    user = get_user_settings(user_id)
     if not user:
         return jsonify({"status": "error", "message": "User not found"}), 404
 
@@ -524,7 +537,7 @@ def debug_password(user_id):
             return jsonify({"status": "error", "message": "Password parameter required"}), 400
 
         # Check if the password matches the stored hash
-        if bcrypt.checkpw(password.encode('utf-8'), user['password'].encode('utf-8')):
+        if check_password(password, user['password']):
             return jsonify({"status": "success", "message": "Password matches"})
         else:
             return jsonify({"status": "error", "message": "Password does not match"})
@@ -535,10 +548,10 @@ def debug_password(user_id):
             return jsonify({"status": "error", "message": "New password required"}), 400
 
         # Hash and update the password
-        hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        hashed_password = hash_password(new_password)
         user['password'] = hashed_password
         try:
-            save_users_settings(users_settings)
+            save_user_settings(user_id, user)
             return jsonify({"status": "success", "message": "Password updated"})
         except Exception as e:
             return jsonify({"status": "error", "message": f"Failed to save: {str(e)}"}), 500
\ No newline at end of file
@@ -1,12 +1,13 @@
 from flask import Blueprint, request, jsonify, session , current_app
-import requests
 import json
 import logging
 from utils.config import load_config  # Import from utils/config.py
-from utils.users import load_users_settings, save_users_settings, get_user_settings  # Import from utils/users.py
+from utils.users import get_user_settings, save_user_settings  # Import from utils/users.py
 from jsonschema import validate, ValidationError
+from utils.deals import query_deals, DEFAULT_PAGE_SIZE
 from utils.products import search_all_discounted
 from utils.auth import login_required
+from utils.outbound import outbound
 
 # region Blueprint Setup
 # Welcome to content_bp, the blueprint that’s more organized than the Spanish Inquisition’s filing system.
@@ -54,7 +55,7 @@ def call_xai_api(messages, deselected_categories):
             'max_tokens': 1000
         }
         logging.debug(f"Sending request to xAI API: {json.dumps(payload, indent=2)}")
-        response = requests.post(XAI_API_URL, headers=headers, json=payload)
+        response = outbound("xai").request("POST", XAI_API_URL, headers=headers, json=payload)
         response.raise_for_status()
         response_data = response.json()
         logging.debug(f"xAI API raw response: {json.dumps(response_data, indent=2)}")
@@ -84,12 +85,23 @@ def get_all_discounted_products():
     """
     Retrieves all discounted products for a given category, like Zaphod Beeblebrox hunting for the best Pan Galactic Gargle Blaster deals.
     Purpose: To provide a list of products that are currently on discount, filtered by category—like the Holy Grail, but with price tags.
-    Inputs: Query parameter:
-        - category_id (str): The ID of the category to filter discounted products. Required, or it’s like asking for "four candles" and getting fork handles.
+    Merchant deals come from the precomputed deals index, so no merchant's store is called while you wait—no queueing at the cheese shop.
+    "products" pages through the index only, best discount first, so next_cursor pages are consistent.
+    With include_affiliates=true, the first page also returns deals from every configured affiliate (Amazon UK, eBay UK,
+    Awin, CJ) under "affiliates", kept out of the paged stream. Those are queried in parallel while you wait, for up to
+    the provider timeout (4s by default) unless cached; an affiliate that is slow or failing is skipped and reported under "providers".
+    Inputs: Query parameters:
+        - category_id (str): The category (merchant collection name) to filter discounted products. Required, or it’s like asking for "four candles" and getting fork handles.
+        - min_discount (float, optional): Minimum discount percent, defaults to any discount at all.
+        - limit (int, optional): Page size, defaults to 50 (at most 200).
+        - cursor (str, optional): The next_cursor from the previous page.
+        - include_affiliates (bool, optional): 'true' to add affiliate deals to the first page; defaults to false.
     Outputs:
-        - Success: JSON {"status": "success", "count": <int>, "products": [<product_data>]}, status 200—your treasure map to savings!
+        - Success: JSON {"status": "success", "count": <int>, "products": [<product_data>], "next_cursor": <str|null>, "providers": {<name>: {"status", "count"}}}, status 200—your treasure map to savings!
+          With include_affiliates on the first page, also "affiliates": [<product_data>] (ranked by discount, not limited by limit).
         - Errors:
             - 400: {"status": "error", "message": "category_id required"}—you forgot the category, you naughty boy!
+            - 400: {"status": "error", "message": "Invalid min_discount, limit or cursor"}—that’s not a number, it’s a dead parrot!
             - 500: {"status": "error", "message": "Server error: <reason>"}—the system’s gone to the People’s Front of Judea!
     """
     try:
@@ -97,13 +109,31 @@ def get_all_discounted_products():
         if not category_id:
             logging.warning("UX Issue - No category_id provided for discounted products")
             return jsonify({"status": "error", "message": "category_id required"}), 400
-        
-        products = search_all_discounted(category_id)
-        if not products:
+
+        try:
+            min_discount = float(request.args.get('min_discount', 0))
+            cursor = request.args.get('cursor')
+            products, next_cursor = query_deals(
+                category_id,
+                min_discount=min_discount,
+                limit=int(request.args.get('limit', DEFAULT_PAGE_SIZE)),
+                cursor=cursor
+            )
+        except ValueError:
+            logging.warning(f"UX Issue - Invalid deals query parameters: {dict(request.args)}")
+            return jsonify({"status": "error", "message": "Invalid min_discount, limit or cursor"}), 400
+
+        response_data = {"status": "success", "count": len(products), "products": products, "next_cursor": next_cursor}
+        providers = {"wix": {"status": "ok", "count": len(products)}}
+        if not cursor and request.args.get('include_affiliates', '').lower() == 'true':
+            affiliates = search_all_discounted(category_id, min_discount, exclude=("wix",))
+            response_data["affiliates"] = affiliates["products"]
+            providers.update(affiliates["providers"])
+        response_data["providers"] = providers
+        if not products and not response_data.get("affiliates"):
             logging.warning(f"UX Issue - No discounted products found for category_id: {category_id}")
-        
-        response_data = {"status": "success", "count": len(products), "products": products}
-        logging.debug(f"Retrieved discounted products for category_id {category_id}: {json.dumps(response_data)}")
+
+        logging.debug(f"Retrieved {len(products)} discounted products for category_id {category_id}")
         return jsonify(response_data), 200
     except Exception as e:
         logging.error(f"UX Issue - Failed to retrieve discounted products: {str(e)}", exc_info=True)
@@ -7,8 +7,10 @@ from blueprints.manager_bp import manager_bp
 from blueprints.site_request_bp import site_request_bp
 from blueprints.user_settings_bp import user_settings_bp
 from blueprints.utility_bp import utility_bp
-from utils.auth import login_required, load_users_settings, generate_token, decode_token
+from utils.auth import login_required, generate_token, decode_token
+from utils.users import load_users_settings
 from utils.posthog_utils import initialize_posthog
+from utils.outbound import outbound
 from functools import wraps
 import json
 import os
@@ -144,7 +146,8 @@ def fetch_last_login(user_id):
             logging.error("PostHog configuration missing: PROJECT_READ_KEY or PROJECT_ID not set")
             return "Last login information unavailable"
 
-        response = requests.get(
+        response = outbound("posthog").request(
+            "GET",
             f"{host}/api/projects/{project_id}/events",
             headers={"Authorization": f"Bearer {api_key}"},
             params={
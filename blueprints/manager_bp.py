@@ -1,7 +1,13 @@
 from flask import Blueprint, request, jsonify, session
-from utils.auth import login_required, get_authenticated_user, generate_token
-from utils.users import load_users_settings, save_users_settings
-from utils.config import load_config, save_config
+from utils.auth import login_required, resolve_authenticated_user, generate_token, invalidate_user_tokens
+from utils.users import get_user_settings, save_user_settings, get_users_by_role as find_users_by_role
+from utils.passwords import password_pool_metrics
+from utils.dedup import event_dedup_stats
+from utils.wix import catalog_stats
+from utils.deals import deals_index_stats
+from utils.products import detail_batch_stats
+from utils.outbound import outbound_stats
+from utils.config import load_config, save_config, get_settings_view, thaw
 from utils.posthog_utils import get_date_range, fetch_events, format_event_details  # Import helper functions
 import logging
 import json
@@ -24,8 +30,7 @@ def patch_permission():
     user_id = data['USERid']
     new_permission = data['permission']
     
-    users_data = load_users_settings()
-    user = users_data.get(user_id)
+    user = get_user_settings(user_id)
     
     if not user:
         return jsonify({"status": "error", "message": "User not found"}), 404
@@ -37,7 +42,8 @@ def patch_permission():
         return jsonify({"status": "error", "message": f"Permission {new_permission} already exists for user {user_id}"}), 400
     
     user['permissions'].append(new_permission)
-    save_users_settings(users_data)
+    save_user_settings(user_id, user)
+    invalidate_user_tokens(user_id)
     return jsonify({"status": "success", "message": f"Permission {new_permission} added for user {user_id}"}), 200
 
 @manager_bp.route('/permission', methods=['DELETE'])
@@ -54,8 +60,7 @@ def delete_permission():
     user_id = data['USERid']
     permission_to_remove = data['permission']
     
-    users_data = load_users_settings()
-    user = users_data.get(user_id)
+    user = get_user_settings(user_id)
     
     if not user:
         return jsonify({"status": "error", "message": "User not found"}), 404
@@ -64,7 +69,8 @@ def delete_permission():
         return jsonify({"status": "error", "message": f"Permission {permission_to_remove} not found for user {user_id}"}), 404
     
     user['permissions'].remove(permission_to_remove)
-    save_users_settings(users_data)
+    save_user_settings(user_id, user)
+    invalidate_user_tokens(user_id)
     return jsonify({"status": "success", "message": f"Permission {permission_to_remove} removed from user {user_id}"}), 200
 # endregion
 
@@ -76,13 +82,10 @@ def get_users_by_role(role):
     Retrieves a list of users who have the specified role in their permissions.
     """
     try:
-        users_data = load_users_settings()
         users_with_role = []
-        for user_id, user in users_data.items():
-            if 'permissions' in user and role in user['permissions']:
-                user_copy = user.copy()
-                user_copy['USERid'] = user_id
-                users_with_role.append(user_copy)
+        for user_id, user in find_users_by_role(role).items():
+            user['USERid'] = user_id
+            users_with_role.append(user)
         
         if not users_with_role:
             logging.info(f"No users found with role '{role}'")
@@ -95,6 +98,34 @@ def get_users_by_role(role):
         return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
 # endregion
 
+# region Metrics
+# Stats callables of in-process subsystems, reported by name from /metrics
+METRICS = {
+    "password_pool": password_pool_metrics,
+    "event_dedup": event_dedup_stats,
+    "catalog_cache": catalog_stats,
+    "deals_index": deals_index_stats,
+    "detail_batches": detail_batch_stats,
+    "outbound": outbound_stats
+}
+
+@manager_bp.route('/metrics', methods=['GET'])
+@login_required(required_permissions=['admin'])
+def get_metrics():
+    """
+    Returns the counters of every subsystem in METRICS for this worker, keyed by name.
+    A subsystem whose stats can't be read is reported as {"error": <reason>} without failing the rest.
+    """
+    metrics = {}
+    for name, stats in METRICS.items():
+        try:
+            metrics[name] = stats()
+        except Exception as e:
+            logging.error(f"Failed to retrieve {name} metrics: {str(e)}", exc_info=True)
+            metrics[name] = {"error": str(e)}
+    return jsonify({"status": "success", "metrics": metrics}), 200
+# endregion
+
 # region Settings Management
 @manager_bp.route('/settings/settings_key', methods=['GET'])
 @login_required(["admin"], require_all=True)
@@ -103,20 +134,7 @@ def get_settings_key_settings():
     Retrieves all settings of type 'settings_key' from the configuration.
     """
     try:
-        config = load_config()
-        settings = []
-        for key, value in config.items():
-            if value.get('setting_type') == 'settings_key':
-                fields = {k: v for k, v in value.items() if k not in ['_comment', 'setting_type', 'icon', 'doc_link', '_description']}
-                setting = {
-                    'key_type': key,
-                    'fields': fields,
-                    'icon': value.get('icon', 'icon-favicon'),
-                    'doc_link': value.get('doc_link', ''),
-                    'comment': value.get('_comment', ''),
-                    'description': value.get('_description', '')
-                }
-                settings.append(setting)
+        settings = thaw(get_settings_view('settings_key'))
         
         if not settings:
             logging.warning("No settings found for type 'settings_key'")
@@ -197,20 +215,7 @@ def get_affiliate_key_settings():
     Retrieves all settings of type 'affiliate_key' from the configuration.
     """
     try:
-        config = load_config()
-        settings = []
-        for key, value in config.items():
-            if value.get('setting_type') == 'affiliate_key':
-                fields = {k: v for k, v in value.items() if k not in ['_comment', 'setting_type', 'icon', 'doc_link', '_description']}
-                setting = {
-                    'key_type': key,
-                    'fields': fields,
-                    'icon': value.get('icon', 'icon-favicon'),
-                    'doc_link': value.get('doc_link', ''),
-                    'comment': value.get('_comment', ''),
-                    'description': value.get('_description', '')
-                }
-                settings.append(setting)
+        settings = thaw(get_settings_view('affiliate_key'))
         
         if not settings:
             logging.warning("No settings found for type 'affiliate_key'")
@@ -288,7 +293,7 @@ def put_affiliate_key(key_type):
 @manager_bp.route('/set-role', methods=['POST'])
 @login_required(['admin'], require_all=True)
 def set_role():
-    decoded, token, source = get_authenticated_user()
+    decoded, token, source = resolve_authenticated_user()
     if not decoded:
         return jsonify({"status": "error", "message": "Authentication required"}), 401
 
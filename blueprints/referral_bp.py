@@ -1,15 +1,51 @@
-from flask import Blueprint, jsonify, request, current_app
+from flask import Blueprint, jsonify, request, current_app, Response, stream_with_context
 import logging
 import string
 import json
 import requests 
+from functools import lru_cache
 from utils.auth import login_required, get_authenticated_user
-from utils.posthog_utils import get_date_range, fetch_events, format_event_details  # Import helper functions
-from utils.users import load_users_settings
+from utils.posthog_utils import get_date_range, load_events, format_event_details  # Import helper functions
+from utils.event_store import record_events, event_store, period_aligned, ROLLUP_EVENTS, BUCKET_FORMATS
+from utils.users import get_user_fields, get_referral_tree, MAX_REFERRAL_DEPTH
+from utils.referrals import commission_rates, commission_level
+from utils.dedup import event_idempotency_key, event_uuid_for, claim_event, release_event
 
 # Create the Blueprint
 referral_bp = Blueprint("referral_bp", __name__)
 
+# Upper bound on events accepted by one /event/batch request
+MAX_BATCH_EVENTS = 1000
+
+class EventRejected(Exception):
+    """Raised by build_event when a payload is invalid; carries the message and HTTP status for the caller."""
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+@lru_cache(maxsize=65536)
+def _checksum_matches(code):
+    # Define valid characters for user IDs (uppercase letters and digits)
+    charset = string.digits + string.ascii_uppercase
+
+    # Check if all characters are in the charset
+    if not all(c in charset for c in code):
+        return False
+
+    # Split into code part and checksum
+    code_part = code[:7]
+    given_checksum = code[7]
+
+    # Calculate the sum of indices for the first 7 characters
+    total = sum(charset.index(c) for c in code_part)
+
+    # Compute the expected checksum
+    expected_checksum = charset[total % 36]
+
+    # Return True if the expected checksum matches the given checksum
+    return expected_checksum == given_checksum
+
 def verify_code(code):
     """
     Verify if the given code matches its checksum.
@@ -17,6 +53,7 @@ def verify_code(code):
     The code should be an 8-character string where the first 7 characters
     are from the charset (digits and uppercase letters), and the 8th character
     is the checksum computed as charset[sum(indices) % 36].
+    Results are memoised, so repeat IDs cost a dict lookup.
     
     Args:
         code: The code to verify.
@@ -24,29 +61,96 @@ def verify_code(code):
     Returns:
         bool: True if the code is valid, False otherwise.
     """
-    # Define valid characters for user IDs (uppercase letters and digits)
-    charset = string.digits + string.ascii_uppercase
-    
     # Check if input is a string and exactly 8 characters long
     if not isinstance(code, str) or len(code) != 8:
         return False
-    
-    # Check if all characters are in the charset
-    if not all(c in charset for c in code):
-        return False
-    
-    # Split into code part and checksum
-    code_part = code[:7]
-    given_checksum = code[7]
-    
-    # Calculate the sum of indices for the first 7 characters
-    total = sum(charset.index(c) for c in code_part)
-    
-    # Compute the expected checksum
-    expected_checksum = charset[total % 36]
-    
-    # Return True if the expected checksum matches the given checksum
-    return expected_checksum == given_checksum
+    return _checksum_matches(code)
+
+def event_user_ids(payloads):
+    """Returns the well-formed source and destination user IDs referenced by event payloads."""
+    user_ids = set()
+    for payload in payloads:
+        if isinstance(payload, dict):
+            for key in ("source_user_id", "destination_user_id"):
+                if verify_code(payload.get(key)):
+                    user_ids.add(payload[key])
+    return user_ids
+
+def build_event(data, profiles):
+    """
+    Validates one click/order payload and builds its PostHog event.
+    profiles maps existing user IDs to their {"website_url": ...}, as returned by get_user_fields,
+    so validation is entirely in memory.
+    Returns (event_type, source_user_id, event_properties). Raises EventRejected if invalid.
+    """
+    if not isinstance(data, dict) or not data:
+        raise EventRejected("Invalid data: JSON object required", 400)
+
+    # Extract required fields
+    source_user_id = data.get("source_user_id")
+    destination_user_id = data.get("destination_user_id")
+
+    # Check for required fields
+    if not source_user_id or not destination_user_id:
+        logging.warning("Missing required fields: source_user_id or destination_user_id")
+        raise EventRejected("Missing required fields: source_user_id and destination_user_id", 400)
+
+    # Validate user IDs
+    if not verify_code(source_user_id) or not verify_code(destination_user_id):
+        logging.warning(f"Invalid user IDs - Source: {source_user_id}, Destination: {destination_user_id}")
+        raise EventRejected("Invalid source_user_id or destination_user_id", 403)
+
+    # Determine event type based on presence of sale_value
+    if "sale_value" in data:
+        event_type = "order"
+        try:
+            sale_value = float(data["sale_value"])
+        except (TypeError, ValueError):
+            logging.warning(f"Invalid sale_value: {data.get('sale_value')}")
+            raise EventRejected("Invalid sale_value: must be a number", 400)
+    else:
+        event_type = "click"
+        sale_value = None
+
+    # Check if both users exist
+    source_profile = profiles.get(source_user_id)
+    destination_profile = profiles.get(destination_user_id)
+    if source_profile is None or destination_profile is None:
+        logging.warning(f"User not found - Source: {source_user_id}, Destination: {destination_user_id}")
+        raise EventRejected("Source or destination user not found", 403)
+
+    # Build event properties for PostHog, defaulting website URLs to "N/A" if missing or empty
+    event_properties = {
+        "source_user_id": source_user_id,
+        "destination_user_id": destination_user_id,
+        "source": source_profile.get("website_url") or "N/A",
+        "destination": destination_profile.get("website_url") or "N/A",
+    }
+    if event_type == "order":
+        event_properties["sale_value"] = sale_value
+    return event_type, source_user_id, event_properties
+
+def stream_json_list(list_key, items, description):
+    """
+    Streams {"<list_key>": [...], "status": "success"} one item at a time, so large periods
+    are sent as they are read rather than built up in memory first.
+    An error mid-stream closes the list and reports "status": "error" instead.
+    """
+    def generate():
+        count = 0
+        yield f'{{"{list_key}": ['
+        try:
+            for item in items:
+                yield (',' if count else '') + json.dumps(item)
+                count += 1
+        except Exception as e:
+            logging.error(f"Failed while streaming {description}: {str(e)}", exc_info=True)
+            yield '], ' + json.dumps({"status": "error", "message": f"Server error: {str(e)}"})[1:]
+            return
+        logging.debug(f"Streamed {count} {description}")
+        yield '], "status": "success"}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 @referral_bp.route("/event", methods=["POST"])
 def handle_event():
@@ -57,10 +161,14 @@ def handle_event():
     - source_user_id: ID of the referring user (required)
     - destination_user_id: ID of the target user (required)
     - sale_value (optional): If present, the event is an "order"; otherwise, a "click"
+    - idempotency_key (optional, or an Idempotency-Key header): Repeats within the dedup window are dropped.
+      Without one, repeats of the same source, destination and sale_value within a time bucket are dropped.
     
     Returns:
         JSON response with status or error message, along with HTTP status code.
+        Dropped repeats return {"status": "success", "duplicate": true}.
     """
+    dedup_key = None
     try:
         # Parse JSON data from the request
         data = request.get_json(silent=True)
@@ -68,63 +176,35 @@ def handle_event():
             logging.warning("No JSON data provided in request")
             return {"error": "Invalid data: JSON required"}, 400
 
-        # Extract required fields
-        source_user_id = data.get("source_user_id")
-        destination_user_id = data.get("destination_user_id")
-
-        # Check for required fields
-        if not source_user_id or not destination_user_id:
-            logging.warning("Missing required fields: source_user_id or destination_user_id")
-            return {"error": "Missing required fields: source_user_id and destination_user_id"}, 400
-
-        # Validate user IDs
-        if not verify_code(source_user_id) or not verify_code(destination_user_id):
-            logging.warning(f"Invalid user IDs - Source: {source_user_id}, Destination: {destination_user_id}")
-            return {"error": "Invalid source_user_id or destination_user_id"}, 403
-
-        # Determine event type based on presence of sale_value
-        if "sale_value" in data:
-            event_type = "order"
-            try:
-                sale_value = float(data["sale_value"])
-            except (TypeError, ValueError):
-                logging.warning(f"Invalid sale_value: {data.get('sale_value')}")
-                return {"error": "Invalid sale_value: must be a number"}, 400
-        else:
-            event_type = "click"
-            sale_value = None
-
-        # Retrieve user settings (assuming utils.users provides this function)
-        from utils.users import get_user_settings
-        source_user_settings = get_user_settings(source_user_id)
-        destination_user_settings = get_user_settings(destination_user_id)
-
-        # Check if both users exist
-        if not source_user_settings or not destination_user_settings:
-            logging.warning(f"User not found - Source: {source_user_id}, Destination: {destination_user_id}")
-            return {"error": "Source or destination user not found"}, 403
-
-        # Extract website URLs, defaulting to "N/A" if missing or empty
-        source_url = source_user_settings.get("website_url") or "N/A"
-        destination_url = destination_user_settings.get("website_url") or "N/A"
-
-        # Build event properties for PostHog
-        event_properties = {
-            "source_user_id": source_user_id,
-            "destination_user_id": destination_user_id,
-            "source": source_url,
-            "destination": destination_url,
-        }
-        if event_type == "order":
-            event_properties["sale_value"] = sale_value
-
-        # Send event to PostHog if client is configured
+        # Validate against the in-memory user store
+        profiles = get_user_fields(event_user_ids([data]), ("website_url",))
+        try:
+            event_type, source_user_id, event_properties = build_event(data, profiles)
+        except EventRejected as e:
+            return {"error": e.message}, e.status_code
+        destination_user_id = event_properties["destination_user_id"]
+        sale_value = event_properties.get("sale_value")
+
+        # Drop retries and double-fired requests before they cost a write and a capture
+        dedup_key = event_idempotency_key(event_type, event_properties, data.get("idempotency_key") or request.headers.get("Idempotency-Key"))
+        if not claim_event(dedup_key):
+            logging.info(f"Duplicate {event_type} from {source_user_id} to {destination_user_id} dropped")
+            return {"status": "success", "duplicate": True}, 200
+
+        # Store the event locally, then send it to PostHog if client is configured
+        event_uuid = event_uuid_for(dedup_key)
+        stored = record_events([(event_type, source_user_id, event_properties, None, event_uuid)])
+        if stored == [None]:
+            # Another worker already stored this event
+            logging.info(f"Duplicate {event_type} from {source_user_id} to {destination_user_id} dropped")
+            return {"status": "success", "duplicate": True}, 200
         posthog_client = current_app.posthog_client
         if posthog_client:
             posthog_client.capture(
                 distinct_id=source_user_id,
                 event=event_type,
-                properties=event_properties
+                properties=event_properties,
+                event_uuid=event_uuid
             )
 
         # Log successful event
@@ -138,6 +218,8 @@ def handle_event():
     except Exception as e:
         # Handle server errors, log them, and report to PostHog
         logging.error(f"Server error in handle_event: {str(e)}")
+        if dedup_key:
+            release_event(dedup_key)
         posthog_client = current_app.posthog_client
         if posthog_client:
             posthog_client.capture(
@@ -147,6 +229,76 @@ def handle_event():
             )
         return {"error": "Internal server error"}, 500
 
+@referral_bp.route("/event/batch", methods=["POST"])
+def handle_event_batch():
+    """
+    Ingest many click/order events in one request, e.g. from Velo code or server-to-server replay.
+
+    Expects a JSON payload of {"events": [<event>, ...]} or a bare list, where each event has
+    the same fields as /event, including the optional idempotency_key. Events are validated and
+    deduplicated individually; new ones are stored in a single transaction and queued for PostHog.
+
+    Returns:
+        JSON {"status": "success", "accepted": n, "duplicates": d, "rejected": m, "results": [{"index", "status", ...}]},
+        where rejected items carry "error" and the "code" /event would have returned.
+    """
+    claimed = []
+    try:
+        data = request.get_json(silent=True)
+        events = data.get("events") if isinstance(data, dict) else data
+        if not isinstance(events, list) or not events:
+            logging.warning("No events provided in batch request")
+            return {"error": "Invalid data: a non-empty list of events is required"}, 400
+        if len(events) > MAX_BATCH_EVENTS:
+            return {"error": f"Too many events: at most {MAX_BATCH_EVENTS} per batch"}, 413
+
+        profiles = get_user_fields(event_user_ids(events), ("website_url",))
+        results = []
+        accepted = []  # (result index, event tuple for record_events)
+        for index, payload in enumerate(events):
+            try:
+                event_type, source_user_id, event_properties = build_event(payload, profiles)
+            except EventRejected as e:
+                results.append({"index": index, "status": "error", "error": e.message, "code": e.status_code})
+                continue
+            dedup_key = event_idempotency_key(event_type, event_properties, payload.get("idempotency_key"))
+            if not claim_event(dedup_key):
+                results.append({"index": index, "status": "duplicate"})
+                continue
+            claimed.append(dedup_key)
+            accepted.append((index, (event_type, source_user_id, event_properties, None, event_uuid_for(dedup_key))))
+            results.append({"index": index, "status": "success"})
+
+        # Store new events locally in one transaction, then queue them for PostHog
+        if accepted:
+            stored = record_events([event for _, event in accepted])
+            if stored is not None:
+                # Events another worker already stored are duplicates too
+                for (index, _), event_uuid in zip(accepted, stored):
+                    if event_uuid is None:
+                        results[index] = {"index": index, "status": "duplicate"}
+                accepted = [(index, event) for (index, event), event_uuid in zip(accepted, stored) if event_uuid is not None]
+            posthog_client = current_app.posthog_client
+            if posthog_client:
+                for _, (event_type, source_user_id, event_properties, _, event_uuid) in accepted:
+                    posthog_client.capture(
+                        distinct_id=source_user_id,
+                        event=event_type,
+                        properties=event_properties,
+                        event_uuid=event_uuid
+                    )
+
+        rejected = sum(1 for result in results if result["status"] == "error")
+        duplicates = len(events) - len(accepted) - rejected
+        logging.info(f"Batch recorded {len(accepted)} of {len(events)} events ({duplicates} duplicates)")
+        return {"status": "success", "accepted": len(accepted), "duplicates": duplicates, "rejected": rejected, "results": results}, 200
+
+    except Exception as e:
+        logging.error(f"Server error in handle_event_batch: {str(e)}", exc_info=True)
+        for dedup_key in claimed:
+            release_event(dedup_key)
+        return {"error": "Internal server error"}, 500
+
 @referral_bp.route('/events/<event_type>', methods=['GET'])
 @login_required(["self"], require_all=True)
 def get_user_events(event_type):
@@ -171,11 +323,11 @@ def get_user_events(event_type):
         if event_type not in ["click", "order"]:
             return jsonify({"status": "error", "message": "Invalid event type"}), 400
 
-        # Determine filter key based on user role
+        # Determine filter based on user role
         if x_role == 'community':
-            filter_key = 'source_user_id'
+            role_filter = {'source_user_id': user_id}
         elif x_role == 'merchant':
-            filter_key = 'destination_user_id'
+            role_filter = {'destination_user_id': user_id}
         else:
             logging.warning(f"Permission denied for user {user_id}: invalid x-role '{x_role}'")
             return jsonify({"status": "error", "message": "Permission denied"}), 403
@@ -184,19 +336,15 @@ def get_user_events(event_type):
         period = request.args.get('period', 'today')
         start, end = get_date_range(period)
 
-        # Fetch events with role-based filter
-        properties_filter = [{'key': filter_key, 'value': user_id}]
-        events_data = fetch_events(event_type, start, end, properties_filter)
-
-        events = [
+        # Stream events with role-based filter
+        events = (
             {
                 "timestamp": event.get("timestamp", "N/A"),
                 "details": format_event_details(event.get("properties", {}), event_type)
             }
-            for event in events_data
-        ]
-        logging.debug(f"User {user_id} retrieved {len(events)} {event_type} events for period {period}")
-        return jsonify({"status": "success", "events": events}), 200
+            for event in load_events(event_type, start, end, **role_filter)
+        )
+        return stream_json_list("events", events, f"{event_type} events for user {user_id}, period {period}")
 
     except Exception as e:
         logging.error(f"Failed to retrieve {event_type} events for user {user_id}: {str(e)}")
@@ -224,18 +372,16 @@ def get_events(event_type):
     start, end = get_date_range(period)
 
     try:
-        # Fetch events from PostHog for the given event type and time range
-        events_data = fetch_events(event_type, start, end)
-        events = [
+        # Stream events for the given event type and time range
+        events = (
             {
                 "timestamp": event.get("timestamp", "N/A"),
                 "user": event.get("distinct_id", "Anonymous"),
                 "details": format_event_details(event.get("properties", {}), event_type)
             }
-            for event in events_data
-        ]
-        logging.debug(f"Admin retrieved {len(events)} {event_type} events for period {period}")
-        return jsonify({"status": "success", "data": events}), 200
+            for event in load_events(event_type, start, end)
+        )
+        return stream_json_list("data", events, f"admin {event_type} events for period {period}")
     except Exception as e:
         logging.error(f"Failed to retrieve {event_type} events: {str(e)}")
         return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
@@ -249,9 +395,10 @@ def get_referrer_events(event_type):
     Inputs:
     - event_type (str): The type of event to retrieve (e.g., 'click', 'signup').
     - period (query param, optional): Temporal filter (e.g., 'today', 'this_month'), defaults to 'today'.
+    - depth (query param, optional): Referral levels to include (1 = direct referees only), defaults to 1.
     
     Outputs:
-    - Success: JSON {"status": "success", "events": [<array_of_events>]} with HTTP 200.
+    - Success: JSON {"status": "success", "events": [<array_of_events>]} with HTTP 200; each event carries its referral level.
     - Error: JSON {"status": "error", "message": "<error_message>"} with HTTP 400 or 500.
     """
     try:
@@ -263,49 +410,173 @@ def get_referrer_events(event_type):
         if not user_id:
             return jsonify({"status": "error", "message": "User ID not found"}), 400
 
-        # Step 2: Load all user settings to check referrers
-        user_settings = load_users_settings()
-
-        # Step 3: Validate the event type
+        # Step 2: Validate the event type
         valid_event_types = ['login', 'signup', 'click', 'order']
         if event_type not in valid_event_types:
             return jsonify({"status": "error", "message": f"Invalid event type: {event_type}"}), 400
 
-        # Step 4: Get the date range for event filtering
+        # Step 3: Get the date range and referral depth for event filtering
         period = request.args.get('period', 'today')
         start, end = get_date_range(period)
+        try:
+            depth = min(max(int(request.args.get('depth', 1)), 1), MAX_REFERRAL_DEPTH)
+        except ValueError:
+            return jsonify({"status": "error", "message": "Invalid depth: must be a number"}), 400
+
+        # Step 4: Stream events whose source or destination is in the current user's referral tree
+        tree = get_referral_tree(user_id, depth)
+        formatted_events = (
+            {
+                "timestamp": event_dict.get("timestamp", "N/A"),
+                "level": commission_level(tree, event_dict),
+                "details": format_event_details(event_dict.get("properties", {}), event_type)
+            }
+            for event_dict in (load_events(event_type, start, end, user_ids=set(tree)) if tree else ())
+        )
+        return stream_json_list("events", formatted_events, f"{event_type} events where {user_id} is referrer")
 
-        # Step 5: Fetch all events of the specified type
-        all_events = fetch_events(event_type, start, end, properties_filter=None)
+    except Exception as e:
+        logging.error(f"Failed to retrieve referral events: {str(e)}")
+        return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
 
-        # Step 6: Filter events where the current user is the referrer of source or destination
-        filtered_events = []
-        for event_dict in all_events:
-            properties = event_dict.get("properties", {})
-            source_user_id = properties.get("source_user_id")
-            destination_user_id = properties.get("destination_user_id")
+@referral_bp.route('/referrer/commission', methods=['GET'])
+@login_required(["admin", "partner"], require_all=False)
+def get_referrer_commission():
+    """
+    Attributes the sale value of orders in the current user's referral tree to each referral level
+    using the configured commission rates. Totals are read from the event store's per-level rollups,
+    which are kept up to date as orders are recorded, so they cover orders since coverage_start.
+    Inputs:
+    - period (query param, optional): Temporal filter (e.g., 'today', 'this_month'), defaults to 'today'.
+    Outputs:
+    - Success: JSON {"status": "success", "levels": [{"level", "rate", "orders", "sale_value", "attributed"}], "attributed": <total>, "coverage_start": "<iso>"}
+    - Error: JSON {"status": "error", "message": "<error_message>"}
+    """
+    try:
+        decoded, _, error_response = get_authenticated_user()
+        if error_response:
+            return error_response
+        user_id = decoded.get('user_id')
+        if not user_id:
+            return jsonify({"status": "error", "message": "User ID not found"}), 400
 
-            # Get the referrer for source and destination users from user_settings
-            source_referrer = user_settings.get(source_user_id, {}).get("referrer")
-            dest_referrer = user_settings.get(destination_user_id, {}).get("referrer")
+        period = request.args.get('period', 'today')
+        start, end = get_date_range(period)
 
-            # Keep the event if the current user is the referrer of source OR destination
-            if user_id in (source_referrer, dest_referrer):
-                filtered_events.append(event_dict)
+        totals = event_store.summarize_levels(user_id, "order", start, end)
+        levels = []
+        for level, rate in enumerate(commission_rates(), 1):
+            level_totals = totals.get(level, {"count": 0, "sale_value": 0.0})
+            levels.append({
+                "level": level,
+                "rate": rate,
+                "orders": level_totals["count"],
+                "sale_value": level_totals["sale_value"],
+                "attributed": round(level_totals["sale_value"] * rate, 2)
+            })
+
+        logging.debug(f"Computed commission attribution for {user_id} for period {period}")
+        return jsonify({
+            "status": "success",
+            "levels": levels,
+            "attributed": round(sum(entry["attributed"] for entry in levels), 2),
+            "coverage_start": event_store.coverage_start()
+        }), 200
 
-        # Step 7: Format the events for the response
-        formatted_events = [
-            {
-                "timestamp": event_dict.get("timestamp", "N/A"),
-                "details": format_event_details(event_dict.get("properties", {}), event_type)
-            }
-            for event_dict in filtered_events
-        ]
+    except Exception as e:
+        logging.error(f"Failed to compute referral commission: {str(e)}", exc_info=True)
+        return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
+
+@referral_bp.route('/summary/<event_type>', methods=['GET'])
+@login_required(["self"], require_all=True)
+def get_user_summary(event_type):
+    """
+    Returns rolled-up totals of the authenticated user's clicks or orders for a period.
+    Community users are summarised as the source, merchants as the destination.
+    Inputs:
+        event_type (str): One of 'click', 'order'.
+        period (query param, optional): Temporal filter (e.g., 'today', 'this_month'), defaults to 'today'.
+        granularity (query param, optional): Bucket size, one of 'hour', 'day', 'month'; defaults to 'day'.
+            Must not be coarser than the period (e.g. 'month' is rejected for 'this_week').
+    Outputs:
+        - Success: JSON {"status": "success", "totals": {...}, "buckets": [...], "counterparties": [...], "coverage_start": "<iso>"}
+        - Error: JSON {"status": "error", "message": "<error_message>"}
+    """
+    try:
+        decoded, _, error_response = get_authenticated_user()
+        if error_response:
+            return error_response
+
+        user_id = decoded.get('user_id')
+        x_role = decoded.get('x-role', 'login').lower()
+
+        if event_type not in ROLLUP_EVENTS:
+            return jsonify({"status": "error", "message": "Invalid event type"}), 400
 
-        # Step 8: Log and return the response
-        logging.debug(f"Retrieved {len(formatted_events)} {event_type} events where {user_id} is referrer")
-        return jsonify({"status": "success", "events": formatted_events}), 200
+        if x_role == 'community':
+            role = 'source'
+        elif x_role == 'merchant':
+            role = 'destination'
+        else:
+            logging.warning(f"Permission denied for user {user_id}: invalid x-role '{x_role}'")
+            return jsonify({"status": "error", "message": "Permission denied"}), 403
+
+        granularity = request.args.get('granularity', 'day')
+        if granularity not in BUCKET_FORMATS:
+            return jsonify({"status": "error", "message": f"Invalid granularity: {granularity}"}), 400
+
+        period = request.args.get('period', 'today')
+        start, end = get_date_range(period)
+        if not period_aligned(start, end, granularity):
+            return jsonify({"status": "error", "message": f"Granularity {granularity} is coarser than period {period}"}), 400
+
+        summary = event_store.summarize(user_id, role, event_type, start, end, granularity)
+        logging.debug(f"User {user_id} retrieved {event_type} summary for period {period}: {summary['totals']}")
+        return jsonify({"status": "success", **summary, "coverage_start": event_store.coverage_start()}), 200
 
     except Exception as e:
-        logging.error(f"Failed to retrieve referral events: {str(e)}")
-        return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
\ No newline at end of file
+        logging.error(f"Failed to retrieve {event_type} summary: {str(e)}", exc_info=True)
+        return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
+
+@referral_bp.route('/referrer/summary/<event_type>', methods=['GET'])
+@login_required(["admin", "partner"], require_all=False)
+def get_referrer_summary(event_type):
+    """
+    Returns rolled-up totals of clicks or orders where the authenticated user referred the
+    source or destination user, with a breakdown per referred user.
+    Inputs:
+        event_type (str): One of 'click', 'order'.
+        period (query param, optional): Temporal filter (e.g., 'today', 'this_month'), defaults to 'today'.
+        granularity (query param, optional): Bucket size, one of 'hour', 'day', 'month'; defaults to 'day'.
+            Must not be coarser than the period (e.g. 'month' is rejected for 'this_week').
+    Outputs:
+        - Success: JSON {"status": "success", "totals": {...}, "buckets": [...], "counterparties": [...], "coverage_start": "<iso>"}
+        - Error: JSON {"status": "error", "message": "<error_message>"}
+    """
+    try:
+        decoded, _, error_response = get_authenticated_user()
+        if error_response:
+            return error_response
+        user_id = decoded.get('user_id')
+        if not user_id:
+            return jsonify({"status": "error", "message": "User ID not found"}), 400
+
+        if event_type not in ROLLUP_EVENTS:
+            return jsonify({"status": "error", "message": f"Invalid event type: {event_type}"}), 400
+
+        granularity = request.args.get('granularity', 'day')
+        if granularity not in BUCKET_FORMATS:
+            return jsonify({"status": "error", "message": f"Invalid granularity: {granularity}"}), 400
+
+        period = request.args.get('period', 'today')
+        start, end = get_date_range(period)
+        if not period_aligned(start, end, granularity):
+            return jsonify({"status": "error", "message": f"Granularity {granularity} is coarser than period {period}"}), 400
+
+        summary = event_store.summarize(user_id, 'referrer', event_type, start, end, granularity)
+        logging.debug(f"Referrer {user_id} retrieved {event_type} summary for period {period}: {summary['totals']}")
+        return jsonify({"status": "success", **summary, "coverage_start": event_store.coverage_start()}), 200
+
+    except Exception as e:
+        logging.error(f"Failed to retrieve referrer summary: {str(e)}", exc_info=True)
+        return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
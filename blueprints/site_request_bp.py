@@ -1,7 +1,7 @@
 from flask import Blueprint, request, jsonify, current_app
 from utils.auth import login_required  # Assumes this validates the token and sets request.user_id
 from utils.data import load_site_request, save_site_request
-from utils.users import load_users_settings  # Use load_users_settings for listing all settings
+from utils.users import get_user_settings
 import logging
 import os
 import datetime
@@ -30,18 +30,19 @@ def list_site_requests():
             logging.warning("No site requests directory found")
             return jsonify({"status": "success", "siterequests": []}), 200
 
-        # Fetch all users' settings using load_users_settings
-        users_settings = load_users_settings()
         siterequests = []
 
         # Iterate through the siterequest directory to gather all site requests
         for filename in os.listdir(siterequest_dir):            
+            if filename.startswith('.'):
+                continue  # Skip lock and in-progress temp files
             user_id = filename
             site_request = load_site_request(user_id)
             if site_request:                
-                first_name = users_settings.get(user_id, {}).get('first_name', '')
-                last_name = users_settings.get(user_id, {}).get('last_name', '')
-                email = users_settings.get(user_id, {}).get('email_address', '')
+                user_settings = get_user_settings(user_id)
+                first_name = user_settings.get('first_name', '')
+                last_name = user_settings.get('last_name', '')
+                email = user_settings.get('email_address', '')
                 organisation = site_request.get('communityName', '')
                 siterequests.append({
                     'user_id': user_id,
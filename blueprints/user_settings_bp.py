@@ -1,7 +1,7 @@
 from flask import Blueprint, request, jsonify, current_app
 from utils.auth import login_required, get_authenticated_user
-from utils.users import load_users_settings, save_users_settings
-from utils.config import load_config
+from utils.users import get_user_settings, save_user_settings
+from utils.config import get_config, get_settings_view, thaw
 from utils.posthog_utils import get_date_range, fetch_events, format_event_details  # Import helper functions
 from utils import wix
 import logging
@@ -19,18 +19,18 @@ def manage_user_settings():
     """
     try:
         user_id = request.user_id
-        users_settings = load_users_settings()
+        user = get_user_settings(user_id)
         
-        if user_id not in users_settings:
+        if not user:
             return jsonify({"status": "error", "message": "User not found"}), 404
         
         expected_fields = ["contact_name", "website_url", "email_address", "phone_number"]
         for field in expected_fields:
-            if field not in users_settings[user_id]:
-                users_settings[user_id][field] = ""
+            if field not in user:
+                user[field] = ""
         
         if request.method == 'GET':
-            top_level_settings = {k: v for k, v in users_settings[user_id].items()}
+            top_level_settings = {k: v for k, v in user.items()}
             return jsonify({"status": "success", "settings": top_level_settings}), 200
         
         elif request.method == 'PUT':
@@ -38,8 +38,7 @@ def manage_user_settings():
             if not data:
                 return jsonify({"status": "error", "message": "No data provided"}), 400
             
-            users_settings[user_id] = data
-            save_users_settings(users_settings)
+            save_user_settings(user_id, data)
             logging.info(f"Top-level settings replaced for user {user_id}")
             return jsonify({"status": "success", "message": "Settings replaced"}), 200
         
@@ -49,9 +48,9 @@ def manage_user_settings():
                 return jsonify({"status": "error", "message": "No data provided"}), 400
             
             for field, value in data.items():
-                users_settings[user_id][field] = value
+                user[field] = value
             
-            save_users_settings(users_settings)
+            save_user_settings(user_id, user)
             logging.info(f"Top-level settings updated for user {user_id}")
             return jsonify({"status": "success", "message": "Settings updated"}), 200
     
@@ -65,19 +64,7 @@ def manage_user_settings():
 @login_required(["allauth"], require_all=False)
 def get_client_api_settings():
     try:
-        config = load_config()
-        settings = [
-            {
-                "key_type": key,
-                "fields": {k: v for k, v in value.items() if k not in ["setting_type", "icon", "doc_link", "_comment", "_description"]},                
-                "icon": value.get("icon", "icon-favicon"),
-                "doc_link": value.get("doc_link", ""),
-                "comment": value.get("_comment", ""),
-                "description": value.get("_description", "")
-            }
-            for key, value in config.items()
-            if value.get("setting_type") == "client_api"
-        ]
+        settings = thaw(get_settings_view("client_api"))
         return jsonify({"status": "success", "settings": settings}), 200
     except Exception as e:
         logging.error(f"Error retrieving client_api settings: {str(e)}")
@@ -92,20 +79,20 @@ def put_client_api_setting(key):
         if not data:
             return jsonify({"status": "error", "message": "No data provided"}), 400
 
-        config = load_config()
+        config = get_config()
         if key not in config or config[key].get("setting_type") != "client_api":
             return jsonify({"status": "error", "message": "Invalid key"}), 400
 
-        users_settings = load_users_settings()
-        if user_id not in users_settings:
+        user = get_user_settings(user_id)
+        if not user:
             return jsonify({"status": "error", "message": "User not found"}), 404
 
-        if "settings" not in users_settings[user_id]:
-            users_settings[user_id]["settings"] = {}
-        if "client_api" not in users_settings[user_id]["settings"]:
-            users_settings[user_id]["settings"]["client_api"] = {}
-        users_settings[user_id]["settings"]["client_api"][key] = data
-        save_users_settings(users_settings)
+        if "settings" not in user:
+            user["settings"] = {}
+        if "client_api" not in user["settings"]:
+            user["settings"]["client_api"] = {}
+        user["settings"]["client_api"][key] = data
+        save_user_settings(user_id, user)
         return jsonify({"status": "success", "message": f"Setting {key} replaced"}), 200
     except Exception as e:
         logging.error(f"Error replacing client_api setting for user {request.user_id}: {str(e)}")
@@ -120,21 +107,21 @@ def patch_client_api_setting(key):
         if not data:
             return jsonify({"status": "error", "message": "No data provided"}), 400
 
-        config = load_config()
+        config = get_config()
         if key not in config or config[key].get("setting_type") != "client_api":
             return jsonify({"status": "error", "message": "Invalid key"}), 400
 
-        users_settings = load_users_settings()
-        if user_id not in users_settings or "settings" not in users_settings[user_id] or "client_api" not in users_settings[user_id]["settings"] or key not in users_settings[user_id]["settings"]["client_api"]:
+        user = get_user_settings(user_id)
+        if not user or "settings" not in user or "client_api" not in user["settings"] or key not in user["settings"]["client_api"]:
             return jsonify({"status": "error", "message": "Setting not found"}), 404
 
         for field, value in data.items():
-            if field in users_settings[user_id]["settings"]["client_api"][key]:
-                users_settings[user_id]["settings"]["client_api"][key][field] = value
+            if field in user["settings"]["client_api"][key]:
+                user["settings"]["client_api"][key][field] = value
             else:
                 return jsonify({"status": "error", "message": f"Invalid field: {field}"}), 400
 
-        save_users_settings(users_settings)
+        save_user_settings(user_id, user)
         return jsonify({"status": "success", "message": f"Setting {key} updated"}), 200
     except Exception as e:
         logging.error(f"Error updating client_api setting for user {request.user_id}: {str(e)}")
@@ -145,29 +132,19 @@ def patch_client_api_setting(key):
 def get_api_key_settings():
     try:
         user_id = request.user_id
-        config = load_config()
-        users_settings = load_users_settings()
+        user = get_user_settings(user_id)
         
-        if user_id not in users_settings:
+        if not user:
             return jsonify({"status": "error", "message": "User not found"}), 404
         
-        user_api_keys = users_settings[user_id].get("settings", {}).get("api_key", {})
+        user_api_keys = user.get("settings", {}).get("api_key", {})
         
         settings = []
-        for key, value in config.items():
-            if value.get("setting_type") == "api_key":
-                default_fields = {k: v for k, v in value.items() if k not in ["setting_type", "icon", "doc_link", "_comment", "_description"]}
-                user_fields = user_api_keys.get(key, {})
-                merged_fields = {field: user_fields.get(field, default_fields.get(field, "")) for field in default_fields}
-                setting = {
-                    "key_type": key,
-                    "fields": merged_fields,
-                    "icon": value.get("icon", "icon-favicon"),
-                    "doc_link": value.get("doc_link", ""),
-                    "comment": value.get("_comment", ""),
-                    "description": value.get("_description", "")
-                }
-                settings.append(setting)
+        for setting in get_settings_view("api_key"):
+            default_fields = setting["fields"]
+            user_fields = user_api_keys.get(setting["key_type"], {})
+            merged_fields = {field: user_fields.get(field, default_fields.get(field, "")) for field in default_fields}
+            settings.append({**thaw(setting), "fields": merged_fields})
         
         return jsonify({"status": "success", "settings": settings}), 200
     except Exception as e:
@@ -183,20 +160,20 @@ def put_api_key_setting(key):
         if not data:
             return jsonify({"status": "error", "message": "No data provided"}), 400
 
-        config = load_config()
+        config = get_config()
         if key not in config or config[key].get("setting_type") != "api_key":
             return jsonify({"status": "error", "message": "Invalid key"}), 400
 
-        users_settings = load_users_settings()
-        if user_id not in users_settings:
+        user = get_user_settings(user_id)
+        if not user:
             return jsonify({"status": "error", "message": "User not found"}), 404
 
-        if "settings" not in users_settings[user_id]:
-            users_settings[user_id]["settings"] = {}
-        if "api_key" not in users_settings[user_id]["settings"]:
-            users_settings[user_id]["settings"]["api_key"] = {}
-        users_settings[user_id]["settings"]["api_key"][key] = data
-        save_users_settings(users_settings)
+        if "settings" not in user:
+            user["settings"] = {}
+        if "api_key" not in user["settings"]:
+            user["settings"]["api_key"] = {}
+        user["settings"]["api_key"][key] = data
+        save_user_settings(user_id, user)
         return jsonify({"status": "success", "message": f"Setting {key} replaced"}), 200
     except Exception as e:
         logging.error(f"Error replacing api_key setting for user {request.user_id}: {str(e)}")
@@ -211,27 +188,27 @@ def patch_api_key_setting(key):
         if not data:
             return jsonify({"status": "error", "message": "No data provided"}), 400
 
-        config = load_config()
+        config = get_config()
         if key not in config or config[key].get("setting_type") != "api_key":
             return jsonify({"status": "error", "message": "Invalid key"}), 400
 
-        users_settings = load_users_settings()
-        if user_id not in users_settings:
+        user = get_user_settings(user_id)
+        if not user:
             return jsonify({"status": "error", "message": "User not found"}), 404
 
-        if "settings" not in users_settings[user_id]:
-            users_settings[user_id]["settings"] = {}
-        if "api_key" not in users_settings[user_id]["settings"]:
-            users_settings[user_id]["settings"]["api_key"] = {}
-        if key not in users_settings[user_id]["settings"]["api_key"]:
-            users_settings[user_id]["settings"]["api_key"][key] = {}
+        if "settings" not in user:
+            user["settings"] = {}
+        if "api_key" not in user["settings"]:
+            user["settings"]["api_key"] = {}
+        if key not in user["settings"]["api_key"]:
+            user["settings"]["api_key"][key] = {}
 
         allowed_fields = [field for field in config[key] if not field.startswith("_")]
         for field, value in data.items():
             if field in allowed_fields:
-                users_settings[user_id]["settings"]["api_key"][key][field] = value
+                user["settings"]["api_key"][key][field] = value
 
-        save_users_settings(users_settings)
+        save_user_settings(user_id, user)
         return jsonify({"status": "success", "message": f"Setting {key} updated"}), 200
     except Exception as e:
         logging.error(f"Error updating api_key setting for user {request.user_id}: {str(e)}")
@@ -249,3 +226,21 @@ def get_user_products():
         logging.error(f"Error fetching products for user {request.user_id}: {str(e)}")
         return jsonify({"status": "error", "message": "Failed to fetch products"}), 500
 
+@user_settings_bp.route('/settings/products/refresh', methods=['POST'])
+@login_required(["self"], require_all=True)
+def refresh_user_products():
+    """
+    Queues an immediate reload of the user's cached Wix catalog, e.g. from a Velo hook after products change.
+    Responds 202 straight away; /settings/products serves the previous copy until the reload finishes.
+    """
+    try:
+        user_id = request.user_id
+        client_id = wix.get_user_wix_client_id(user_id)
+        if not client_id:
+            return jsonify({"status": "error", "message": "No Wix API token configured"}), 400
+        wix.refresh_catalog(client_id)
+        return jsonify({"status": "success", "message": "Catalog refresh queued"}), 202
+    except Exception as e:
+        logging.error(f"Error queueing catalog refresh for user {request.user_id}: {str(e)}")
+        return jsonify({"status": "error", "message": "Failed to queue catalog refresh"}), 500
+
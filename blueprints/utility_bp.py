@@ -1,6 +1,8 @@
 from flask import Blueprint, request, jsonify, current_app, make_response
-from utils.auth import login_required, load_users_settings
+from utils.auth import login_required
+from utils.users import find_user_by_email
 from utils.helpers import get_system_stats, ping_service, log_activity
+from utils.outbound import outbound
 import logging
 import requests
 import os
@@ -157,8 +159,7 @@ def send_sms():
         message = data["message"].strip()
 
         # Look up user by email
-        users_settings = load_users_settings()
-        user_entry = next(((uid, u) for uid, u in users_settings.items() if u.get("email_address", "").lower() == email), None)
+        user_entry = find_user_by_email(email)
         if not user_entry:
             logging.warning(f"UX Issue - SMS failed - Email not found: {email}")
             response_data = {"status": "error", "message": "User not found"}
@@ -192,7 +193,7 @@ def send_sms():
             "X-TM-Key": api_key,
             "Content-Type": "application/x-www-form-urlencoded"
         }
-        response = requests.post(url, data=payload, headers=headers)
+        response = outbound("textmagic").request("POST", url, data=payload, headers=headers)
 
         if response.status_code != 201:
             logging.error(f"UX Issue - Failed to send SMS for {email}, User ID: {user_id}, Response: {response.text}")
@@ -255,7 +256,7 @@ def render_md(full_path):
                 logging.warning(f"UX Issue - Only .md files supported: {path}")
                 raise ValueError("Only .md files are supported")
             url = f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{path}"
-            response = requests.get(url)
+            response = outbound("github").request("GET", url)
             if response.status_code != 200:
                 logging.warning(f"UX Issue - File not found on GitHub: {response.status_code}")
                 raise FileNotFoundError(f"File not found on GitHub: {response.status_code}")
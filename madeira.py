@@ -7,8 +7,13 @@ from blueprints.manager_bp import manager_bp
 from blueprints.site_request_bp import site_request_bp
 from blueprints.user_settings_bp import user_settings_bp
 from blueprints.utility_bp import utility_bp
-from utils.auth import login_required, load_users_settings, generate_token, decode_token
+from utils.auth import login_required, generate_token, resolve_authenticated_user as get_authenticated_user
+from utils.users import get_user_settings, find_users_by_email, record_login, update_user_fields
 from utils.posthog_utils import initialize_posthog
+from utils.outbound import outbound
+from utils.event_store import record_event
+from utils.config import get_config, get_settings_view
+from utils.passwords import verify_login, PasswordBusyError
 from functools import wraps
 import json
 import os
@@ -16,26 +21,12 @@ import logging
 from logging.handlers import TimedRotatingFileHandler
 import datetime
 import time
-import bcrypt
-import jwt
-import requests  # Added for PostHog API calls
+import threading
 
 app = Flask(__name__, template_folder='templates')
 CORS(app)
 
-CONFIG_FILE = "config.json"
-
-def load_config():
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r') as f:
-            return json.load(f)
-    return {
-        "jwt": {"SECRET_KEY": "your-secret-key"},
-        "session": {"SECRET_KEY": "your-session-secret-key"},
-        "log_level": "DEBUG"
-    }
-
-config = load_config()
+config = get_config()
 app.config['JWT_SECRET_KEY'] = config['jwt']['SECRET_KEY']
 app.secret_key = config['session']['SECRET_KEY']
 
@@ -66,13 +57,7 @@ setup_logging()
 # Function to fetch site settings from config
 def fetch_site_settings():
     try:
-        config = load_config()
-        settings_dict = {}
-        for key, value in config.items():
-            if value.get('setting_type') == 'settings_key':
-                fields = {k: v for k, v in value.items() if k not in ['_comment', '_description', 'setting_type', 'icon', 'doc_link']}
-                settings_dict[key] = fields
-        return settings_dict
+        return {setting['key_type']: setting['fields'] for setting in get_settings_view('settings_key')}
     except Exception as e:
         logging.error(f"Error fetching site settings from config: {str(e)}", exc_info=True)
         return {}
@@ -83,73 +68,32 @@ def inject_site_settings():
     site_settings = fetch_site_settings()
     return dict(site_settings=site_settings)
 
-def get_authenticated_user():
-    token = None
-    source = None
-    
-    if 'user' in session and session['user'].get('token'):
-        try:
-            decoded = decode_token(session['user']['token'])
-            logging.debug(f"Authenticated via session for user: {decoded.get('user_id')}")
-            return decoded, session['user']['token'], "session"
-        except jwt.InvalidTokenError:
-            logging.debug("Session token invalid, clearing session")
-            session.pop('user', None)
-
-    header_token = request.headers.get('Authorization', '').replace('Bearer ', '').strip()
-    if header_token:
-        try:
-            decoded = decode_token(header_token)
-            logging.debug(f"Authenticated via Authorization header for user: {decoded.get('user_id')}")
-            session['user'] = {
-                'user_id': decoded.get('user_id'),
-                'permissions': decoded.get('permissions', []),
-                'token': header_token,
-                'x-role': decoded.get('x-role') or ('admin' if 'admin' in decoded.get('permissions', []) else next((r for r in ['merchant', 'community', 'partner'] if r in decoded.get('permissions', [])), 'login'))
-            }
-            session.modified = True
-            return decoded, header_token, "header"
-        except jwt.InvalidTokenError:
-            logging.debug("Header token invalid")
-
-    cookie_token = request.cookies.get('authToken', '')
-    if cookie_token:
-        try:
-            decoded = decode_token(cookie_token)
-            logging.debug(f"Authenticated via cookie for user: {decoded.get('user_id')}")
-            session['user'] = {
-                'user_id': decoded.get('user_id'),
-                'permissions': decoded.get('permissions', []),
-                'token': cookie_token,
-                'x-role': decoded.get('x-role') or ('admin' if 'admin' in decoded.get('permissions', []) else next((r for r in ['merchant', 'community', 'partner'] if r in decoded.get('permissions', [])), 'login'))
-            }
-            session.modified = True
-            return decoded, cookie_token, "cookie"
-        except jwt.InvalidTokenError:
-            logging.debug("Cookie token invalid")
+def format_last_login(record):
+    if not record:
+        return "This is your first login"
+    return f"Your last login was on {record.get('timestamp', 'N/A')} from IP {record.get('ip_address', 'N/A')}"
 
-    logging.debug("No valid authentication found")
-    return None, None, None
-
-# Function to fetch the user's last login from PostHog
-def fetch_last_login(user_id):
+# Backfills previous_login from PostHog for users whose logins predate local tracking; runs off the request thread
+def backfill_last_login(user_id, before):
     try:
-        config = load_config()
+        config = get_config()
         posthog_config = config.get("posthog", {})
         api_key = posthog_config.get("PROJECT_READ_KEY")
         host = posthog_config.get("HOST", "https://eu.i.posthog.com")
         project_id = posthog_config.get("PROJECT_ID")
 
         if not api_key or not project_id:
-            logging.error("PostHog configuration missing: PROJECT_READ_KEY or PROJECT_ID not set")
-            return "Last login information unavailable"
+            logging.debug("PostHog read configuration missing, skipping last login backfill")
+            return
 
-        response = requests.get(
+        response = outbound("posthog").request(
+            "GET",
             f"{host}/api/projects/{project_id}/events",
             headers={"Authorization": f"Bearer {api_key}"},
             params={
                 "event": "login",
                 "properties": json.dumps([{"key": "user_id", "value": user_id, "operator": "exact"}]),
+                "before": before,
                 "order_by": json.dumps(["-timestamp"]),
                 "limit": 1
             },
@@ -158,23 +102,19 @@ def fetch_last_login(user_id):
 
         if response.status_code != 200:
             logging.error(f"Failed to fetch login events from PostHog for user {user_id}: {response.status_code} - {response.text}")
-            return "Last login information unavailable"
+            return
 
         events_data = response.json().get("results", [])
         if events_data:
-            last_login = events_data[0]
-            timestamp = last_login.get("timestamp", "N/A")
-            ip_address = last_login.get("properties", {}).get("ip_address", "N/A")
-            return f"Your last login was on {timestamp} from IP {ip_address}"
-        else:
-            return "This is your first login"
-
-    except requests.Timeout:
-        logging.error(f"Timeout while fetching last login for user {user_id}")
-        return "Last login information unavailable"
+            previous_login = {
+                "timestamp": events_data[0].get("timestamp", "N/A"),
+                "ip_address": events_data[0].get("properties", {}).get("ip_address", "N/A")
+            }
+            # Only fill the field in, and only if no login was recorded locally meanwhile
+            update_user_fields(user_id, lambda user: {} if user.get('previous_login') else {'previous_login': previous_login})
+            logging.debug(f"Backfilled previous login for user {user_id} from PostHog")
     except Exception as e:
-        logging.error(f"Failed to retrieve last login for user {user_id}: {str(e)}", exc_info=True)
-        return "Last login information unavailable"
+        logging.error(f"Failed to backfill last login for user {user_id}: {str(e)}", exc_info=True)
 
 @app.before_request
 def log_request():
@@ -254,7 +194,7 @@ def home():
                         'stripe_account_id': stripe_account_id,
                         'role': role
                     }
-                    config = load_config()
+                    config = get_config()
                     stripe_api_key = config.get('stripe', {}).get('API_KEY', '')
                     context['stripe_sandbox'] = stripe_api_key.startswith('sk_test_')
                 response = make_response(render_template('login.html', **context))
@@ -272,13 +212,12 @@ def home():
                 session['user']['x-role'] = x_role
                 session.modified = True
             
-            users_settings = load_users_settings()
-            user_data = users_settings.get(user_id, {})
+            user_data = get_user_settings(user_id)
             if 'contact_name' not in user_data:
                 user_data['contact_name'] = ''
             user = {**user_data, 'user_id': user_id}
             # Add last_login to the user object
-            user['last_login'] = session['user'].get('last_login', 'Last login information unavailable')
+            user['last_login'] = session['user'].get('last_login') or format_last_login(user_data.get('previous_login'))
             role_pages = {
                 'admin': ('admin.html', 'Admin', 'admin'),
                 'community': ('community.html', 'Community', 'community'),
@@ -332,37 +271,47 @@ def home():
         email = data['email'].strip().lower()
         password = data['password'].strip()
 
-        users_settings = load_users_settings()
-        user_entry = next(((uid, u) for uid, u in users_settings.items() if u['email_address'].lower() == email), None)
+        # Several users may share an address; log in the one whose password matches
+        user_entries = find_users_by_email(email)
 
-        if user_entry:
-            user_id, user = user_entry
-            stored_hash = user['password']
-            logging.debug(f"Stored password hash for {user_id}: {stored_hash[:10]}...")
+        if user_entries:
             logging.debug(f"Provided password length: {len(password)}")
-
-            if bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8')):
+            verified = None
+            for candidate_id, candidate in user_entries:
+                stored_hash = candidate.get('password', '')
+                logging.debug(f"Stored password hash for {candidate_id}: {stored_hash[:10]}...")
+                if verify_login(candidate_id, candidate, password):
+                    verified = (candidate_id, candidate)
+                    break
+
+            if verified:
+                user_id, user = verified
                 permissions = user['permissions']
                 x_role = 'admin' if 'admin' in permissions else next((r for r in ['merchant', 'community', 'partner'] if r in permissions), 'login')
                 token = generate_token(user_id, permissions, x_role=x_role)
-                # Fetch last login before recording current login event
-                last_login_message = fetch_last_login(user_id)
+                # Record this login locally; the previous one is what the user is shown
+                login_timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+                previous_login = record_login(user_id, request.remote_addr, login_timestamp)
                 session['user'] = {
                     'user_id': user_id,
                     'permissions': permissions,
                     'token': token,
-                    'x-role': x_role,
-                    'last_login': last_login_message  # Store in session
+                    'x-role': x_role
                 }
+                if previous_login:
+                    session['user']['last_login'] = format_last_login(previous_login)
+                else:
+                    threading.Thread(target=backfill_last_login, args=(user_id, login_timestamp), daemon=True).start()
                 session.modified = True
                 logging.debug(f"Login successful, x-role set to {x_role} for user {user_id}")
 
-                # Record login event in PostHog after fetching last login
+                # Record login event in PostHog
                 login_data = {
                     "user_id": user_id,
-                    "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "timestamp": login_timestamp,
                     "ip_address": request.remote_addr
                 }
+                record_event("login", user_id, login_data)
                 if current_app.posthog_client:
                     try:
                         current_app.posthog_client.capture(
@@ -391,6 +340,8 @@ def home():
             logging.debug(f"User not found for email: {email}")
             return jsonify({"status": "error", "message": "Invalid credentials"}), 401
 
+    except PasswordBusyError as e:
+        return jsonify({"status": "error", "message": str(e)}), e.status_code
     except Exception as e:
         logging.error(f"UX Issue - Failed to process request: {str(e)}", exc_info=True)
         return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
@@ -0,0 +1,57 @@
+import threading
+import pytest
+from utils.cache import TTLCache
+
+def test_stream_failure_propagates_and_is_remembered():
+    cache = TTLCache()
+    calls = []
+
+    def failing():
+        calls.append(1)
+        yield {"n": 1}
+        raise RuntimeError("upstream down")
+
+    received = []
+    with pytest.raises(RuntimeError):
+        for item in cache.stream_or_load("key", failing, ttl=60, negative_ttl=15):
+            received.append(item)
+    assert received == [{"n": 1}]
+
+    # Within negative_ttl the failure is raised again without going upstream
+    with pytest.raises(RuntimeError):
+        list(cache.stream_or_load("key", failing, ttl=60, negative_ttl=15))
+    assert len(calls) == 1
+    assert cache.get("key") is None
+
+def test_concurrent_streams_share_one_upstream_read(tmp_path):
+    cache = TTLCache(disk_dir=str(tmp_path))
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        yield 1
+        started.set()
+        release.wait(5)
+        yield 2
+
+    leader = cache.stream_or_load("key", slow, ttl=60)
+    assert next(leader) == 1
+    started.wait(5)
+    results = []
+    follower = threading.Thread(target=lambda: results.append(list(cache.stream_or_load("key", slow, ttl=60))))
+    follower.start()
+    release.set()
+    assert list(leader) == [2]
+    follower.join(5)
+    assert results == [[1, 2]]
+    assert len(calls) == 1
+
+    # Another worker process finds the result on disk
+    assert list(TTLCache(disk_dir=str(tmp_path)).stream_or_load("key", slow, ttl=60)) == [1, 2]
+    assert len(calls) == 1
+
+def test_results_over_max_items_are_not_cached():
+    cache = TTLCache()
+    assert list(cache.stream_or_load("key", lambda: iter(range(5)), ttl=60, max_items=3)) == [0, 1, 2, 3, 4]
+    assert cache.get("key") is None
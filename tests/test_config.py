@@ -0,0 +1,24 @@
+import json
+from utils import config
+
+def test_unreadable_config_keeps_the_last_good_snapshot(tmp_path, monkeypatch):
+    path = tmp_path / "config.json"
+    monkeypatch.setattr(config, "CONFIG_FILE", str(path))
+    monkeypatch.setattr(config, "_cached_config", None)
+    path.write_text(json.dumps({"jwt": {"SECRET_KEY": "real"}}))
+    assert config.get_config()["jwt"]["SECRET_KEY"] == "real"
+
+    path.write_text("{broken")
+    assert config.get_config()["jwt"]["SECRET_KEY"] == "real"
+
+    # The failed read isn't cached, so the fixed file is picked up
+    path.write_text(json.dumps({"jwt": {"SECRET_KEY": "fixed"}}))
+    assert config.get_config()["jwt"]["SECRET_KEY"] == "fixed"
+
+def test_unreadable_config_without_a_good_snapshot_is_retried(tmp_path, monkeypatch):
+    path = tmp_path / "config.json"
+    monkeypatch.setattr(config, "CONFIG_FILE", str(path))
+    monkeypatch.setattr(config, "_cached_config", None)
+    path.write_text("{broken")
+    assert config.get_config()["jwt"]["SECRET_KEY"] == "your-secret-key"
+    assert config._cached_config is None
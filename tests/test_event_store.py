@@ -0,0 +1,38 @@
+import pytest
+from utils import event_store as event_store_module
+from utils.event_store import EventStore, period_aligned
+from utils.posthog_utils import get_date_range
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(event_store_module, "get_user_fields", lambda user_ids, fields: {})
+    monkeypatch.setattr(event_store_module, "get_referral_chain", lambda user_id: ())
+    return EventStore(str(tmp_path / "events.db"))
+
+@pytest.mark.parametrize("period", ["today", "this_week"])
+def test_month_granularity_is_rejected_for_shorter_periods(store, period):
+    store.record("order", "buyer", {"source_user_id": "buyer", "destination_user_id": "shop", "sale_value": 12.5})
+    start, end = get_date_range(period)
+
+    assert store.summarize("buyer", "source", "order", start, end, "day")["totals"] == {"count": 1, "sale_value": 12.5}
+    assert not period_aligned(start, end, "month")
+    with pytest.raises(ValueError):
+        store.summarize("buyer", "source", "order", start, end, "month")
+
+def test_month_granularity_sums_a_whole_month(store):
+    store.record("order", "buyer", {"source_user_id": "buyer", "destination_user_id": "shop", "sale_value": 12.5})
+    start, end = get_date_range("this_month")
+
+    assert period_aligned(start, end, "month")
+    assert store.summarize("buyer", "source", "order", start, end, "month")["totals"] == {"count": 1, "sale_value": 12.5}
+
+def test_orders_roll_up_to_each_upline_level_once(store, monkeypatch):
+    chains = {"buyer": (("middle", 1), ("top", 2)), "shop": (("top", 1),)}
+    monkeypatch.setattr(event_store_module, "get_referral_chain", lambda user_id: chains.get(user_id, ()))
+    store.record("order", "buyer", {"source_user_id": "buyer", "destination_user_id": "shop", "sale_value": 12.5})
+    start, end = get_date_range("today")
+
+    assert store.summarize_levels("middle", "order", start, end) == {1: {"count": 1, "sale_value": 12.5}}
+    # top is two levels above the buyer but directly above the shop, so the order counts once, at level 1
+    assert store.summarize_levels("top", "order", start, end) == {1: {"count": 1, "sale_value": 12.5}}
+    assert store.summarize_levels("buyer", "order", start, end) == {}
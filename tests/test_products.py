@@ -0,0 +1,40 @@
+from utils.cache import TTLCache
+from utils.products import DealsEngine, FakeProvider
+
+def test_deals_engine_skips_late_and_failing_providers():
+    fast = FakeProvider("fast", [{"id": "tent", "title": "Tent", "current_price": 50, "discount_percent": 30}])
+    slow = FakeProvider("slow", [{"id": "stove", "title": "Stove", "current_price": 20, "discount_percent": 40}], delay=0.5, timeout=0.05)
+    broken = FakeProvider("broken", error=RuntimeError("boom"))
+    engine = DealsEngine([fast, slow, broken], cache=TTLCache(maxsize=16))
+
+    result = engine.search("camping", min_discount=20)
+
+    assert [deal["id"] for deal in result["products"]] == ["tent"]
+    assert result["providers"]["fast"] == {"status": "ok", "count": 1}
+    assert result["providers"]["slow"]["status"] == "timeout"
+    assert result["providers"]["broken"] == {"status": "error", "count": 0, "message": "boom"}
+
+def test_deals_engine_merges_duplicates_and_ranks_by_discount():
+    first = FakeProvider("first", [
+        {"id": "a1", "title": "Tent", "current_price": 50, "discount_percent": 25},
+        {"id": "a2", "title": "Lamp", "current_price": 10, "discount_percent": 10}
+    ])
+    second = FakeProvider("second", [
+        {"id": "b1", "title": "tent ", "current_price": 50, "discount_percent": 35},
+        {"id": "b2", "title": "Stove", "current_price": 20, "discount_percent": 30}
+    ])
+    engine = DealsEngine([first, second], cache=TTLCache(maxsize=16))
+
+    result = engine.search("camping", min_discount=20)
+
+    # The tent is listed by both sources and kept once, from the better discount
+    assert [(deal["source"], deal["id"]) for deal in result["products"]] == [("second", "b1"), ("second", "b2")]
+
+def test_deals_engine_caches_provider_results():
+    provider = FakeProvider("fake", [{"id": "tent", "title": "Tent", "current_price": 50, "discount_percent": 30}])
+    engine = DealsEngine([provider], cache=TTLCache(maxsize=16))
+
+    engine.search("camping", min_discount=20)
+    engine.search("camping", min_discount=20)
+
+    assert provider.calls == 1
@@ -0,0 +1,50 @@
+import pytest
+from flask import Flask
+from utils import auth
+from utils import event_store as event_store_module
+from utils.event_store import EventStore
+import blueprints.referral_bp as referral_bp_module
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(event_store_module, "get_user_fields", lambda user_ids, fields: {})
+    monkeypatch.setattr(event_store_module, "get_referral_chain", lambda user_id: ())
+    store = EventStore(str(tmp_path / "events.db"))
+    store.record("order", "buyer", {"source_user_id": "buyer", "destination_user_id": "shop", "sale_value": 12.5})
+    monkeypatch.setattr(referral_bp_module, "event_store", store)
+    monkeypatch.setattr(auth, "resolve_authenticated_user", lambda: ({"user_id": "buyer", "x-role": "community", "permissions": ["community"]}, "token", None))
+    app = Flask(__name__)
+    app.register_blueprint(referral_bp_module.referral_bp)
+    return app.test_client()
+
+def test_summary_counts_the_period(client):
+    response = client.get("/summary/order?period=today&granularity=day")
+
+    assert response.status_code == 200
+    assert response.get_json()["totals"] == {"count": 1, "sale_value": 12.5}
+
+@pytest.mark.parametrize("period", ["today", "this_week"])
+def test_summary_rejects_granularity_coarser_than_period(client, period):
+    response = client.get(f"/summary/order?period={period}&granularity=month")
+
+    assert response.status_code == 400
+    assert response.get_json()["status"] == "error"
+
+def test_commission_is_attributed_per_level(tmp_path, monkeypatch):
+    chains = {"buyer": (("middle", 1), ("partner", 2))}
+    monkeypatch.setattr(event_store_module, "get_user_fields", lambda user_ids, fields: {})
+    monkeypatch.setattr(event_store_module, "get_referral_chain", lambda user_id: chains.get(user_id, ()))
+    store = EventStore(str(tmp_path / "events.db"))
+    store.record("order", "buyer", {"source_user_id": "buyer", "destination_user_id": "shop", "sale_value": 20})
+    monkeypatch.setattr(referral_bp_module, "event_store", store)
+    monkeypatch.setattr(referral_bp_module, "commission_rates", lambda: (0.1, 0.05))
+    monkeypatch.setattr(auth, "resolve_authenticated_user", lambda: ({"user_id": "partner", "x-role": "partner", "permissions": ["partner"]}, "token", None))
+    app = Flask(__name__)
+    app.register_blueprint(referral_bp_module.referral_bp)
+
+    response = app.test_client().get("/referrer/commission?period=today")
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [(level["level"], level["orders"], level["attributed"]) for level in body["levels"]] == [(1, 0, 0.0), (2, 1, 1.0)]
+    assert body["attributed"] == 1.0
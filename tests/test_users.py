@@ -0,0 +1,73 @@
+from utils.users import UserStore
+
+def test_shared_email_lookup_survives_removing_either_user(tmp_path):
+    store = UserStore(str(tmp_path / "users.db"))
+    store.put("first", {"email_address": "shared@example.com"})
+    store.put("second", {"email_address": "Shared@example.com"})
+    assert store.find_by_email("shared@example.com")[0] == "first"
+
+    # Updating the first user keeps it first; removing it hands the address to the second
+    store.put("first", {"email_address": "shared@example.com", "contact_name": "First"})
+    assert store.find_by_email("shared@example.com")[0] == "first"
+    store.replace_all({"second": store.get("second")})
+    assert store.find_by_email("shared@example.com")[0] == "second"
+
+def test_every_user_sharing_an_email_is_found(tmp_path):
+    store = UserStore(str(tmp_path / "users.db"))
+    store.put("first", {"email_address": "shared@example.com"})
+    store.put("second", {"email_address": "Shared@example.com"})
+    assert [user_id for user_id, _ in store.find_all_by_email(" SHARED@example.com")] == ["first", "second"]
+    assert store.find_all_by_email("nobody@example.com") == []
+
+def test_changing_email_moves_the_lookup(tmp_path):
+    store = UserStore(str(tmp_path / "users.db"))
+    store.put("user", {"email_address": "old@example.com"})
+    store.put("user", {"email_address": "new@example.com"})
+    assert store.find_by_email("old@example.com") is None
+    assert store.find_by_email("new@example.com")[0] == "user"
+
+def test_record_login_only_touches_login_fields(tmp_path, monkeypatch):
+    from utils import users
+    store = UserStore(str(tmp_path / "users.db"))
+    monkeypatch.setattr(users, "user_store", store)
+    store.put("user", {"email_address": "user@example.com"})
+
+    assert users.record_login("user", "10.0.0.1", "2025-05-09T10:00:00Z") is None
+    store.put("user", dict(store.get("user"), contact_name="Saved meanwhile"))
+    previous = users.record_login("user", "10.0.0.2", "2025-05-10T10:00:00Z")
+
+    user = store.get("user")
+    assert previous == {"timestamp": "2025-05-09T10:00:00Z", "ip_address": "10.0.0.1"}
+    assert user["previous_login"] == previous
+    assert user["last_login"] == {"timestamp": "2025-05-10T10:00:00Z", "ip_address": "10.0.0.2"}
+    assert user["contact_name"] == "Saved meanwhile"
+    assert users.record_login("missing", "10.0.0.3", "2025-05-10T10:00:00Z") is None
+
+def test_rehash_only_replaces_the_hash_it_checked(tmp_path, monkeypatch):
+    from utils import users, passwords
+    store = UserStore(str(tmp_path / "users.db"))
+    monkeypatch.setattr(users, "user_store", store)
+    monkeypatch.setattr(passwords, "_hashpw", lambda password, rounds: f"new-{rounds}")
+    store.put("user", {"password": "old", "contact_name": "User"})
+
+    passwords._rehash("user", "old", "secret", 12)
+    assert store.get("user")["password"] == "new-12"
+    assert store.get("user")["contact_name"] == "User"
+
+    # A password changed while the rehash was queued is left alone
+    passwords._rehash("user", "old", "secret", 13)
+    assert store.get("user")["password"] == "new-12"
+
+def test_referral_chain_follows_referrer_changes(tmp_path):
+    store = UserStore(str(tmp_path / "users.db"))
+    store.put("top", {})
+    store.put("middle", {"referrer": "top"})
+    store.put("buyer", {"referrer": "middle"})
+    assert store.referral_chain("buyer") == (("middle", 1), ("top", 2))
+    assert store.referral_chain("buyer", max_depth=1) == (("middle", 1),)
+
+    # The memoised chain is dropped when an edge changes
+    store.put("middle", {"referrer": "other"})
+    assert store.referral_chain("buyer") == (("middle", 1), ("other", 2))
+    store.put("other", {"referrer": "buyer"})
+    assert store.referral_chain("buyer") == (("middle", 1), ("other", 2))
@@ -2,27 +2,33 @@ from functools import wraps
 from flask import request, jsonify, current_app, url_for, redirect, session
 import jwt
 import datetime
-import bcrypt
 import string
 import random
 import logging
 import json
-from utils.users import load_users_settings, save_users_settings
+import time
+import hashlib
+import threading
+import copy
+from collections import OrderedDict
+from utils.passwords import verify_login, hash_password, PasswordBusyError
+from utils.users import save_user_settings, get_user_value, find_user_by_email, find_users_by_email, record_login, update_user_fields
+
+# Verified token payloads keyed by a digest of the signing key and token, most recently used last
+TOKEN_CACHE_SIZE = 10000
+_verified_tokens = OrderedDict()
+_token_digests_by_user = {}
+_token_cache_lock = threading.Lock()
 
 def login_required(required_permissions, require_all=True):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            token = request.headers.get("Authorization", "").replace("Bearer ", "")
-            if not token and 'user' in session:
-                token = session.get('user', {}).get('token', '')
-
-            if not token:
-                logging.warning("Security Issue - No token provided in Authorization header or session, redirecting to /")
-                return redirect(url_for('home'))
-
             try:
-                payload = decode_token(token)
+                payload, _, _ = resolve_authenticated_user()
+                if not payload:
+                    logging.warning("Security Issue - No valid token in Authorization header, session or cookie, redirecting to /")
+                    return redirect(url_for('home'))
                 request.user_id = payload["user_id"]
                 request.permissions = payload.get("permissions", [])
                 effective_perms = []
@@ -46,9 +52,6 @@ def login_required(required_permissions, require_all=True):
                         logging.warning(f"Security Issue - Insufficient permissions for user {request.user_id}: required={effective_perms}, has={request.permissions}")
                         return jsonify({"status": "error", "message": f"Insufficient permissions: {effective_perms}"}), 403
                 return f(*args, **kwargs)
-            except jwt.InvalidTokenError:
-                logging.error("Security Issue - Invalid token provided, redirecting to /", exc_info=True)
-                return redirect(url_for('home'))
             except Exception as e:
                 logging.error(f"UX Issue - Token processing error: {str(e)}", exc_info=True)
                 return jsonify({"status": "error", "message": f"Token error: {str(e)}"}), 500
@@ -62,20 +65,21 @@ def login_user():
             logging.warning("UX Issue - Login attempt with missing email or password")
             return jsonify({"status": "error", "message": "Email and password required"}), 400
         email = data["email"].strip().lower()
-        users_settings = load_users_settings()
 
+        # Several users may share an address; log in the one whose password matches
         user_id = None
         user = None
-        for uid, settings in users_settings.items():
-            if settings.get("email_address", "").lower() == email:
-                try:
-                    if bcrypt.checkpw(data["password"].encode('utf-8'), settings["password"].encode('utf-8')):
-                        user_id = uid
-                        user = settings
-                        break
-                except Exception as e:
-                    logging.error(f"Security Issue - Password verification failed for email {email}: {str(e)}", exc_info=True)
-                    return jsonify({"status": "error", "message": "Invalid password format in user data"}), 500
+        for uid, settings in find_users_by_email(email):
+            try:
+                if verify_login(uid, settings, data["password"]):
+                    user_id = uid
+                    user = settings
+                    break
+            except PasswordBusyError:
+                raise
+            except Exception as e:
+                logging.error(f"Security Issue - Password verification failed for email {email}: {str(e)}", exc_info=True)
+                return jsonify({"status": "error", "message": "Invalid password format in user data"}), 500
 
         if not user_id:
             logging.warning(f"Security Issue - Login failed, no user found for email: {email}")
@@ -83,6 +87,7 @@ def login_user():
 
         permissions = user.get("permissions", [])
         token = generate_token(user_id, permissions)
+        record_login(user_id, request.remote_addr, datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"))
         
         # Store user_id and token in session
         session['user_id'] = user_id
@@ -109,6 +114,8 @@ def login_user():
         }
         logging.debug(f"Login response for user {user_id}: {json.dumps(response_data)}")
         return jsonify({"status": "success", "token": token, "user_id": user_id, "contact_name": user.get("contact_name", "User"), "redirect_url": redirect_url}), 200
+    except PasswordBusyError as e:
+        return jsonify({"status": "error", "message": str(e)}), e.status_code
     except Exception as e:
         logging.error(f"UX Issue - Login processing error: {str(e)}", exc_info=True)
         return jsonify({"status": "error", "message": f"Server error: {str(e)}"}), 500
@@ -132,29 +139,32 @@ def signup_user():
             logging.warning(f"UX Issue - Signup failed, invalid phone format: {signup_phone}")
             return jsonify({"status": "error", "message": "Phone number must be a 10-digit number with no spaces or special characters"}), 400
 
-    users_settings = load_users_settings()
-    if any(u['email_address'] == data['signup_email'] for u in users_settings.values()):
+    if find_user_by_email(data['signup_email']):
         logging.warning(f"UX Issue - Signup failed, email exists: {data['signup_email']}")
         return jsonify({"status": "error", "message": "Email exists"}), 400
 
     USERid = generate_code()
-    hashed_password = bcrypt.hashpw(data['signup_password'].encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-    users_settings[USERid] = {
+    try:
+        hashed_password = hash_password(data['signup_password'])
+    except PasswordBusyError as e:
+        return jsonify({"status": "error", "message": str(e)}), e.status_code
+    save_user_settings(USERid, {
         "email_address": data['signup_email'],
         "password": hashed_password,
         "contact_name": data['contact_name'],
         "phone_number": signup_phone,
         "permissions": [data['signup_type']]
-    }
-    save_users_settings(users_settings)
+    })
     logging.debug(f"User signed up - User ID: {USERid}, Type: {signup_type}")
     return jsonify({"status": "success", "message": "Signup successful"}), 201
 
 def generate_token(user_id, permissions, x_role=None):
+    now = int(datetime.datetime.utcnow().timestamp())
     payload = {
         "user_id": user_id,
         "permissions": permissions,
-        "exp": int(datetime.datetime.utcnow().timestamp() + (24 * 3600))
+        "iat": now,
+        "exp": now + (24 * 3600)
     }
     if x_role:
         payload["x-role"] = x_role
@@ -162,18 +172,68 @@ def generate_token(user_id, permissions, x_role=None):
     logging.debug(f"Generated token for user {user_id} with x-role {x_role}: [REDACTED]")
     return token
 
+def _forget_token(digest):
+    payload = _verified_tokens.pop(digest, None)
+    if payload is not None:
+        digests = _token_digests_by_user.get(payload.get("user_id"))
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del _token_digests_by_user[payload.get("user_id")]
+
+def _tokens_revoked(payload):
+    revoked_before = get_user_value(payload.get("user_id"), "tokens_revoked_before")
+    return bool(revoked_before) and payload.get("iat", 0) < revoked_before
+
 def decode_token(token):
+    """
+    Verifies a JWT and returns its payload.
+    Verified payloads are cached (bounded LRU keyed by token digest) until the token's exp,
+    so repeat requests skip the HS256 verification.
+    Raises jwt.InvalidTokenError for invalid or expired tokens and for tokens issued
+    before the user's permissions last changed.
+    """
+    secret = current_app.config['JWT_SECRET_KEY']
+    digest = hashlib.sha256(f"{secret}:{token}".encode('utf-8')).hexdigest()
+    now = time.time()
+    with _token_cache_lock:
+        payload = _verified_tokens.get(digest)
+        if payload is not None:
+            if payload["exp"] > now:
+                _verified_tokens.move_to_end(digest)
+            else:
+                _forget_token(digest)
+                payload = None
     try:
-        payload = jwt.decode(token, current_app.config['JWT_SECRET_KEY'], algorithms=["HS256"])
-        if datetime.datetime.utcnow().timestamp() > payload["exp"]:
-            logging.warning(f"Security Issue - Token expired for user: {payload.get('user_id')}")
-            raise jwt.InvalidTokenError("Token expired")
-        logging.debug(f"Decoded token for user {payload['user_id']}")
-        return payload
+        if payload is None:
+            payload = jwt.decode(token, secret, algorithms=["HS256"], options={"require": ["exp"]})
+            logging.debug(f"Decoded token for user {payload['user_id']}")
+            with _token_cache_lock:
+                _verified_tokens[digest] = payload
+                _token_digests_by_user.setdefault(payload["user_id"], set()).add(digest)
+                while len(_verified_tokens) > TOKEN_CACHE_SIZE:
+                    _forget_token(next(iter(_verified_tokens)))
+        if _tokens_revoked(payload):
+            with _token_cache_lock:
+                _forget_token(digest)
+            logging.warning(f"Security Issue - Token for user {payload.get('user_id')} predates a permission change")
+            raise jwt.InvalidTokenError("Token revoked after permission change")
+        return copy.deepcopy(payload)
     except jwt.InvalidTokenError as e:
         logging.error(f"Security Issue - Invalid token: {str(e)}", exc_info=True)
         raise
 
+def invalidate_user_tokens(user_id):
+    """
+    Drops cached verifications of user_id's tokens and revokes every token issued so far,
+    so permission changes take effect on the user's next request in every worker.
+    """
+    with _token_cache_lock:
+        for digest in list(_token_digests_by_user.get(user_id, ())):
+            _forget_token(digest)
+    update_user_fields(user_id, lambda user: {"tokens_revoked_before": int(time.time())})
+    logging.info(f"Invalidated tokens for user {user_id}")
+
 def generate_code():
     charset = string.digits + string.ascii_uppercase
     code = ''.join(random.choice(charset) for _ in range(7))
@@ -181,25 +241,56 @@ def generate_code():
     checksum = charset[total % 36]
     return code + checksum
 
+def resolve_authenticated_user():
+    """
+    Resolves the caller's verified token from, in order, the Authorization header,
+    the session and the authToken cookie. Each distinct token is verified at most once.
+    A valid header or cookie token is mirrored into the session; an invalid session token is cleared.
+    Returns a tuple: (decoded_payload, token, source), or (None, None, None).
+    """
+    session_user = session.get('user') or {}
+    candidates = [
+        ("header", request.headers.get('Authorization', '').replace('Bearer ', '').strip()),
+        ("session", session_user.get('token', '')),
+        ("cookie", request.cookies.get('authToken', ''))
+    ]
+    tried = set()
+    for source, token in candidates:
+        if not token or token in tried:
+            continue
+        tried.add(token)
+        try:
+            decoded = decode_token(token)
+        except jwt.InvalidTokenError:
+            logging.debug(f"{source.capitalize()} token invalid")
+            if source == "session":
+                session.pop('user', None)
+            continue
+        if source != "session" and session_user.get('token') != token:
+            permissions = decoded.get('permissions', [])
+            session['user'] = {
+                'user_id': decoded.get('user_id'),
+                'permissions': permissions,
+                'token': token,
+                'x-role': decoded.get('x-role') or ('admin' if 'admin' in permissions else next((r for r in ['merchant', 'community', 'partner'] if r in permissions), 'login'))
+            }
+            session.modified = True
+        logging.debug(f"Authenticated via {source} for user: {decoded.get('user_id')}")
+        return decoded, token, source
+    logging.debug("No valid authentication found")
+    return None, None, None
+
 def get_authenticated_user():
     """
     Retrieve and decode the authenticated user's token from the request.
     Returns a tuple: (decoded_payload, token, error_response).
     """
-    token = request.headers.get("Authorization", "").replace("Bearer ", "")
-    if not token and 'user' in session:
-        token = session.get('user', {}).get('token', '')
-
-    if not token:
-        logging.warning("Security Issue - No token provided in Authorization header or session")
-        return None, None, jsonify({"status": "error", "message": "No token provided"}), 401
-
     try:
-        decoded = decode_token(token)
+        decoded, token, _ = resolve_authenticated_user()
+        if not decoded:
+            logging.warning("Security Issue - No valid token provided in Authorization header, session or cookie")
+            return None, None, (jsonify({"status": "error", "message": "Invalid or missing token"}), 401)
         return decoded, token, None
-    except jwt.InvalidTokenError as e:
-        logging.error(f"Security Issue - Invalid token: {str(e)}", exc_info=True)
-        return None, None, jsonify({"status": "error", "message": "Invalid token"}), 401
     except Exception as e:
         logging.error(f"UX Issue - Token processing error: {str(e)}", exc_info=True)
-        return None, None, jsonify({"status": "error", "message": f"Token error: {str(e)}"}), 500
\ No newline at end of file
+        return None, None, (jsonify({"status": "error", "message": f"Token error: {str(e)}"}), 500)
\ No newline at end of file
@@ -0,0 +1,223 @@
+# utils/cache.py
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+_MISSING = object()
+
+class _Failure:
+    """Negative cache entry for a failed streaming load; hits re-raise the error."""
+
+    def __init__(self, error):
+        self.error = error
+
+class TTLCache:
+    """
+    Bounded in-memory cache whose entries each carry their own time-to-live.
+    get_or_load() and its streaming counterpart stream_or_load() are single-flight per key:
+    concurrent callers for the same missing key wait for one loader call instead of each going upstream.
+    With disk_dir set, loaded values are also written there as JSON so other worker
+    processes (and restarts) can reuse them until they expire.
+    """
+
+    def __init__(self, maxsize=256, disk_dir=None):
+        self.maxsize = maxsize
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()  # key -> (expires_at, value), most recently used last
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "load_failures": 0}
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + ".json")
+
+    def _get_memory(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        if entry[0] <= now:
+            del self._entries[key]
+            return _MISSING
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _set_memory(self, key, value, expires_at):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _get_disk(self, key, now):
+        if not self.disk_dir:
+            return _MISSING, None
+        try:
+            with open(self._disk_path(key), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return _MISSING, None
+        if entry.get("key") != key or entry.get("expires_at", 0) <= now:
+            return _MISSING, None
+        return entry["value"], entry["expires_at"]
+
+    def _set_disk(self, key, value, expires_at):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump({"key": key, "expires_at": expires_at, "value": value}, f)
+            os.replace(temp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logging.warning(f"Cache Issue - Failed to write disk cache entry: {str(e)}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def get(self, key):
+        """Returns the cached value for key, or None if absent or expired."""
+        now = time.time()
+        with self._lock:
+            value = self._get_memory(key, now)
+        return None if value is _MISSING or isinstance(value, _Failure) else value
+
+    def set(self, key, value, ttl, persist=True):
+        """Caches value for ttl seconds, also on disk when persist is set and a disk_dir is configured."""
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._set_memory(key, value, expires_at)
+        if persist:
+            self._set_disk(key, value, expires_at)
+
+    def get_or_load(self, key, loader, ttl, negative_ttl=None, fallback=None):
+        """
+        Returns the cached value for key, calling loader() on a miss and caching its result for ttl seconds.
+        If loader raises and negative_ttl is given, fallback is cached in memory for negative_ttl seconds
+        and returned, so a failing upstream is retried at most once per negative_ttl; otherwise the
+        exception propagates. Failures are never written to disk.
+        """
+        now = time.time()
+        with self._lock:
+            value = self._get_memory(key, now)
+            if value is not _MISSING:
+                self._stats["hits"] += 1
+                if isinstance(value, _Failure):
+                    if negative_ttl is None:
+                        raise value.error
+                    return fallback
+                return value
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+        if not leader:
+            return future.result()
+
+        try:
+            value, expires_at = self._get_disk(key, now)
+            if value is not _MISSING:
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+                    self._set_memory(key, value, expires_at)
+            else:
+                with self._lock:
+                    self._stats["misses"] += 1
+                try:
+                    value = loader()
+                    self.set(key, value, ttl)
+                except Exception:
+                    with self._lock:
+                        self._stats["load_failures"] += 1
+                    if negative_ttl is None:
+                        raise
+                    value = fallback
+                    self.set(key, value, negative_ttl, persist=False)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stream_or_load(self, key, iterate, ttl, negative_ttl=None, max_items=None):
+        """
+        Generator counterpart of get_or_load for large results: yields the cached items for key or, on a miss,
+        the items of iterate() as they arrive, caching them (in memory and on disk) once fully read, unless there
+        are more than max_items. Single-flight per key: concurrent callers wait for the streaming caller's result
+        rather than going upstream, and only stream on their own if that result couldn't be cached.
+        If iterate() raises, the error propagates to the streaming caller and its waiters; with negative_ttl it is
+        also cached in memory, so calls within negative_ttl seconds raise it again without going upstream.
+        """
+        now = time.time()
+        with self._lock:
+            value = self._get_memory(key, now)
+            if value is not _MISSING:
+                self._stats["hits"] += 1
+                future, leader = None, False
+            else:
+                future = self._inflight.get(key)
+                leader = future is None
+                if leader:
+                    future = Future()
+                    self._inflight[key] = future
+        if value is not _MISSING:
+            if isinstance(value, _Failure):
+                raise value.error
+            yield from value
+            return
+        if not leader:
+            value = future.result()
+            yield from (value if value is not None else iterate())
+            return
+
+        try:
+            value, expires_at = self._get_disk(key, now)
+            if value is not _MISSING:
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+                    self._set_memory(key, value, expires_at)
+                future.set_result(value)
+                yield from value
+                return
+            with self._lock:
+                self._stats["misses"] += 1
+            collected = []
+            try:
+                for item in iterate():
+                    if collected is not None:
+                        collected.append(item)
+                        if max_items is not None and len(collected) > max_items:
+                            collected = None
+                    yield item
+            except Exception as e:
+                with self._lock:
+                    self._stats["load_failures"] += 1
+                if negative_ttl is not None:
+                    self.set(key, _Failure(e), negative_ttl, persist=False)
+                future.set_exception(e)
+                raise
+            if collected is not None:
+                self.set(key, collected, ttl)
+            future.set_result(collected)
+        finally:
+            if not future.done():
+                future.set_result(None)  # Abandoned mid-stream; waiters stream on their own
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._entries))
@@ -0,0 +1,213 @@
+# utils/catalog.py
+import os
+import gzip
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from utils.storage import file_lock
+
+CATALOG_VERSION = 1
+DEFAULT_FRESH_SECONDS = 900
+DEFAULT_MAX_STALE_SECONDS = 7 * 86400
+DEFAULT_REFRESH_INTERVAL = 300
+MEMORY_CATALOGS = 64
+REFRESH_WORKERS = 2
+LOAD_LOCK_TIMEOUT = 120.0  # How long a request waits for another process that is loading the same catalog
+
+class CatalogCache:
+    """
+    Per-store product catalogs kept on disk as gzipped JSON, one file per store key, and
+    served stale-while-revalidate: a catalog younger than fresh_seconds is returned as is,
+    an older one is returned immediately while a background refresh runs, and only a missing
+    (or older than max_stale_seconds) catalog makes the caller wait for loader(key, previous),
+    where previous is the copy being replaced (None if there is none) so loaders can sync incrementally.
+    Refreshes take a per-key file lock so one worker process loads a catalog while the others
+    pick up the rewritten file. A scheduler thread refreshes recently used catalogs every
+    refresh_interval seconds, and nudge() forces a refresh after a store reports a change.
+    """
+
+    def __init__(self, loader, cache_dir, fresh_seconds=DEFAULT_FRESH_SECONDS,
+                 max_stale_seconds=DEFAULT_MAX_STALE_SECONDS, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.loader = loader
+        self.cache_dir = cache_dir
+        self.fresh_seconds = fresh_seconds
+        self.max_stale_seconds = max_stale_seconds
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (file mtime, catalog), most recently used last
+        self._inflight = {}
+        self._accessed = {}  # key -> last get() time, for the scheduler
+        self._executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix="catalog-refresh")
+        self._scheduler = None
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "refresh_failures": 0}
+
+    def _path(self, key):
+        # Keys are API tokens, so file names carry only a digest
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + ".json.gz")
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            mtime = os.stat(path).st_mtime
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                catalog = json.load(f)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.warning(f"Cache Issue - Unreadable catalog file {path}: {str(e)}")
+            return None, None
+        if catalog.get("version") != CATALOG_VERSION:
+            return None, None
+        return mtime, catalog
+
+    def _write_disk(self, key, catalog):
+        path = self._path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        os.makedirs(self.cache_dir, exist_ok=True)
+        try:
+            with gzip.open(temp_path, 'wt', encoding='utf-8', compresslevel=5) as f:
+                json.dump(catalog, f, separators=(',', ':'))
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return os.stat(path).st_mtime
+
+    def _remember(self, key, mtime, catalog):
+        with self._lock:
+            self._memory[key] = (mtime, catalog)
+            self._memory.move_to_end(key)
+            while len(self._memory) > MEMORY_CATALOGS:
+                self._memory.popitem(last=False)
+
+    def _current(self, key):
+        """Returns the newest catalog for key from memory or disk, re-reading the file only when another process rewrote it."""
+        try:
+            mtime = os.stat(self._path(key)).st_mtime
+        except OSError:
+            mtime = None
+        with self._lock:
+            entry = self._memory.get(key)
+        if entry is not None and (mtime is None or entry[0] >= mtime):
+            return entry[1]
+        mtime, catalog = self._read_disk(key)
+        if catalog is not None:
+            self._remember(key, mtime, catalog)
+        return catalog
+
+    def _age(self, catalog):
+        return time.time() - catalog.get("fetched_at", 0)
+
+    def get(self, key):
+        """
+        Returns the catalog for key, refreshing it in the background when stale.
+        Waits for a load only when there is no usable copy; if that load fails, a stale copy is
+        returned when one exists, otherwise the loader's exception propagates.
+        """
+        self._ensure_scheduler()
+        with self._lock:
+            self._accessed[key] = time.time()
+        catalog = self._current(key)
+        if catalog is not None and self._age(catalog) <= self.max_stale_seconds:
+            if self._age(catalog) > self.fresh_seconds:
+                self._count("stale_hits")
+                self.refresh(key)
+            else:
+                self._count("hits")
+            return catalog
+        self._count("misses")
+        try:
+            loaded = self.refresh(key).result()
+            if loaded is None or self._age(loaded) > self.fresh_seconds:
+                # Another process holds the load lock; wait for its copy
+                loaded = self.refresh(key, newer_than=time.time() - self.fresh_seconds, lock_timeout=LOAD_LOCK_TIMEOUT).result()
+            return loaded
+        except Exception:
+            if catalog is not None:
+                logging.warning(f"Cache Issue - Catalog load failed, serving copy from {self._age(catalog):.0f}s ago")
+                return catalog
+            raise
+
+    def refresh(self, key, newer_than=None, lock_timeout=0):
+        """
+        Schedules a reload of key's catalog and returns a Future for the resulting catalog.
+        A copy fetched after newer_than (default: within fresh_seconds) is accepted instead of reloading,
+        e.g. one another process just wrote. Concurrent refreshes of one key share a single load.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None and newer_than is None:
+                return future
+            future = Future()
+            self._inflight[key] = future
+        self._executor.submit(self._refresh, key, future, newer_than, lock_timeout)
+        return future
+
+    def nudge(self, key):
+        """Forces a reload of key's catalog, e.g. after the store reports a product change. Returns the Future."""
+        return self.refresh(key, newer_than=time.time(), lock_timeout=LOAD_LOCK_TIMEOUT)
+
+    def _refresh(self, key, future, newer_than, lock_timeout):
+        if newer_than is None:
+            newer_than = time.time() - self.fresh_seconds
+        try:
+            with file_lock(self._path(key), timeout=lock_timeout):
+                mtime, catalog = self._read_disk(key)
+                if catalog is None or catalog.get("fetched_at", 0) < newer_than:
+                    fetched_at = time.time()
+                    catalog = self.loader(key, catalog)
+                    catalog["version"] = CATALOG_VERSION
+                    catalog.setdefault("fetched_at", fetched_at)
+                    mtime = self._write_disk(key, catalog)
+                    self._count("refreshes")
+                    logging.info(f"Refreshed catalog {os.path.basename(self._path(key))[:12]} in {time.time() - fetched_at:.2f}s")
+                self._remember(key, mtime, catalog)
+            future.set_result(catalog)
+        except TimeoutError:
+            # Another process is refreshing this catalog; use whatever copy we have
+            future.set_result(self._current(key))
+        except Exception as e:
+            self._count("refresh_failures")
+            logging.error(f"Cache Issue - Catalog refresh failed: {str(e)}", exc_info=True)
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+
+    def _ensure_scheduler(self):
+        if not self.refresh_interval or (self._scheduler is not None and self._scheduler.is_alive()):
+            return
+        with self._lock:
+            if self._scheduler is None or not self._scheduler.is_alive():
+                self._scheduler = threading.Thread(target=self._schedule, name="catalog-scheduler", daemon=True)
+                self._scheduler.start()
+
+    def _schedule(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                now = time.time()
+                with self._lock:
+                    # Forget stores nobody has asked for within the stale limit
+                    for key in [key for key, accessed in self._accessed.items() if now - accessed > self.max_stale_seconds]:
+                        del self._accessed[key]
+                    keys = list(self._accessed)
+                for key in keys:
+                    catalog = self._current(key)
+                    if catalog is None or self._age(catalog) > self.fresh_seconds:
+                        self.refresh(key)
+            except Exception as e:
+                logging.error(f"Cache Issue - Catalog scheduler error: {str(e)}", exc_info=True)
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, catalogs=len(self._memory), refreshing=len(self._inflight))
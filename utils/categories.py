@@ -1,5 +1,5 @@
 import logging
-from utils.config import load_config
+from utils.config import get_config
 
 # Placeholder AmazonApi class (assuming it’s defined elsewhere or stubbed)
 class AmazonApi:
@@ -14,7 +14,7 @@ class AmazonApi:
         return []  # Stub for demo
 
 def get_all_categories(parent_id=None):
-    config = load_config()
+    config = get_config()
     if parent_id and all(config.get("amazon_uk", {}).values()):
         try:
             amazon = AmazonApi(
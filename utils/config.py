@@ -1,40 +1,143 @@
 import json
 import os
 import logging
+import threading
+from types import MappingProxyType
+from utils.storage import read_json, atomic_write_json
 
 CONFIG_FILE = "config.json"
 
-def load_config():
+# Presentation fields stripped from the 'fields' of each setting in the per-type views
+SETTING_META_FIELDS = ['_comment', '_description', 'setting_type', 'icon', 'doc_link']
+
+_config_lock = threading.Lock()
+_cached_config = None  # (file signature, frozen config, frozen views by setting_type); signature None for defaults
+_STALE = object()  # Signature of a cached config that must be re-read
+
+def _default_config():
+    return {"log_level": "DEBUG", "jwt": {"SECRET_KEY": "your-secret-key"}, "session": {"SECRET_KEY": "your-session-secret-key"}}
+
+def _redacted(config):
+    # Copy the jwt section too so redaction never leaks into the returned or saved config
+    log_config = dict(config)
+    if "jwt" in log_config and "SECRET_KEY" in log_config["jwt"]:
+        log_config["jwt"] = {**log_config["jwt"], "SECRET_KEY": "[REDACTED]"}
+    return log_config
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def thaw(value):
+    """
+    Converts a frozen config snapshot or view back into plain dicts and lists,
+    e.g. before passing it to jsonify or mutating it.
+    """
+    if isinstance(value, (dict, MappingProxyType)):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(v) for v in value]
+    return value
+
+def _file_signature():
+    try:
+        stat = os.stat(CONFIG_FILE)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def _read_config():
+    """Returns the parsed config file, or None if it is missing or can't be read."""
     try:
         if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r') as f:
-                config = json.load(f)
-                # Redact sensitive data in logs
-                log_config = config.copy()
-                if "jwt" in log_config and "SECRET_KEY" in log_config["jwt"]:
-                    log_config["jwt"]["SECRET_KEY"] = "[REDACTED]"
-                logging.debug(f"Loaded config: {json.dumps(log_config)}")
-                return config
+            config = read_json(CONFIG_FILE)
+            # Redact sensitive data in logs
+            logging.debug(f"Loaded config: {json.dumps(_redacted(config))}")
+            return config
         else:
             logging.warning("UX Issue - Config file not found, using defaults")
-            default_config = {"log_level": "DEBUG", "jwt": {"SECRET_KEY": "your-secret-key"}}
-            return default_config
+            return None
     except json.JSONDecodeError as e:
         logging.error(f"Security Issue - Invalid config file format: {str(e)}", exc_info=True)
-        return {"log_level": "DEBUG", "jwt": {"SECRET_KEY": "your-secret-key"}}
+        return None
     except Exception as e:
         logging.error(f"UX Issue - Failed to load config: {str(e)}", exc_info=True)
-        return {"log_level": "DEBUG", "jwt": {"SECRET_KEY": "your-secret-key"}}
+        return None
+
+def _build_views(config):
+    views = {}
+    for key, value in config.items():
+        if not isinstance(value, dict) or not value.get('setting_type'):
+            continue
+        views.setdefault(value['setting_type'], []).append({
+            'key_type': key,
+            'fields': {k: v for k, v in value.items() if k not in SETTING_META_FIELDS},
+            'icon': value.get('icon', 'icon-favicon'),
+            'doc_link': value.get('doc_link', ''),
+            'comment': value.get('_comment', ''),
+            'description': value.get('_description', '')
+        })
+    return {setting_type: _freeze(settings) for setting_type, settings in views.items()}
+
+def _current_config():
+    global _cached_config
+    signature = _file_signature()
+    cached = _cached_config
+    if cached is not None and cached[0] == signature:
+        return cached
+    with _config_lock:
+        if _cached_config is not None and _cached_config[0] == signature:
+            return _cached_config
+        config = _read_config()
+        if config is None:
+            # A failed load is never cached, so it is retried on the next call; until then the
+            # last good config is served, and the defaults only if the file was never read
+            if _cached_config is not None and _cached_config[0] is not None:
+                logging.warning("UX Issue - Serving the last good config until config.json can be read")
+                return _cached_config
+            config = _default_config()
+            defaults = (signature, _freeze(config), _build_views(config))
+            if signature is None:
+                _cached_config = defaults  # No config file yet: the defaults stand until one appears
+            return defaults
+        _cached_config = (signature, _freeze(config), _build_views(config))
+        return _cached_config
+
+def get_config():
+    """
+    Returns a read-only snapshot of config.json, parsed once and re-read only when
+    the file changes or save_config() is called. Use load_config() for a mutable copy.
+    If the file can't be read, the last good snapshot is returned (defaults if there is none)
+    and the file is read again on the next call.
+    """
+    return _current_config()[1]
+
+def get_settings_view(setting_type):
+    """
+    Returns the read-only settings of one setting_type ('settings_key', 'affiliate_key',
+    'client_api', 'api_key', ...) as a tuple of
+    {'key_type', 'fields', 'icon', 'doc_link', 'comment', 'description'} entries.
+    """
+    return _current_config()[2].get(setting_type, ())
+
+def load_config():
+    """
+    Returns a mutable copy of the cached config, for callers that edit and save_config() it.
+    """
+    return thaw(get_config())
 
 def save_config(config):
+    global _cached_config
     try:
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=4)
+        atomic_write_json(CONFIG_FILE, config)
+        with _config_lock:
+            if _cached_config is not None:
+                _cached_config = (_STALE,) + _cached_config[1:]
         # Redact sensitive data in logs
-        log_config = config.copy()
-        if "jwt" in log_config and "SECRET_KEY" in log_config["jwt"]:
-            log_config["jwt"]["SECRET_KEY"] = "[REDACTED]"
-        logging.debug(f"Saved config: {json.dumps(log_config)}")
+        logging.debug(f"Saved config: {json.dumps(_redacted(config))}")
     except Exception as e:
         logging.error(f"UX Issue - Failed to save config: {str(e)}", exc_info=True)
-        raise  # Re-raise to alert calling code
\ No newline at end of file
+        raise  # Re-raise to alert calling code
@@ -1,6 +1,7 @@
 import os
 import json
 import logging
+from utils.storage import read_json, atomic_write_json
 
 SITE_REQUEST_DIR = "siterequest"
 
@@ -8,10 +9,9 @@ def load_site_request(user_id):
     file_path = os.path.join(SITE_REQUEST_DIR, user_id)
     try:
         if os.path.exists(file_path):
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                logging.debug(f"Loaded site request for user {user_id}: {json.dumps(data)}")
-                return data
+            data = read_json(file_path)
+            logging.debug(f"Loaded site request for user {user_id}: {json.dumps(data)}")
+            return data
         else:
             logging.warning(f"UX Issue - No site request found for user {user_id}")
             return {}
@@ -28,8 +28,7 @@ def save_site_request(user_id, site_request_data):
             os.makedirs(SITE_REQUEST_DIR)
             logging.debug(f"Created site request directory: {SITE_REQUEST_DIR}")
         file_path = os.path.join(SITE_REQUEST_DIR, user_id)
-        with open(file_path, 'w') as f:
-            json.dump(site_request_data, f, indent=4)
+        atomic_write_json(file_path, site_request_data)
         logging.debug(f"Saved site request for user {user_id}: {json.dumps(site_request_data)}")
     except Exception as e:
         logging.error(f"UX Issue - Failed to save site request for user {user_id}: {str(e)}", exc_info=True)
@@ -0,0 +1,190 @@
+# utils/deals.py
+import json
+import time
+import base64
+import logging
+import threading
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from utils.users import get_users_by_role
+from utils.wix import get_catalog, iter_catalog_products, normalize_products
+
+ALL_CATEGORIES = "*"
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+SWEEP_INTERVAL = 60  # Seconds between checks of merchants' cached catalogs for changes
+INITIAL_BUILD_WAIT = 10.0  # How long the first query waits for the index to be built
+
+def category_key(name):
+    return (name or "").strip().casefold()
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Returns the sort key encoded in a cursor. Raises ValueError if it isn't one."""
+    try:
+        discount, merchant_id, product_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return (float(discount), str(merchant_id), str(product_id))
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+class DealsIndex:
+    """
+    Discounted products from every merchant, kept per category in lists sorted by discount (highest first).
+    Entries are keyed (-discount_percent, merchant_id, product_id), so a minimum-discount threshold is one
+    binary search and a cursor is simply the last key returned: pages stay consistent while deals change.
+    Merchants are updated independently; only keys that appeared, vanished or changed discount are moved.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = {}  # category -> sorted list of keys
+        self._deals = {}  # key -> deal record
+        self._merchant_keys = {}  # merchant_id -> {key: category set}
+        self._versions = {}  # merchant_id -> version of the catalog indexed
+
+    def version(self, merchant_id):
+        return self._versions.get(merchant_id)
+
+    def _insert(self, category, key):
+        insort(self._keys.setdefault(category, []), key)
+
+    def _remove(self, category, key):
+        keys = self._keys.get(category, [])
+        position = bisect_left(keys, key)
+        if position < len(keys) and keys[position] == key:
+            del keys[position]
+            if not keys:
+                del self._keys[category]
+
+    def update_merchant(self, merchant_id, deals, version=None):
+        """Replaces a merchant's deals with the given records (each needs "id", "discount_percent" and "category")."""
+        entries = {}
+        for deal in deals:
+            key = (-deal["discount_percent"], merchant_id, deal["id"])
+            categories = entries.setdefault(key, ({ALL_CATEGORIES}, deal))[0]
+            categories.add(category_key(deal["category"]))
+        with self._lock:
+            previous = self._merchant_keys.get(merchant_id, {})
+            for key, categories in previous.items():
+                for category in categories - (entries[key][0] if key in entries else set()):
+                    self._remove(category, key)
+                if key not in entries:
+                    self._deals.pop(key, None)
+            for key, (categories, deal) in entries.items():
+                for category in categories - previous.get(key, set()):
+                    self._insert(category, key)
+                self._deals[key] = deal
+            self._merchant_keys[merchant_id] = {key: categories for key, (categories, _) in entries.items()}
+            self._versions[merchant_id] = version
+
+    def remove_merchant(self, merchant_id):
+        self.update_merchant(merchant_id, [])
+        with self._lock:
+            self._merchant_keys.pop(merchant_id, None)
+            self._versions.pop(merchant_id, None)
+
+    def merchants(self):
+        with self._lock:
+            return set(self._merchant_keys)
+
+    def query(self, category=None, min_discount=0.0, limit=DEFAULT_PAGE_SIZE, cursor=None):
+        """
+        Returns (deals, next_cursor) for one category (None for every category), best discount first,
+        keeping only deals with discount_percent >= min_discount. next_cursor is None on the last page.
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        with self._lock:
+            keys = self._keys.get(category_key(category) if category else ALL_CATEGORIES, [])
+            # Keys sort by -discount, so every deal at or above the threshold precedes this position
+            end = bisect_right(keys, (-float(min_discount), chr(0x10FFFF), chr(0x10FFFF)))
+            start = bisect_right(keys, decode_cursor(cursor)) if cursor else 0
+            page = keys[start:min(end, start + limit)]
+            deals = [dict(self._deals[key]) for key in page]
+        next_cursor = encode_cursor(page[-1]) if page and start + len(page) < end else None
+        return deals, next_cursor
+
+    def stats(self):
+        with self._lock:
+            return {
+                "merchants": len(self._merchant_keys),
+                "deals": len(self._deals),
+                "categories": len(self._keys) - (1 if ALL_CATEGORIES in self._keys else 0)
+            }
+
+deals_index = DealsIndex()
+_sweep_lock = threading.Lock()
+_sweep = None  # Future for the running or last sweep
+_last_sweep = 0.0
+
+def _merchant_client_ids():
+    merchants = {}
+    for user_id, user in get_users_by_role("merchant").items():
+        client_id = (user or {}).get("settings", {}).get("api_key", {}).get("wixStore", {}).get("API_TOKEN")
+        if client_id:
+            merchants[user_id] = client_id
+    return merchants
+
+def sync_deals_index():
+    """
+    Brings the index in line with merchants' cached catalogs. Catalogs are read through the catalog cache
+    (so stale ones are refreshed in the background) and only merchants whose catalog changed are re-indexed.
+    """
+    merchants = _merchant_client_ids()
+    for merchant_id in deals_index.merchants() - set(merchants):
+        deals_index.remove_merchant(merchant_id)
+    updated = 0
+    for merchant_id, client_id in merchants.items():
+        try:
+            catalog = get_catalog(client_id)
+        except Exception as e:
+            logging.warning(f"UX Issue - No catalog for merchant {merchant_id}, keeping indexed deals: {str(e)}")
+            continue
+        if deals_index.version(merchant_id) == catalog.get("fetched_at"):
+            continue
+        records = normalize_products(iter_catalog_products(catalog), merchant_id)
+        deals_index.update_merchant(merchant_id, [record for record in records if record["discount_percent"] > 0], catalog.get("fetched_at"))
+        updated += 1
+    if updated:
+        logging.info(f"Deals index updated for {updated} merchants: {deals_index.stats()}")
+
+def _run_sweep(future):
+    global _last_sweep
+    try:
+        sync_deals_index()
+        _last_sweep = time.monotonic()
+        future.set_result(True)
+    except Exception as e:
+        logging.error(f"UX Issue - Deals index sync failed: {str(e)}", exc_info=True)
+        _last_sweep = time.monotonic()
+        future.set_exception(e)
+
+def _ensure_fresh():
+    """Starts a background sync when the last one is older than SWEEP_INTERVAL; returns its Future."""
+    global _sweep
+    with _sweep_lock:
+        if _sweep is not None and (not _sweep.done() or time.monotonic() - _last_sweep < SWEEP_INTERVAL):
+            return _sweep
+        _sweep = Future()
+        threading.Thread(target=_run_sweep, args=(_sweep,), name="deals-sync", daemon=True).start()
+        return _sweep
+
+def query_deals(category=None, min_discount=0.0, limit=DEFAULT_PAGE_SIZE, cursor=None):
+    """
+    Reads a page of deals from the index (see DealsIndex.query). Syncs with merchants' catalogs in the
+    background; only the very first query waits, briefly, for the index to be built.
+    """
+    first = _sweep is None
+    sweep = _ensure_fresh()
+    if first:
+        try:
+            sweep.result(timeout=INITIAL_BUILD_WAIT)
+        except FutureTimeoutError:
+            logging.warning("UX Issue - Deals index still building, serving partial results")
+        except Exception:
+            pass  # Already logged by the sweep
+    return deals_index.query(category, min_discount, limit, cursor)
+
+def deals_index_stats():
+    return deals_index.stats()
@@ -0,0 +1,114 @@
+# utils/dedup.py
+import time
+import uuid
+import hashlib
+import threading
+from utils.config import get_config
+
+# Defaults, overridable through the "dedup" entry in config.json
+DEFAULT_WINDOW_SECONDS = 600
+DEFAULT_MAX_KEYS = 50000
+DEFAULT_BUCKET_SECONDS = 60
+
+# Namespace for the event uuids derived from idempotency keys
+EVENT_UUID_NAMESPACE = uuid.UUID("6f1c5d2e-8a43-4b7e-9c1d-3e2f4a5b6c7d")
+
+class DedupWindow:
+    """
+    Remembers recently seen keys for between window_seconds and twice that, in bounded memory.
+    Keys are kept as 64-bit digests in two generations of sets: when the current generation is
+    window_seconds old or holds max_keys digests, it becomes the previous one and the old
+    previous generation is dropped. A full generation rotates early, so under a flood of
+    distinct keys the window shrinks rather than memory growing.
+    """
+
+    def __init__(self, window_seconds=DEFAULT_WINDOW_SECONDS, max_keys=DEFAULT_MAX_KEYS):
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._current = set()
+        self._previous = set()
+        self._rotated_at = time.monotonic()
+        self._stats = {"added": 0, "duplicates": 0, "rotations": 0}
+
+    @staticmethod
+    def _digest(key):
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def _rotate_if_due(self):
+        now = time.monotonic()
+        if now - self._rotated_at >= self.window_seconds or len(self._current) >= self.max_keys:
+            self._previous = self._current
+            self._current = set()
+            self._rotated_at = now
+            self._stats["rotations"] += 1
+
+    def add(self, key):
+        """Records key and returns True, or returns False if it was already seen within the window."""
+        digest = self._digest(key)
+        with self._lock:
+            self._rotate_if_due()
+            if digest in self._current or digest in self._previous:
+                self._stats["duplicates"] += 1
+                return False
+            self._current.add(digest)
+            self._stats["added"] += 1
+            return True
+
+    def discard(self, key):
+        """Forgets key, e.g. when the request that added it failed and a retry should go through."""
+        digest = self._digest(key)
+        with self._lock:
+            self._current.discard(digest)
+            self._previous.discard(digest)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._current) + len(self._previous))
+
+def _settings():
+    dedup = get_config().get("dedup", {})
+    return {
+        "window_seconds": float(dedup.get("window_seconds", DEFAULT_WINDOW_SECONDS)),
+        "max_keys": int(dedup.get("max_keys", DEFAULT_MAX_KEYS)),
+        "bucket_seconds": int(dedup.get("bucket_seconds", DEFAULT_BUCKET_SECONDS))
+    }
+
+_event_window = None
+_event_window_lock = threading.Lock()
+
+def _get_event_window():
+    global _event_window
+    if _event_window is None:
+        with _event_window_lock:
+            if _event_window is None:
+                settings = _settings()
+                _event_window = DedupWindow(settings["window_seconds"], settings["max_keys"])
+    return _event_window
+
+def event_idempotency_key(event_type, properties, idempotency_key=None):
+    """
+    Returns the dedup key for a click/order event. A client-supplied idempotency_key is scoped
+    to the source user; without one, the key is derived from source, destination, sale_value
+    and the current time bucket (bucket_seconds), so rapid repeats of the same event collapse.
+    """
+    source_user_id = properties.get("source_user_id")
+    if idempotency_key:
+        return f"key:{source_user_id}:{idempotency_key}"
+    bucket = int(time.time() // _settings()["bucket_seconds"])
+    return f"{event_type}:{source_user_id}:{properties.get('destination_user_id')}:{properties.get('sale_value')}:{bucket}"
+
+def event_uuid_for(key):
+    """Returns the stable event uuid for a dedup key, so every worker stores and sends the same uuid."""
+    return str(uuid.uuid5(EVENT_UUID_NAMESPACE, key))
+
+def claim_event(key):
+    """Returns True if the event with this dedup key hasn't been seen within the window, recording it."""
+    return _get_event_window().add(key)
+
+def release_event(key):
+    """Un-claims a key whose event couldn't be processed, so a retry isn't dropped as a duplicate."""
+    _get_event_window().discard(key)
+
+def event_dedup_stats():
+    return _get_event_window().stats()
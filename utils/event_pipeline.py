@@ -0,0 +1,211 @@
+# utils/event_pipeline.py
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from utils.storage import file_lock
+from utils.outbound import outbound
+
+DEFAULT_MAX_QUEUE = 10000
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 2.0
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_SPOOL_DIR = "event_spool"
+MAX_BACKOFF = 300.0
+SPOOL_DRAIN_FILES = 20
+
+class EventPipeline:
+    """
+    Captures analytics events without touching the network on the request thread.
+    capture() puts the event on a bounded in-memory queue. A background flusher sends events
+    to PostHog's /batch/ endpoint when batch_size events are waiting or flush_interval
+    seconds have passed, whichever comes first.
+    When the queue is full, or PostHog is unreachable, events go to an on-disk spool
+    (one JSON-lines file per batch) that is drained oldest-first once sends succeed again,
+    including after a restart.
+    """
+
+    def __init__(self, api_key, host, spool_dir=DEFAULT_SPOOL_DIR, max_queue=DEFAULT_MAX_QUEUE,
+                 batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL, timeout=DEFAULT_TIMEOUT):
+        self.api_key = api_key
+        self.batch_url = f"{host.rstrip('/')}/batch/"
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._failures = 0
+        self._retry_at = 0.0
+        self._stats = {"captured": 0, "sent": 0, "spooled": 0, "dropped": 0, "send_failures": 0}
+        atexit.register(self.shutdown)
+
+    def _ensure_started(self):
+        # Start (or restart after a fork) the flusher in the current process
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="event-pipeline", daemon=True)
+            self._thread.start()
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def capture(self, distinct_id, event, properties=None, timestamp=None, event_uuid=None):
+        """
+        Queues an event for delivery and returns immediately. Pass event_uuid to let PostHog
+        recognise retries of the same event.
+        Returns False only if the event could be neither queued nor spooled.
+        """
+        message = {
+            "event": event,
+            "distinct_id": distinct_id,
+            "properties": dict(properties or {}),
+            "timestamp": timestamp or datetime.now(timezone.utc).isoformat(),
+            "uuid": event_uuid or str(uuid.uuid4())
+        }
+        self._count("captured")
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(message)
+            return True
+        except queue.Full:
+            logging.warning(f"PostHog Issue - Event queue full, spooling {event} event to disk")
+            return self._spool([message])
+
+    def _spool(self, batch):
+        """Writes a batch to a new spool file; the rename makes it visible to drainers only when complete."""
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.jsonl"
+            temp_path = os.path.join(self.spool_dir, f".{name}.tmp")
+            with open(temp_path, 'w') as f:
+                for message in batch:
+                    f.write(json.dumps(message) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, os.path.join(self.spool_dir, name))
+            self._count("spooled", len(batch))
+            return True
+        except Exception as e:
+            logging.error(f"PostHog Issue - Failed to spool {len(batch)} events, dropping them: {str(e)}", exc_info=True)
+            self._count("dropped", len(batch))
+            return False
+
+    def _send(self, batch):
+        """Posts a batch to PostHog. Returns True on success and manages the retry backoff."""
+        try:
+            response = outbound("posthog").request("POST", self.batch_url, json={"api_key": self.api_key, "batch": batch}, timeout=self.timeout)
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                # PostHog rejected the payload itself; retrying would never succeed
+                logging.error(f"PostHog Issue - Batch of {len(batch)} events rejected ({response.status_code}): {response.text[:200]}")
+                self._count("dropped", len(batch))
+                return True
+            response.raise_for_status()
+            self._failures = 0
+            self._retry_at = 0.0
+            self._count("sent", len(batch))
+            return True
+        except Exception as e:
+            self._failures += 1
+            backoff = min(MAX_BACKOFF, 2 ** self._failures)
+            self._retry_at = time.monotonic() + backoff
+            self._count("send_failures")
+            logging.warning(f"PostHog Issue - Batch send failed ({str(e)}), retrying in {backoff:.0f}s")
+            return False
+
+    def _deliver(self, batch):
+        if not batch:
+            return
+        if time.monotonic() < self._retry_at or not self._send(batch):
+            self._spool(batch)
+
+    def _spool_files(self):
+        try:
+            return sorted(name for name in os.listdir(self.spool_dir) if name.endswith(".jsonl"))
+        except FileNotFoundError:
+            return []
+
+    def _drain_spool(self):
+        """Resends spooled batches oldest-first. Only one process drains the spool at a time."""
+        if time.monotonic() < self._retry_at or not self._spool_files():
+            return
+        try:
+            with file_lock(os.path.join(self.spool_dir, "drain"), timeout=0):
+                for name in self._spool_files()[:SPOOL_DRAIN_FILES]:
+                    path = os.path.join(self.spool_dir, name)
+                    try:
+                        with open(path, 'r') as f:
+                            batch = [json.loads(line) for line in f if line.strip()]
+                    except (OSError, json.JSONDecodeError) as e:
+                        logging.error(f"PostHog Issue - Discarding unreadable spool file {name}: {str(e)}")
+                        os.replace(path, path + ".bad")
+                        continue
+                    if batch and not self._send(batch):
+                        break
+                    os.remove(path)
+        except TimeoutError:
+            pass
+
+    def _next_batch(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        self._drain_spool()
+        while not self._stopping.is_set():
+            try:
+                self._deliver(self._next_batch())
+                self._drain_spool()
+            except Exception as e:
+                logging.error(f"PostHog Issue - Event pipeline error: {str(e)}", exc_info=True)
+
+    def _pending(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def flush(self):
+        """Sends everything queued in memory now, spooling it if the send fails."""
+        pending = self._pending()
+        for start in range(0, len(pending), self.batch_size):
+            self._deliver(pending[start:start + self.batch_size])
+
+    def shutdown(self):
+        """Stops the flusher and spools whatever is still in memory so nothing is lost on exit."""
+        self._stopping.set()
+        pending = self._pending()
+        if pending:
+            self._spool(pending)
+
+    def stats(self):
+        """Returns counters plus the current queue depth and spool backlog."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["spool_files"] = len(self._spool_files())
+        return stats
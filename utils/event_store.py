@@ -0,0 +1,379 @@
+# utils/event_store.py
+import json
+import uuid
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from utils.users import get_user_fields, get_referral_chain
+
+EVENTS_DB_FILE = "events.db"
+QUERY_CHUNK_SIZE = 500
+
+# Events rolled up per user, counterparty and time bucket as they are recorded
+ROLLUP_EVENTS = ("click", "order")
+ROLLUP_ROLES = ("source", "destination", "referrer")
+BUCKET_FORMATS = {"hour": "%Y-%m-%dT%H", "day": "%Y-%m-%d", "month": "%Y-%m"}
+# Bumped when rollups gain rows, so existing stores rebuild them from their events
+ROLLUPS_VERSION = "2"
+
+class EventStore:
+    """
+    Local copy of analytics events (click, order, login, signup), persisted in SQLite (WAL mode).
+    Handlers write here directly as events happen, so period queries for the event routes
+    never leave the process. Filterable properties (source/destination user, their referrers,
+    sale_value) are stored as indexed columns; the full property dict is kept alongside as JSON.
+    Clicks and orders also update rollups in the same transaction: counts and sale_value sums per
+    user, role (source, destination or referrer), counterparty and hour/day/month bucket, so
+    dashboard totals are read from a few buckets instead of scanning events. Every referrer up the
+    chain (to MAX_REFERRAL_DEPTH levels) also gets "upline" rows keyed by its nearest level to the
+    event, from which per-level commission is read.
+    Timestamps are stored as fixed-width UTC ISO strings so range queries compare as text.
+    The store records when it started collecting (coverage_start); earlier periods still
+    have to come from PostHog.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._initialized = False
+        self._coverage_start = None
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _initialize(self):
+        with self._lock:
+            if self._initialized:
+                return
+            conn = self._connection()
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, uuid TEXT, event TEXT NOT NULL, distinct_id TEXT, "
+                "timestamp TEXT NOT NULL, source_user_id TEXT, destination_user_id TEXT, "
+                "source_referrer TEXT, destination_referrer TEXT, sale_value REAL, properties TEXT NOT NULL)"
+            )
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS events_uuid ON events (uuid)")
+            conn.execute("CREATE INDEX IF NOT EXISTS events_event_time ON events (event, timestamp)")
+            conn.execute("CREATE INDEX IF NOT EXISTS events_source ON events (source_user_id, event, timestamp)")
+            conn.execute("CREATE INDEX IF NOT EXISTS events_destination ON events (destination_user_id, event, timestamp)")
+            conn.execute("CREATE INDEX IF NOT EXISTS events_source_referrer ON events (source_referrer, event, timestamp)")
+            conn.execute("CREATE INDEX IF NOT EXISTS events_destination_referrer ON events (destination_referrer, event, timestamp)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rollups ("
+                "user_id TEXT NOT NULL, role TEXT NOT NULL, counterparty_id TEXT NOT NULL, event TEXT NOT NULL, "
+                "granularity TEXT NOT NULL, bucket TEXT NOT NULL, count INTEGER NOT NULL, sale_value REAL NOT NULL, "
+                "PRIMARY KEY (user_id, role, event, granularity, counterparty_id, bucket))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('coverage_start', ?)", (normalize_timestamp(None),))
+            self._coverage_start = conn.execute("SELECT value FROM meta WHERE key = 'coverage_start'").fetchone()[0]
+            if conn.execute("SELECT value FROM meta WHERE key = 'rollups_version'").fetchone() != (ROLLUPS_VERSION,):
+                self._rebuild_rollups(conn)
+            self._initialized = True
+
+    def _rollup_keys(self, source_user_id, destination_user_id, source_referrer, destination_referrer, upline=None):
+        """
+        Returns the (user_id, role, counterparty_id) keys an event counts towards; '' is the all-counterparties total.
+        upline ({referrer_id: level}) adds an "upline" key per referrer, with the level as its counterparty.
+        """
+        keys = []
+        if source_user_id:
+            keys += [(source_user_id, "source", destination_user_id or ""), (source_user_id, "source", "")]
+        if destination_user_id:
+            keys += [(destination_user_id, "destination", source_user_id or ""), (destination_user_id, "destination", "")]
+        for referrer, referee in ((source_referrer, source_user_id), (destination_referrer, destination_user_id)):
+            if referrer:
+                keys += [(referrer, "referrer", referee), (referrer, "referrer", "")]
+        keys += [(referrer, "upline", str(level)) for referrer, level in (upline or {}).items()]
+        # Dedupe so a counterparty that is also the total row (or a referrer of both sides) isn't counted twice
+        return list(dict.fromkeys(keys))
+
+    def _apply_rollups(self, conn, event, timestamp, sale_value, *parties, upline=None):
+        if event not in ROLLUP_EVENTS:
+            return
+        moment = datetime.fromisoformat(timestamp)
+        rows = []
+        for user_id, role, counterparty_id in self._rollup_keys(*parties, upline=upline):
+            for granularity, bucket_format in BUCKET_FORMATS.items():
+                rows.append((user_id, role, counterparty_id, event, granularity, moment.strftime(bucket_format), sale_value or 0.0))
+        conn.executemany(
+            "INSERT INTO rollups (user_id, role, counterparty_id, event, granularity, bucket, count, sale_value) "
+            "VALUES (?, ?, ?, ?, ?, ?, 1, ?) "
+            "ON CONFLICT (user_id, role, event, granularity, counterparty_id, bucket) "
+            "DO UPDATE SET count = count + 1, sale_value = sale_value + excluded.sale_value",
+            rows
+        )
+
+    def _rebuild_rollups(self, conn):
+        """
+        Recomputes every rollup from the events table, e.g. the first time an existing store is opened.
+        Upline rows follow the referral chains as they are now; events only record the direct referrers.
+        """
+        chains = {}
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM rollups")
+            events = conn.execute(
+                "SELECT event, timestamp, sale_value, source_user_id, destination_user_id, source_referrer, destination_referrer "
+                f"FROM events WHERE event IN ({', '.join('?' for _ in ROLLUP_EVENTS)})",
+                ROLLUP_EVENTS
+            ).fetchall()
+            for event, timestamp, sale_value, *parties in events:
+                for user_id in parties[:2]:
+                    if user_id and user_id not in chains:
+                        chains[user_id] = get_referral_chain(user_id)
+                upline = nearest_levels(chains.get(parties[0]), chains.get(parties[1]))
+                self._apply_rollups(conn, event, timestamp, sale_value, *parties, upline=upline)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rollups_built', ?)", (normalize_timestamp(None),))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rollups_version', ?)", (ROLLUPS_VERSION,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        logging.info(f"Built referral rollups from {len(events)} events")
+
+    def coverage_start(self):
+        """Returns the UTC ISO timestamp from which this store holds every event."""
+        if not self._initialized:
+            self._initialize()
+        return self._coverage_start
+
+    def record(self, event, distinct_id, properties=None, timestamp=None, event_uuid=None):
+        """Stores one event and returns its uuid, or None if an event with that uuid is already stored."""
+        return self.record_many([(event, distinct_id, properties, timestamp, event_uuid)])[0]
+
+    def record_many(self, events):
+        """
+        Stores (event, distinct_id, properties, timestamp, event_uuid) tuples in one transaction,
+        with their rollups, and returns their uuids. Referrers and referral chains are looked up once per distinct user.
+        Events whose uuid is already stored (e.g. a retry deduplicated by another worker) are skipped
+        and None is returned in their place.
+        """
+        if not self._initialized:
+            self._initialize()
+        rows = []
+        user_ids = set()
+        for event, distinct_id, properties, timestamp, event_uuid in events:
+            properties = dict(properties or {})
+            user_ids.update(uid for uid in (properties.get("source_user_id"), properties.get("destination_user_id")) if uid)
+            rows.append((event, distinct_id, properties, normalize_timestamp(timestamp), event_uuid or str(uuid.uuid4())))
+        referrers = {uid: fields.get("referrer") for uid, fields in get_user_fields(user_ids, ("referrer",)).items()}
+        chains = {uid: get_referral_chain(uid) for uid in user_ids}
+
+        stored = []
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for event, distinct_id, properties, timestamp, event_uuid in rows:
+                source_user_id = properties.get("source_user_id")
+                destination_user_id = properties.get("destination_user_id")
+                source_referrer = referrers.get(source_user_id)
+                destination_referrer = referrers.get(destination_user_id)
+                sale_value = properties.get("sale_value")
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO events (uuid, event, distinct_id, timestamp, source_user_id, destination_user_id, "
+                    "source_referrer, destination_referrer, sale_value, properties) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        event_uuid,
+                        event,
+                        distinct_id,
+                        timestamp,
+                        source_user_id,
+                        destination_user_id,
+                        source_referrer,
+                        destination_referrer,
+                        sale_value,
+                        json.dumps(properties)
+                    )
+                )
+                if cursor.rowcount == 0:
+                    stored.append(None)
+                    continue
+                self._apply_rollups(
+                    conn, event, timestamp, sale_value, source_user_id, destination_user_id, source_referrer, destination_referrer,
+                    upline=nearest_levels(chains.get(source_user_id), chains.get(destination_user_id))
+                )
+                stored.append(event_uuid)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return stored
+
+    def summarize(self, user_id, role, event, start, end, granularity="day"):
+        """
+        Returns rollup totals for one user acting in role ("source", "destination" or "referrer")
+        over the buckets from start's bucket up to (not including) end's bucket:
+        {"totals": {"count", "sale_value"}, "buckets": [...], "counterparties": [...]}.
+        Raises ValueError unless start and end both fall on bucket boundaries (see period_aligned):
+        a bucket only partly inside the period can't be split, so e.g. a week can't be summed by month.
+        """
+        if role not in ROLLUP_ROLES:
+            raise ValueError(f"Invalid rollup role: {role}")
+        if granularity not in BUCKET_FORMATS:
+            raise ValueError(f"Invalid granularity: {granularity}")
+        if not period_aligned(start, end, granularity):
+            raise ValueError(f"Period {start} to {end} is not aligned to {granularity} buckets")
+        if not self._initialized:
+            self._initialize()
+        bucket_format = BUCKET_FORMATS[granularity]
+        first = datetime.fromisoformat(normalize_timestamp(start)).strftime(bucket_format)
+        last = datetime.fromisoformat(normalize_timestamp(end)).strftime(bucket_format)
+        conn = self._connection()
+        base = "FROM rollups WHERE user_id = ? AND role = ? AND event = ? AND granularity = ? AND bucket >= ? AND bucket < ?"
+        params = (user_id, role, event, granularity, first, last)
+        buckets = [
+            {"bucket": bucket, "count": count, "sale_value": round(sale_value, 2)}
+            for bucket, count, sale_value in conn.execute(
+                f"SELECT bucket, count, sale_value {base} AND counterparty_id = '' ORDER BY bucket", params
+            )
+        ]
+        counterparties = [
+            {"user_id": counterparty_id, "count": count, "sale_value": round(sale_value, 2)}
+            for counterparty_id, count, sale_value in conn.execute(
+                f"SELECT counterparty_id, SUM(count), SUM(sale_value) {base} AND counterparty_id != '' "
+                "GROUP BY counterparty_id ORDER BY SUM(count) DESC", params
+            )
+        ]
+        return {
+            "totals": {
+                "count": sum(bucket["count"] for bucket in buckets),
+                "sale_value": round(sum(bucket["sale_value"] for bucket in buckets), 2)
+            },
+            "buckets": buckets,
+            "counterparties": counterparties
+        }
+
+    def summarize_levels(self, user_id, event, start, end, granularity="day"):
+        """
+        Returns the totals of events user_id is an upline referrer of, per referral level (1 for events of
+        users they referred directly), over the same buckets as summarize: {level: {"count", "sale_value"}}.
+        Raises ValueError for the same misaligned periods as summarize.
+        """
+        if granularity not in BUCKET_FORMATS:
+            raise ValueError(f"Invalid granularity: {granularity}")
+        if not period_aligned(start, end, granularity):
+            raise ValueError(f"Period {start} to {end} is not aligned to {granularity} buckets")
+        if not self._initialized:
+            self._initialize()
+        bucket_format = BUCKET_FORMATS[granularity]
+        first = datetime.fromisoformat(normalize_timestamp(start)).strftime(bucket_format)
+        last = datetime.fromisoformat(normalize_timestamp(end)).strftime(bucket_format)
+        rows = self._connection().execute(
+            "SELECT counterparty_id, SUM(count), SUM(sale_value) FROM rollups WHERE user_id = ? AND role = 'upline' "
+            "AND event = ? AND granularity = ? AND bucket >= ? AND bucket < ? GROUP BY counterparty_id",
+            (user_id, event, granularity, first, last)
+        )
+        return {int(level): {"count": count, "sale_value": round(sale_value, 2)} for level, count, sale_value in rows}
+
+    def iter_query(self, event, start, end, source_user_id=None, destination_user_id=None, referrer=None, user_ids=None, limit=None):
+        """
+        Yields events of one type with start <= timestamp < end, newest first, shaped like
+        PostHog event results ({"uuid", "event", "distinct_id", "timestamp", "properties"}).
+        referrer matches events where either side was referred by that user when the event happened;
+        user_ids matches events where either side is in the given set (passed as one JSON parameter).
+        Rows are read from the cursor in chunks, so large periods aren't held in memory.
+        """
+        if not self._initialized:
+            self._initialize()
+        clauses = ["event = ?", "timestamp >= ?", "timestamp < ?"]
+        params = [event, normalize_timestamp(start), normalize_timestamp(end)]
+        if source_user_id:
+            clauses.append("source_user_id = ?")
+            params.append(source_user_id)
+        if destination_user_id:
+            clauses.append("destination_user_id = ?")
+            params.append(destination_user_id)
+        if referrer:
+            clauses.append("(source_referrer = ? OR destination_referrer = ?)")
+            params.extend([referrer, referrer])
+        if user_ids is not None:
+            clauses.append(
+                "(source_user_id IN (SELECT value FROM json_each(?)) OR destination_user_id IN (SELECT value FROM json_each(?)))"
+            )
+            user_ids_json = json.dumps(list(user_ids))
+            params.extend([user_ids_json, user_ids_json])
+        sql = f"SELECT uuid, event, distinct_id, timestamp, properties FROM events WHERE {' AND '.join(clauses)} ORDER BY timestamp DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        cursor = self._connection().execute(sql, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(QUERY_CHUNK_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield {"uuid": row[0], "event": row[1], "distinct_id": row[2], "timestamp": row[3], "properties": json.loads(row[4])}
+        finally:
+            cursor.close()
+
+    def query(self, event, start, end, **filters):
+        """Returns iter_query() results as a list."""
+        return list(self.iter_query(event, start, end, **filters))
+
+def normalize_timestamp(value):
+    """
+    Converts a datetime or ISO string (naive values are taken as UTC) to the store's
+    fixed-width form, e.g. 2025-05-09T13:45:00.000000+00:00. None means now.
+    """
+    if value is None:
+        value = datetime.now(timezone.utc)
+    elif isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).isoformat(timespec="microseconds")
+
+def nearest_levels(*chains):
+    """
+    Merges referral chains ((referrer_id, level), ...) into {referrer_id: level}, keeping each
+    referrer's nearest level, as for an event between users whose chains are given.
+    """
+    levels = {}
+    for chain in chains:
+        for referrer_id, level in chain or ():
+            levels[referrer_id] = min(level, levels.get(referrer_id, level))
+    return levels
+
+def period_aligned(start, end, granularity):
+    """Whether start and end both fall exactly on the start of a bucket of the given granularity."""
+    bucket_format = BUCKET_FORMATS[granularity]
+    for value in (start, end):
+        moment = datetime.fromisoformat(normalize_timestamp(value))
+        if datetime.strptime(moment.strftime(bucket_format), bucket_format).replace(tzinfo=moment.tzinfo) != moment:
+            return False
+    return True
+
+event_store = EventStore(EVENTS_DB_FILE)
+
+def record_events(events):
+    """
+    Stores a batch of (event, distinct_id, properties, timestamp, event_uuid) tuples in one transaction.
+    Returns their uuids (None for events already stored), or None if the batch couldn't be stored
+    (the failure is logged).
+    """
+    try:
+        return event_store.record_many(events)
+    except Exception as e:
+        logging.error(f"UX Issue - Failed to store {len(events)} events locally: {str(e)}", exc_info=True)
+        return None
+
+def record_event(event, distinct_id, properties=None, timestamp=None, event_uuid=None):
+    """
+    Stores an event locally. Failures are logged rather than raised so analytics
+    can never fail the request that produced the event.
+    """
+    try:
+        return event_store.record(event, distinct_id, properties, timestamp, event_uuid)
+    except Exception as e:
+        logging.error(f"UX Issue - Failed to store {event} event locally: {str(e)}", exc_info=True)
+        return None
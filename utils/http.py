@@ -0,0 +1,81 @@
+# utils/http.py
+import random
+import threading
+import importlib.util
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils.config import get_config
+
+# brotli is optional and lets urllib3 decode br responses; gzip and deflate are always decoded
+ACCEPT_ENCODING = "gzip, deflate, br" if importlib.util.find_spec("brotli") else "gzip, deflate"
+
+# Defaults, overridable through the "http" entry in config.json
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 15.0
+DEFAULT_POOL_HOSTS = 16  # Hosts whose connection pools are kept open
+DEFAULT_POOL_SIZE = 16  # Keep-alive connections per host
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+USER_AGENT = "clubmadeira.io"
+
+class JitteredRetry(Retry):
+    """Retry whose exponential backoff is randomized ("full jitter"), so workers retrying together spread out."""
+
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default (connect, read) timeout to requests made without one."""
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def _build_session(retry_posts, retries):
+    settings = get_config().get("http", {})
+    methods = Retry.DEFAULT_ALLOWED_METHODS | ({"POST"} if retry_posts else set())
+    retry = JitteredRetry(
+        total=retries,
+        backoff_factor=float(settings.get("backoff", DEFAULT_BACKOFF)),
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=methods,
+        respect_retry_after_header=True,
+        raise_on_status=False  # Hand the last response back to the caller instead of raising
+    )
+    adapter = PooledAdapter(
+        timeout=(float(settings.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT)), float(settings.get("read_timeout", DEFAULT_READ_TIMEOUT))),
+        pool_connections=int(settings.get("pool_hosts", DEFAULT_POOL_HOSTS)),
+        pool_maxsize=int(settings.get("pool_size", DEFAULT_POOL_SIZE)),
+        max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"User-Agent": USER_AGENT, "Accept-Encoding": ACCEPT_ENCODING})
+    return session
+
+def get_session(retry_posts=False, retries=DEFAULT_RETRIES):
+    """
+    Returns the application-wide HTTP session: keep-alive connection pools per host, a default timeout,
+    and retries with jittered backoff on 429/5xx and connection errors. Only idempotent methods are retried,
+    unless retry_posts is set for APIs whose POSTs are read-only queries (e.g. Wix). Compressed responses
+    are decoded transparently. Pass retries=0 for clients that retry on their own (e.g. Stripe).
+    """
+    key = (retry_posts, retries)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = _build_session(retry_posts, retries)
+    return session
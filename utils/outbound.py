@@ -0,0 +1,251 @@
+# utils/outbound.py
+import time
+import logging
+import threading
+from bisect import bisect_left
+import requests
+from utils.config import get_config
+from utils.http import get_session
+
+# Defaults for every provider, overridable per provider through the "outbound" entry in config.json,
+# e.g. {"outbound": {"xai": {"rate": 1, "max_concurrent": 2}}}
+DEFAULT_LIMITS = {
+    "rate": 10.0,  # Calls per second the token bucket refills
+    "burst": 20,  # Token bucket size
+    "max_concurrent": 8,  # Bulkhead: calls in flight at once per worker
+    "acquire_timeout": 2.0,  # How long a call may wait for a token or a bulkhead slot
+    "failure_threshold": 5,  # Consecutive failures that open the circuit
+    "reset_timeout": 30.0,  # Seconds an open circuit waits before letting a probe through
+    "timeout": 10.0  # Default request timeout
+}
+PROVIDER_LIMITS = {
+    "wix": {"rate": 20.0, "burst": 40, "max_concurrent": 12, "timeout": 15.0},
+    "xai": {"rate": 2.0, "burst": 5, "max_concurrent": 4, "acquire_timeout": 5.0, "timeout": 30.0},
+    "textmagic": {"rate": 2.0, "burst": 5, "max_concurrent": 2},
+    "stripe": {"rate": 20.0, "burst": 25, "timeout": 20.0},
+    "posthog": {"rate": 10.0, "burst": 20, "max_concurrent": 6},
+    "github": {"rate": 5.0, "burst": 10, "max_concurrent": 4}
+}
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+class OutboundRejected(requests.RequestException):
+    """
+    Raised instead of calling a provider whose circuit is open, whose rate limit is used up or whose
+    bulkhead is full. A RequestException, so callers' existing network error handling applies.
+    """
+
+    def __init__(self, provider, reason):
+        super().__init__(f"{provider} call rejected: {reason}")
+        self.provider = provider
+        self.reason = reason
+
+class TokenBucket:
+    """Allows rate calls per second on average, and bursts of up to burst calls."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=0.0):
+        """Takes a token, waiting up to timeout seconds for one. Returns False if none became available."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects calls for reset_timeout seconds.
+    It then goes half-open and lets a single probe call through: the circuit closes if the probe
+    succeeds and re-opens if it fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def release(self):
+        """Gives back a probe slot taken by allow() for a call that was never made."""
+        with self._lock:
+            self._probing = False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self.state = self.CLOSED
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+class LatencyHistogram:
+    """Call latencies counted in LATENCY_BUCKETS_MS buckets, reported cumulatively (each bucket counts calls at or under its bound)."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = tuple(bounds)
+        self._counts = [0] * (len(self.bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, ms):
+        with self._lock:
+            self._counts[bisect_left(self.bounds, ms)] += 1
+            self._sum += ms
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total_ms = self._sum
+        buckets = {}
+        running = 0
+        for bound, count in zip(self.bounds + ("+Inf",), counts):
+            running += count
+            buckets[str(bound)] = running
+        return {"buckets": buckets, "count": running, "sum_ms": round(total_ms, 1)}
+
+def _is_failure(response=None, error=None):
+    """
+    Whether a call outcome counts against the provider's circuit: network errors, 5xx and 429 do;
+    4xx responses (and client errors raised for them, e.g. by Stripe) are the caller's problem and don't.
+    """
+    if error is not None:
+        status = getattr(error, "http_status", None) or getattr(getattr(error, "response", None), "status_code", None)
+        return not (status and 400 <= status < 500 and status != 429)
+    status = getattr(response, "status_code", None)
+    return status is not None and (status >= 500 or status == 429)
+
+class OutboundProvider:
+    """
+    Guards calls to one external provider with a token bucket, a bulkhead limiting calls in flight and a
+    circuit breaker, and records each call's latency. Calls that can't proceed raise OutboundRejected
+    straight away (or after at most acquire_timeout seconds) rather than piling up behind a slow provider.
+    """
+
+    def __init__(self, name, limits):
+        self.name = name
+        self.timeout = float(limits["timeout"])
+        self.acquire_timeout = float(limits["acquire_timeout"])
+        self.bucket = TokenBucket(limits["rate"], limits["burst"])
+        self.bulkhead = threading.BoundedSemaphore(int(limits["max_concurrent"]))
+        self.breaker = CircuitBreaker(int(limits["failure_threshold"]), float(limits["reset_timeout"]))
+        self.latency = LatencyHistogram()
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._stats = {"calls": 0, "failures": 0, "circuit_open": 0, "rate_limited": 0, "bulkhead_full": 0, "trips": 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _reject(self, reason):
+        self._count(reason)
+        logging.warning(f"UX Issue - Outbound call to {self.name} rejected: {reason}")
+        raise OutboundRejected(self.name, reason)
+
+    def call(self, fn, *args, **kwargs):
+        """Calls fn(*args, **kwargs) under this provider's limits and returns its result."""
+        if not self.breaker.allow():
+            self._reject("circuit_open")
+        started = time.monotonic()
+        if not self.bucket.acquire(self.acquire_timeout):
+            self.breaker.release()
+            self._reject("rate_limited")
+        if not self.bulkhead.acquire(timeout=max(0, started + self.acquire_timeout - time.monotonic())):
+            self.breaker.release()
+            self._reject("bulkhead_full")
+        with self._lock:
+            self._inflight += 1
+            self._stats["calls"] += 1
+        started = time.monotonic()
+        response, error = None, None
+        try:
+            response = fn(*args, **kwargs)
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.latency.observe((time.monotonic() - started) * 1000)
+            with self._lock:
+                self._inflight -= 1
+            self.bulkhead.release()
+            if _is_failure(response, error):
+                self._count("failures")
+                if self.breaker.failure():
+                    self._count("trips")
+                    logging.warning(f"UX Issue - Circuit for {self.name} opened for {self.breaker.reset_timeout:.0f}s")
+            else:
+                self.breaker.success()
+
+    def request(self, method, url, session=None, **kwargs):
+        """
+        Makes an HTTP request through call() on session (default: the shared pooled session),
+        with this provider's default timeout unless one is given.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.call((session or get_session()).request, method, url, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, inflight=self._inflight)
+        return dict(stats, circuit=self.breaker.state, latency_ms=self.latency.snapshot())
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+def outbound(name):
+    """Returns the shared guard for one provider, built from config on first use."""
+    provider = _providers.get(name)
+    if provider is None:
+        with _providers_lock:
+            provider = _providers.get(name)
+            if provider is None:
+                limits = dict(DEFAULT_LIMITS, **PROVIDER_LIMITS.get(name, {}))
+                limits.update(get_config().get("outbound", {}).get(name, {}))
+                provider = _providers[name] = OutboundProvider(name, limits)
+    return provider
+
+def outbound_stats():
+    """Returns call counts, circuit state and latency histograms for every provider used in this worker."""
+    with _providers_lock:
+        providers = list(_providers.values())
+    return {provider.name: provider.stats() for provider in providers}
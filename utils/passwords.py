@@ -0,0 +1,217 @@
+# utils/passwords.py
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import bcrypt
+from flask import has_request_context, request
+from utils.config import get_config
+from utils.users import update_user_fields
+
+# Defaults, overridable through the "passwords" entry in config.json
+DEFAULT_ROUNDS = 12
+DEFAULT_WORKERS = max(1, min(4, os.cpu_count() or 1))
+DEFAULT_MAX_QUEUE = 64
+DEFAULT_MAX_PER_CLIENT = 4
+DEFAULT_TIMEOUT = 10.0
+DEPTH_WARNING_RATIO = 0.75
+
+class PasswordBusyError(Exception):
+    """
+    Raised when a password job can't be queued or doesn't finish in time.
+    status_code is 429 when one client has too many jobs queued and 503 when the pool is saturated.
+    """
+    def __init__(self, message, status_code=503):
+        super().__init__(message)
+        self.status_code = status_code
+
+def _settings():
+    passwords = get_config().get("passwords", {})
+    return {
+        "rounds": int(passwords.get("bcrypt_rounds", DEFAULT_ROUNDS)),
+        "workers": int(passwords.get("workers", DEFAULT_WORKERS)),
+        "max_queue": int(passwords.get("max_queue", DEFAULT_MAX_QUEUE)),
+        "max_per_client": int(passwords.get("max_per_client", DEFAULT_MAX_PER_CLIENT)),
+        "timeout": float(passwords.get("timeout", DEFAULT_TIMEOUT)),
+        "rehash_on_login": bool(passwords.get("rehash_on_login", True))
+    }
+
+class PasswordWorkerPool:
+    """
+    Runs bcrypt jobs on a fixed number of worker threads so hashing can't occupy every request worker.
+    Jobs wait in one queue per client (IP address) and workers take from those queues round-robin,
+    so a burst from one address doesn't delay logins from everyone else.
+    """
+
+    def __init__(self, workers, max_queue, max_per_client):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_per_client = max_per_client
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # client -> deque of (future, fn, args, queued_at), in serving order
+        self._depth = 0
+        self._active = 0
+        self._threads = []
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "max_depth": 0, "wait_seconds": 0.0}
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name=f"password-worker-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, client, fn, *args):
+        """Queues fn(*args) for client and returns a Future. Raises PasswordBusyError if the queue is full."""
+        client = client or "unknown"
+        future = Future()
+        with self._cond:
+            pending = self._queues.get(client)
+            if pending is not None and len(pending) >= self.max_per_client:
+                self._stats["rejected"] += 1
+                logging.warning(f"Security Issue - Password queue limit reached for client {client}")
+                raise PasswordBusyError("Too many password attempts in progress, please retry shortly", 429)
+            if self._depth >= self.max_queue:
+                self._stats["rejected"] += 1
+                logging.warning(f"UX Issue - Password queue full ({self._depth} jobs), rejecting request from {client}")
+                raise PasswordBusyError("Server busy, please retry shortly", 503)
+            self._queues.setdefault(client, deque()).append((future, fn, args, time.monotonic()))
+            self._depth += 1
+            self._stats["submitted"] += 1
+            self._stats["max_depth"] = max(self._stats["max_depth"], self._depth)
+            if self._depth >= self.max_queue * DEPTH_WARNING_RATIO:
+                logging.warning(f"UX Issue - Password queue depth {self._depth}/{self.max_queue}")
+            self._start()
+            self._cond.notify()
+        return future
+
+    def _next_job(self):
+        client, pending = next(iter(self._queues.items()))
+        job = pending.popleft()
+        if pending:
+            self._queues.move_to_end(client)
+        else:
+            del self._queues[client]
+        self._depth -= 1
+        return job
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queues:
+                    self._cond.wait()
+                future, fn, args, queued_at = self._next_job()
+                self._active += 1
+                self._stats["wait_seconds"] += time.monotonic() - queued_at
+            try:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(fn(*args))
+                    ok = True
+                else:
+                    ok = False
+            except Exception as e:
+                future.set_exception(e)
+                ok = False
+            with self._cond:
+                self._active -= 1
+                self._stats["completed" if ok else "failed"] += 1
+
+    def metrics(self):
+        """Returns a snapshot of queue depth, active jobs and counters."""
+        with self._cond:
+            started = self._stats["submitted"] - self._depth
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "max_per_client": self.max_per_client,
+                "queue_depth": self._depth,
+                "active": self._active,
+                "queued_clients": len(self._queues),
+                "submitted": self._stats["submitted"],
+                "completed": self._stats["completed"],
+                "failed": self._stats["failed"],
+                "rejected": self._stats["rejected"],
+                "max_depth": self._stats["max_depth"],
+                "avg_wait_ms": round(1000 * self._stats["wait_seconds"] / started, 2) if started else 0.0
+            }
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                settings = _settings()
+                _pool = PasswordWorkerPool(settings["workers"], settings["max_queue"], settings["max_per_client"])
+    return _pool
+
+def _client():
+    return request.remote_addr if has_request_context() else None
+
+def _run_job(fn, *args, client=None):
+    future = _get_pool().submit(client or _client(), fn, *args)
+    try:
+        return future.result(timeout=_settings()["timeout"])
+    except FutureTimeoutError:
+        future.cancel()
+        logging.warning("UX Issue - Password job timed out waiting for a worker")
+        raise PasswordBusyError("Server busy, please retry shortly", 503)
+
+def _checkpw(password, stored_hash):
+    return bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8'))
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
+
+def check_password(password, stored_hash, client=None):
+    """
+    Verifies password against a bcrypt hash on the password pool.
+    Raises PasswordBusyError if the pool can't take or finish the job.
+    """
+    if not stored_hash:
+        return False
+    return _run_job(_checkpw, password, stored_hash, client=client)
+
+def hash_password(password, client=None):
+    """
+    Hashes password with the configured bcrypt cost on the password pool.
+    Raises PasswordBusyError if the pool can't take or finish the job.
+    """
+    return _run_job(_hashpw, password, _settings()["rounds"], client=client)
+
+def needs_rehash(stored_hash):
+    """Returns True if stored_hash was made with a different cost than the configured bcrypt_rounds."""
+    try:
+        return int(stored_hash.split('$')[2]) != _settings()["rounds"]
+    except (AttributeError, IndexError, ValueError):
+        return False
+
+def _rehash(user_id, old_hash, password, rounds):
+    new_hash = _hashpw(password, rounds)
+    # Skip if the password changed while the rehash was queued
+    previous = update_user_fields(user_id, lambda user: {"password": new_hash} if user.get("password") == old_hash else {})
+    if previous and previous.get("password") == old_hash:
+        logging.info(f"Rehashed password for user {user_id} at cost {rounds}")
+
+def verify_login(user_id, user, password, client=None):
+    """
+    Verifies a login password. When it matches and the hash uses a stale cost factor,
+    a rehash at the configured cost is queued in the background without delaying the login.
+    """
+    stored_hash = user.get("password", "")
+    if not check_password(password, stored_hash, client=client):
+        return False
+    settings = _settings()
+    if settings["rehash_on_login"] and needs_rehash(stored_hash):
+        try:
+            _get_pool().submit(client or _client(), _rehash, user_id, stored_hash, password, settings["rounds"])
+        except PasswordBusyError:
+            logging.debug(f"Password pool busy, rehash for user {user_id} deferred to a later login")
+    return True
+
+def password_pool_metrics():
+    """Returns the password pool's queue depth and counters."""
+    return _get_pool().metrics()
@@ -1,19 +1,27 @@
-import posthog
-from .config import load_config  # Import from existing utils/config.py
+from .config import get_config  # Import from existing utils/config.py
+from .event_pipeline import EventPipeline, DEFAULT_SPOOL_DIR, DEFAULT_MAX_QUEUE, DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL
+from .event_store import event_store, normalize_timestamp
+from .users import get_referees
+from .cache import TTLCache
+from .outbound import outbound
+from .http import get_session
 import logging
 from datetime import datetime, timedelta, timezone
-import requests
 import json
-from functools import lru_cache
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 def initialize_posthog():
     """
-    Initialize PostHog client using credentials from config.json.
+    Initialize the PostHog event pipeline using credentials from config.json.
+    Events passed to capture() are queued and sent in batches by a background flusher,
+    so request handlers never wait on PostHog.
 
     Returns:
-        posthog: Initialized PostHog client object, or None if initialization fails.
+        EventPipeline: Pipeline exposing capture(distinct_id, event, properties), or None if initialization fails.
     """
-    config = load_config()
+    config = get_config()
     posthog_config = config.get("posthog", {})
     api_key = posthog_config.get("PROJECT_API_KEY")
     host = posthog_config.get("HOST", "https://app.posthog.com")
@@ -23,10 +31,16 @@ def initialize_posthog():
         return None
 
     try:
-        posthog.api_key = api_key
-        posthog.host = host
-        logging.debug("PostHog initialized successfully")
-        return posthog
+        pipeline = EventPipeline(
+            api_key,
+            host,
+            spool_dir=posthog_config.get("SPOOL_DIR", DEFAULT_SPOOL_DIR),
+            max_queue=int(posthog_config.get("MAX_QUEUE", DEFAULT_MAX_QUEUE)),
+            batch_size=int(posthog_config.get("BATCH_SIZE", DEFAULT_BATCH_SIZE)),
+            flush_interval=float(posthog_config.get("FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL))
+        )
+        logging.debug("PostHog event pipeline initialized successfully")
+        return pipeline
     except Exception as e:
         logging.error(f"PostHog Issue - Failed to initialize PostHog: {str(e)}", exc_info=True)
         return None
@@ -70,78 +84,160 @@ def get_date_range(period):
 
     return start.isoformat(), end.isoformat()
 
-@lru_cache(maxsize=100)
-def cached_fetch_events(event_type, start, end, properties_filter_str=None):
-    """
-    Cached helper function to fetch events from PostHog, avoiding redundant API calls.
+# Periods that ended more than SETTLE_SECONDS ago no longer change upstream and are cached for CLOSED_PERIOD_TTL
+OPEN_PERIOD_TTL = 60
+CLOSED_PERIOD_TTL = 7 * 24 * 3600
+SETTLE_SECONDS = 15 * 60
+FAILURE_TTL = 15
 
-    Args:
-        event_type (str): The event type to filter by (e.g., 'login').
-        start (str): Start date in ISO format (e.g., '2025-05-09T00:00:00Z').
-        end (str): End date in ISO format (e.g., '2025-05-09T23:59:59Z').
-        properties_filter_str (str, optional): JSON-serialized string of property filters.
+# Event API paging and concurrency
+PAGE_SIZE = 1000
+MAX_PAGES = 500
+FETCH_WORKERS = 4
+REQUEST_TIMEOUT = (5, 30)
+STREAM_CACHE_LIMIT = 20000
 
-    Returns:
-        list: List of event dictionaries from PostHog, or empty list if the request fails.
+_events_cache = None
+_events_cache_lock = threading.Lock()
+
+def _get_events_cache():
+    global _events_cache
+    if _events_cache is None:
+        with _events_cache_lock:
+            if _events_cache is None:
+                posthog_config = get_config().get("posthog", {})
+                _events_cache = TTLCache(
+                    maxsize=int(posthog_config.get("CACHE_SIZE", 256)),
+                    disk_dir=posthog_config.get("CACHE_DIR")
+                )
+    return _events_cache
+
+def period_ttl(end):
+    """
+    Returns how long events for a period ending at end (ISO string) may be cached:
+    short while the period is still open, long once it has closed and settled.
     """
-    # Convert properties_filter_str back to a list if provided
-    properties_filter = json.loads(properties_filter_str) if properties_filter_str else None
-    # Call the internal fetch function with deserialized filter
-    return fetch_events_internal(event_type, start, end, properties_filter)
+    end_time = datetime.fromisoformat(end.replace("Z", "+00:00"))
+    if end_time.tzinfo is None:
+        end_time = end_time.replace(tzinfo=timezone.utc)
+    if end_time <= datetime.now(timezone.utc) - timedelta(seconds=SETTLE_SECONDS):
+        return CLOSED_PERIOD_TTL
+    return OPEN_PERIOD_TTL
 
-def fetch_events_internal(event_type, start, end, properties_filter=None):
+def _read_config():
+    posthog_config = get_config().get("posthog", {})
+    api_key = posthog_config.get("PROJECT_READ_KEY", "")
+    host = posthog_config.get("HOST", "https://eu.i.posthog.com")
+    project_id = posthog_config.get("PROJECT_ID", 0)
+    if not api_key or not project_id:
+        raise ValueError("PostHog configuration missing: PROJECT_READ_KEY or PROJECT_ID not set")
+    return api_key, host, project_id
+
+def _day_windows(start, end):
+    """Splits [start, end) into day-sized windows, newest first."""
+    start_time = datetime.fromisoformat(start.replace("Z", "+00:00"))
+    window_end = datetime.fromisoformat(end.replace("Z", "+00:00"))
+    windows = []
+    while window_end > start_time:
+        window_start = max(start_time, window_end - timedelta(days=1))
+        windows.append((window_start.isoformat(), window_end.isoformat()))
+        window_end = window_start
+    return windows
+
+def fetch_events_window(event_type, start, end, properties_filter=None):
     """
-    Internal function to handle the actual API call to PostHog.
+    Fetches every event of one type in [start, end) from PostHog, following the "next"
+    cursor across pages.
 
     Args:
         event_type (str): The event type to filter by (e.g., 'login').
         start (str): Start date in ISO format (e.g., '2025-05-09T00:00:00Z').
-        end (str): End date in ISO format (e.g., '2025-05-09T23:59:59Z').
+        end (str): End date in ISO format (e.g., '2025-05-10T00:00:00Z').
         properties_filter (list, optional): List of property filters (e.g., [{'key': 'source_user_id', 'value': '123'}]).
 
     Returns:
-        list: List of event dictionaries from PostHog, or empty list if the request fails.
+        list: Event dictionaries from PostHog, newest first.
+
+    Raises:
+        ValueError: If the PostHog read configuration is missing.
+        requests.RequestException: If a request fails after retries.
     """
-    # Load PostHog configuration
-    config = load_config()
-    posthog_config = config.get("posthog", {})
+    api_key, host, project_id = _read_config()
+    session = get_session()
+    headers = {"Authorization": f"Bearer {api_key}"}
 
-    api_key = posthog_config.get("PROJECT_READ_KEY", "")
-    host = posthog_config.get("HOST", "https://eu.i.posthog.com")
-    project_id = posthog_config.get("PROJECT_ID", 0)
+    params = {
+        "event": event_type,
+        "after": start,
+        "before": end,
+        "limit": PAGE_SIZE
+    }
+    if properties_filter:
+        params["properties"] = json.dumps(properties_filter)  # Serialize filter to JSON
 
-    if not api_key or not project_id:
-        logging.error("PostHog configuration missing: PROJECT_READ_KEY or PROJECT_ID not set")
-        return []
+    url = f"{host}/api/projects/{project_id}/events"
+    events = []
+    for _ in range(MAX_PAGES):
+        response = outbound("posthog").request("GET", url, session=session, headers=headers, params=params, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()  # Raises an exception for 4xx/5xx status codes
+        data = response.json()
+        events.extend(data.get("results", []))
+        url = data.get("next")
+        if not url:
+            break
+        params = None  # The next URL already carries the query
+    else:
+        logging.warning(f"PostHog Issue - Stopped after {MAX_PAGES} pages of {event_type} events for {start} to {end}")
+    return events
+
+def iter_events(event_type, start, end, properties_filter=None):
+    """
+    Yields every PostHog event of one type in [start, end), newest first.
+    The range is split into day windows that are fetched concurrently (at most FETCH_WORKERS
+    in flight), and each window is yielded as soon as the windows before it are done,
+    so a month is never held in memory at once.
 
+    Raises:
+        ValueError: If the PostHog read configuration is missing.
+        requests.RequestException: If a window fails after retries.
+    """
+    windows = iter(_day_windows(start, end))
+    pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+    pending = deque()
     try:
-        # Construct the API URL and headers
-        url = f"{host}/api/projects/{project_id}/events"
-        headers = {"Authorization": f"Bearer {api_key}"}
-
-        # Set up query parameters
-        params = {
-            "event": event_type,
-            "after": start,
-            "before": end,
-        }
-        if properties_filter:
-            params["properties"] = json.dumps(properties_filter)  # Serialize filter to JSON
-
-        # Make the API request
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()  # Raises an exception for 4xx/5xx status codes
+        for window_start, window_end in windows:
+            pending.append(pool.submit(fetch_events_window, event_type, window_start, window_end, properties_filter))
+            if len(pending) >= FETCH_WORKERS:
+                break
+        while pending:
+            events = pending.popleft().result()
+            following = next(windows, None)
+            if following:
+                pending.append(pool.submit(fetch_events_window, event_type, following[0], following[1], properties_filter))
+            yield from events
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
 
-        # Return the list of events from the response
-        return response.json().get("results", [])
+def fetch_events_internal(event_type, start, end, properties_filter=None):
+    """
+    Internal function returning every PostHog event in the range as a list.
 
-    except Exception as e:
-        logging.error(f"Failed to fetch events from PostHog: {str(e)}")
-        return []
+    Raises:
+        ValueError: If the PostHog read configuration is missing.
+        requests.RequestException: If the request fails.
+    """
+    return list(iter_events(event_type, start, end, properties_filter))
+
+def _events_key(event_type, start, end, properties_filter):
+    # Serialize the query, ensuring consistency with sort_keys
+    return json.dumps(["events", event_type, start, end, properties_filter], sort_keys=True)
 
 def fetch_events(event_type, start, end, properties_filter=None):
     """
-    Fetch events from PostHog with optional filters, utilizing caching for efficiency.
+    Fetch events from PostHog with optional filters, through a TTL cache.
+    Results for closed periods are kept for days, open periods for a minute; concurrent
+    requests for the same query share one upstream call. A failed fetch returns an empty
+    list and is retried after FAILURE_TTL seconds rather than on every request.
 
     Args:
         event_type (str): The event type to filter by (e.g., 'login').
@@ -152,10 +248,81 @@ def fetch_events(event_type, start, end, properties_filter=None):
     Returns:
         list: List of event dictionaries from PostHog, or empty list if the request fails.
     """
-    # Serialize properties_filter to a JSON string for caching, ensuring consistency with sort_keys
-    properties_filter_str = json.dumps(properties_filter, sort_keys=True) if properties_filter else None
-    # Call the cached function with serialized parameters
-    return cached_fetch_events(event_type, start, end, properties_filter_str)
+    def load():
+        try:
+            return fetch_events_internal(event_type, start, end, properties_filter)
+        except Exception as e:
+            logging.error(f"Failed to fetch events from PostHog: {str(e)}")
+            raise
+
+    key = _events_key(event_type, start, end, properties_filter)
+    return _get_events_cache().get_or_load(key, load, period_ttl(end), negative_ttl=FAILURE_TTL, fallback=[])
+
+def stream_events(event_type, start, end, properties_filter=None):
+    """
+    Yields PostHog events like fetch_events, but streams them on a cache miss instead of
+    collecting the whole range first. It shares fetch_events' cache, including its disk tier and
+    per-query single-flight: concurrent requests for the same query wait for the one streaming it.
+    Results of up to STREAM_CACHE_LIMIT events are cached once fully read.
+
+    Raises:
+        ValueError: If the PostHog read configuration is missing.
+        requests.RequestException: If PostHog fails, including mid-stream. The failure is remembered
+            for FAILURE_TTL seconds, during which the same query fails again without going upstream.
+    """
+    def iterate():
+        try:
+            yield from iter_events(event_type, start, end, properties_filter)
+        except Exception as e:
+            logging.error(f"Failed to fetch events from PostHog: {str(e)}")
+            raise
+
+    key = _events_key(event_type, start, end, properties_filter)
+    yield from _get_events_cache().stream_or_load(
+        key, iterate, period_ttl(end), negative_ttl=FAILURE_TTL, max_items=STREAM_CACHE_LIMIT
+    )
+
+def load_events(event_type, start, end, source_user_id=None, destination_user_id=None, referrer_id=None, user_ids=None):
+    """
+    Yields events for a period, newest first, answering from the local event store.
+    Only the part of the period before the store's coverage start is fetched (streamed) from PostHog.
+
+    Args:
+        event_type (str): The event type to filter by (e.g., 'click').
+        start (str): Start date in ISO format.
+        end (str): End date in ISO format.
+        source_user_id (str, optional): Only events from this source user.
+        destination_user_id (str, optional): Only events to this destination user.
+        referrer_id (str, optional): Only events whose source or destination user was referred by this user.
+        user_ids (set, optional): Only events whose source or destination user is in this set.
+
+    Yields:
+        dict: Event dictionaries shaped like PostHog results.
+    """
+    coverage_start = event_store.coverage_start()
+    start, end = normalize_timestamp(start), normalize_timestamp(end)
+
+    if end > coverage_start:
+        yield from event_store.iter_query(
+            event_type, max(start, coverage_start), end,
+            source_user_id=source_user_id, destination_user_id=destination_user_id, referrer=referrer_id, user_ids=user_ids
+        )
+
+    if start < coverage_start:
+        older_end = min(end, coverage_start)
+        if referrer_id or user_ids is not None:
+            referees = set(user_ids) if user_ids is not None else get_referees(referrer_id)
+            for event in stream_events(event_type, start, older_end):
+                properties = event.get("properties", {})
+                if properties.get("source_user_id") in referees or properties.get("destination_user_id") in referees:
+                    yield event
+        else:
+            properties_filter = []
+            if source_user_id:
+                properties_filter.append({'key': 'source_user_id', 'value': source_user_id})
+            if destination_user_id:
+                properties_filter.append({'key': 'destination_user_id', 'value': destination_user_id})
+            yield from stream_events(event_type, start, older_end, properties_filter or None)
 
 def format_event_details(properties, event_type):
     """
@@ -173,7 +340,7 @@ def format_event_details(properties, event_type):
 
     # Define formatters for all four supported event types
     formatters = {
-        'login': lambda props: f"{props.get('user_id')} logged in from IP {props.get('$ip', 'N/A')}",
+        'login': lambda props: f"{props.get('user_id')} logged in from IP {props.get('$ip', props.get('ip_address', 'N/A'))}",
         'signup': lambda props: f"Signup for IP {props.get('$ip', 'N/A')}, Role: {props.get('role', 'N/A')}, Email: {props.get('email', 'N/A')}",
         'click': lambda props: f"Click by IP {props.get('$ip', 'N/A')} from: {props.get('source', props.get('source_user_id'))} to: {props.get('destination', props.get('destination_user_id'))}",
         'order': lambda props: f"Order for {props.get('sale_value', 'N/A')} by IP {props.get('$ip', 'N/A')} from: {props.get('source', props.get('source_user_id'))} to: {props.get('destination', props.get('destination_user_id'))}"
@@ -1,5 +1,18 @@
+import time
 import logging
-from utils.config import load_config
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from utils.config import get_config, get_settings_view
+from utils.cache import TTLCache
+from utils.deals import query_deals
+from utils.http import get_session
+
+# Defaults, overridable through the "deal_providers" entry in config.json
+DEFAULT_PROVIDER_TIMEOUT = 4.0
+DEFAULT_PROVIDER_CACHE_TTL = 300
+DEFAULT_MIN_DISCOUNT = 20
+ENGINE_WORKERS = 8
+DEFAULT_BATCH_WINDOW = 0.025  # Seconds a detail lookup waits for others to share its batch
 
 # Placeholder AmazonApi class (assuming it’s defined elsewhere or stubbed)
 class AmazonApi:
@@ -8,29 +21,445 @@ class AmazonApi:
         self.secret_key = secret_key
         self.associate_tag = associate_tag
         self.country = country
-    
-    def search_items(self, BrowseNodeId, ItemCount):
+
+    def search_items(self, BrowseNodeId, ItemCount, **kwargs):
         logging.debug(f"Amazon API call to search items - BrowseNodeId: {BrowseNodeId}, ItemCount: {ItemCount}")
         return []  # Stub for demo
 
-def search_all_discounted(category_id):
-    config = load_config()
+    def get_items(self, item_ids, resources):
+        logging.debug(f"Amazon API call to get items: {item_ids}")
+        return []  # Stub for demo
+
+def _discount(original_price, current_price):
+    return round((original_price - current_price) / original_price * 100, 2) if original_price > current_price else 0.0
+
+class DetailBatcher:
+    """
+    Coalesces detail lookups for one provider. IDs requested within window seconds of each other, by any
+    number of callers, are sent upstream together as fetch_batch(ids) calls of at most max_batch IDs
+    (a full batch goes at once), and each caller gets back just the records it asked for.
+    An ID already waiting or in flight is shared rather than requested twice.
+    """
+
+    def __init__(self, fetch_batch, max_batch, window=DEFAULT_BATCH_WINDOW):
+        self.fetch_batch = fetch_batch
+        self.max_batch = max_batch
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = {}  # item_id -> Future, in arrival order
+        self._inflight = {}  # item_id -> Future, for IDs sent upstream and not yet answered
+        self._timer = None
+        self._stats = {"requested": 0, "coalesced": 0, "batches": 0, "failures": 0}
+
+    def submit(self, item_id):
+        """Returns a Future for item_id's record (None if the provider doesn't return it)."""
+        with self._lock:
+            self._stats["requested"] += 1
+            future = self._pending.get(item_id) or self._inflight.get(item_id)
+            if future is not None:
+                self._stats["coalesced"] += 1
+                return future
+            future = Future()
+            self._pending[item_id] = future
+            if len(self._pending) >= self.max_batch:
+                batch = self._take()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.window, self._flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if batch:
+            threading.Thread(target=self._run, args=(batch,), name="detail-batch", daemon=True).start()
+        return future
+
+    def _take(self):
+        batch = dict(list(self._pending.items())[:self.max_batch])
+        for item_id in batch:
+            del self._pending[item_id]
+        self._inflight.update(batch)
+        if not self._pending and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            batches = []
+            while self._pending:
+                batches.append(self._take())
+        for batch in batches:
+            self._run(batch)
+
+    def _run(self, batch):
+        with self._lock:
+            self._stats["batches"] += 1
+        try:
+            records = self.fetch_batch(list(batch))
+        except Exception as e:
+            records = None
+            error = e
+        with self._lock:
+            for item_id in batch:
+                self._inflight.pop(item_id, None)
+            if records is None:
+                self._stats["failures"] += 1
+        for item_id, future in batch.items():
+            if records is None:
+                future.set_exception(error)
+            else:
+                future.set_result(records.get(item_id))
+
+    def lookup(self, item_ids, timeout=None):
+        """Returns {item_id: record} for the given IDs, leaving out any the provider didn't return."""
+        futures = [(item_id, self.submit(item_id)) for item_id in dict.fromkeys(item_ids)]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        records = {}
+        for item_id, future in futures:
+            record = future.result(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+            if record is not None:
+                records[item_id] = record
+        return records
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending), inflight=len(self._inflight))
+
+class DealProvider:
+    """
+    One source of discounted products. Subclasses set name (the config key of their 'affiliate_key'
+    settings), the settings fields they need, and implement search(category, min_discount),
+    returning deal records: {"source", "id", "title", "product_url", "current_price", "original_price",
+    "discount_percent", "image_url", "category"}.
+    """
+    name = None
+    required_fields = ()
+    cacheable = True
+    batch_size = None  # Most IDs one detail request takes; providers with detail lookups set it
+
+    def __init__(self, settings=None, timeout=DEFAULT_PROVIDER_TIMEOUT, batch_window=DEFAULT_BATCH_WINDOW):
+        self.settings = dict(settings or {})
+        self.timeout = timeout
+        self.batcher = DetailBatcher(self.fetch_details, self.batch_size, batch_window) if self.batch_size else None
+
+    @classmethod
+    def is_configured(cls, settings):
+        return all(settings.get(field) for field in cls.required_fields)
+
+    def search(self, category, min_discount):
+        raise NotImplementedError
+
+    def fetch_details(self, item_ids):
+        """Looks up at most batch_size items upstream and returns {item_id: deal record without category}."""
+        raise NotImplementedError
+
+    def details(self, item_ids, category=None):
+        """Returns deal records for item_ids, in order, through the provider's coalescing batcher."""
+        records = self.batcher.lookup(item_ids, timeout=self.timeout)
+        return [dict(records[item_id], category=category) for item_id in item_ids if item_id in records]
+
+class AmazonUKProvider(DealProvider):
+    name = "amazon_uk"
+    required_fields = ("ACCESS_KEY", "SECRET_KEY", "ASSOCIATE_TAG", "COUNTRY")
+    batch_size = 10  # PA-API GetItems takes at most 10 ASINs
+
+    def _api(self):
+        return AmazonApi(self.settings["ACCESS_KEY"], self.settings["SECRET_KEY"], self.settings["ASSOCIATE_TAG"], self.settings["COUNTRY"])
+
+    def search(self, category, min_discount):
+        search_result = self._api().search_items(
+            BrowseNodeId=category, ItemCount=10, Resources=["Offers.Listings.Price", "Offers.Summaries.HighestPrice"]
+        )
+        asins = [
+            item.asin for item in (getattr(search_result, "items", search_result) or [])
+            if item.offers and item.offers.listings and item.offers.listings[0].price.savings
+            and item.offers.listings[0].price.savings.percentage >= min_discount
+        ]
+        return self.details(asins, category)
+
+    def fetch_details(self, asins):
+        response = self._api().get_items(
+            item_ids=asins,
+            resources=["ItemInfo.Title", "Images.Primary.Large", "Offers.Listings.Price", "DetailPageURL"]
+        )
+        records = {}
+        for item in getattr(response, "items", response) or []:
+            listing = item.offers.listings[0] if item.offers and item.offers.listings else None
+            current_price = listing.price.amount if listing else None
+            savings = listing.price.savings if listing else None
+            records[item.asin] = {
+                "source": self.name,
+                "id": item.asin,
+                "title": item.item_info.title.display_value if item.item_info.title else None,
+                "product_url": item.detail_page_url,
+                "current_price": current_price,
+                "original_price": current_price + savings.amount if savings else current_price,
+                "discount_percent": float(savings.percentage) if savings else 0.0,
+                "image_url": item.images.primary.large.url if item.images and item.images.primary else None
+            }
+        return records
+
+class EbayUKProvider(DealProvider):
+    name = "ebay_uk"
+    required_fields = ("APP_ID",)
+    search_url = "https://api.ebay.com/buy/browse/v1/item_summary/search"
+
+    def search(self, category, min_discount):
+        # Summaries already carry prices, so search needs no per-item detail requests
+        response = get_session().get(
+            self.search_url,
+            headers={"Authorization": f"Bearer {self.settings['APP_ID']}", "X-EBAY-C-MARKETPLACE-ID": "EBAY_GB"},
+            params={"q": category, "filter": "conditions:{NEW}", "limit": "50"},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        deals = []
+        for item in response.json().get("itemSummaries", []):
+            current_price = float(item["price"]["value"])
+            original = item.get("marketingPrice", {}).get("originalPrice") or item.get("originalPrice") or {}
+            original_price = float(original.get("value", current_price))
+            discount = _discount(original_price, current_price)
+            if discount >= min_discount:
+                deals.append({
+                    "source": self.name,
+                    "id": item["itemId"],
+                    "title": item["title"],
+                    "product_url": item.get("itemAffiliateWebUrl") or item["itemWebUrl"],
+                    "current_price": current_price,
+                    "original_price": original_price,
+                    "discount_percent": discount,
+                    "image_url": item.get("image", {}).get("imageUrl"),
+                    "category": category
+                })
+        return deals
+
+class AwinUKProvider(DealProvider):
+    name = "awin"
+    required_fields = ("API_TOKEN",)
+
+    def search(self, category, min_discount):
+        response = get_session().get(
+            f"https://api.awin.com/publishers/{self.settings['API_TOKEN']}/products",
+            params={"region": "UK", "search": category, "discount": "true"},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        deals = []
+        for product in response.json().get("products", []):
+            current_price = float(product["price"]["amount"])
+            original_price = float(product.get("originalPrice", current_price))
+            discount = _discount(original_price, current_price)
+            if discount >= min_discount:
+                deals.append({
+                    "source": self.name,
+                    "id": product["productId"],
+                    "title": product["name"],
+                    "product_url": product["url"],
+                    "current_price": current_price,
+                    "original_price": original_price,
+                    "discount_percent": discount,
+                    "image_url": product.get("imageUrl"),
+                    "category": category
+                })
+        return deals
+
+class CJUKProvider(DealProvider):
+    name = "cj"
+    required_fields = ("API_KEY", "WEBSITE_ID")
+
+    def search(self, category, min_discount):
+        response = get_session().get(
+            "https://product-search.api.cj.com/v2/product-search",
+            headers={"Authorization": f"Bearer {self.settings['API_KEY']}"},
+            params={"website-id": self.settings["WEBSITE_ID"], "keywords": category, "country": "UK", "sale-price": "true"},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        deals = []
+        for product in response.json().get("products", []):
+            # CJ reports the list price as price and the reduced one as salePrice
+            original_price = float(product["price"])
+            current_price = float(product.get("salePrice") or original_price)
+            discount = _discount(original_price, current_price)
+            if discount >= min_discount:
+                deals.append({
+                    "source": self.name,
+                    "id": product["sku"],
+                    "title": product["name"],
+                    "product_url": product["buyUrl"],
+                    "current_price": current_price,
+                    "original_price": original_price,
+                    "discount_percent": discount,
+                    "image_url": product.get("imageUrl"),
+                    "category": category
+                })
+        return deals
+
+class WixProvider(DealProvider):
+    """Merchants' own Wix stores, read from the in-memory deals index rather than the Wix API."""
+    name = "wix"
+    cacheable = False
+
+    def search(self, category, min_discount):
+        deals, _ = query_deals(category, min_discount=min_discount)
+        return deals
+
+class FakeProvider(DealProvider):
+    """
+    Provider returning canned deals for local testing, optionally after a delay or by raising error.
+    Deals below min_discount are filtered out like a real provider would.
+    """
+
+    def __init__(self, name, deals=(), delay=0.0, error=None, timeout=DEFAULT_PROVIDER_TIMEOUT):
+        super().__init__(timeout=timeout)
+        self.name = name
+        self.deals = list(deals)
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def search(self, category, min_discount):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return [dict(deal, source=deal.get("source", self.name)) for deal in self.deals if deal.get("discount_percent", 0) >= min_discount]
+
+# Affiliate providers by their 'affiliate_key' config name
+AFFILIATE_PROVIDERS = {provider.name: provider for provider in (AmazonUKProvider, EbayUKProvider, AwinUKProvider, CJUKProvider)}
+
+def _dedupe_key(deal):
+    # The same product listed through two affiliates shares a title and price
+    return ((deal.get("title") or "").strip().casefold(), round(float(deal.get("current_price") or 0), 2))
+
+def merge_deals(results):
+    """
+    Merges provider results, keeping the best discount where different sources list the same product,
+    ranked by discount then price.
+    """
+    best = {}
+    for deals in results:
+        for deal in deals:
+            key = _dedupe_key(deal) if deal.get("title") else (deal.get("source"), deal.get("id"))
+            current = best.get(key)
+            if current is not None and current.get("source") == deal.get("source"):
+                # Same title and price from one source are distinct products (e.g. variants)
+                key = (deal.get("source"), deal.get("id"))
+                current = best.get(key)
+            if current is None or (deal.get("discount_percent") or 0) > (current.get("discount_percent") or 0):
+                best[key] = deal
+    return sorted(best.values(), key=lambda deal: (-(deal.get("discount_percent") or 0), deal.get("current_price") or 0))
+
+class DealsEngine:
+    """
+    Queries every provider concurrently and merges what arrives in time. Each provider has its own timeout;
+    one that is late or fails is reported in the per-provider status and left out, without failing the rest.
+    Results are cached per provider, category and threshold for cache_ttl seconds, and a late provider keeps
+    running in the background so its results are ready for the next request.
+    """
+
+    def __init__(self, providers, cache_ttl=DEFAULT_PROVIDER_CACHE_TTL, cache=None):
+        self.providers = list(providers)
+        self.cache_ttl = cache_ttl
+        self.cache = cache or TTLCache(maxsize=512)
+
+    def _search(self, provider, category, min_discount):
+        if not provider.cacheable:
+            return provider.search(category, min_discount)
+        return self.cache.get_or_load(
+            f"{provider.name}:{category}:{min_discount}",
+            lambda: provider.search(category, min_discount),
+            ttl=self.cache_ttl
+        )
+
+    def search(self, category, min_discount=DEFAULT_MIN_DISCOUNT, exclude=()):
+        """
+        Returns {"products": [...], "providers": {name: {"status", "count"}}, "ms": <elapsed>},
+        skipping the providers named in exclude.
+        """
+        started = time.monotonic()
+        futures = [
+            (provider, _get_executor().submit(self._search, provider, category, min_discount))
+            for provider in self.providers if provider.name not in exclude
+        ]
+
+        results = []
+        statuses = {}
+        for provider, future in futures:
+            # Every provider's timeout runs from the start of the search, not from when it is checked
+            try:
+                deals = future.result(timeout=max(0, started + provider.timeout - time.monotonic()))
+            except FutureTimeoutError:
+                logging.warning(f"UX Issue - Deal provider {provider.name} timed out after {provider.timeout}s for category {category}")
+                statuses[provider.name] = {"status": "timeout", "count": 0}
+                continue
+            except Exception as e:
+                logging.error(f"UX Issue - Deal provider {provider.name} failed for category {category}: {str(e)}")
+                statuses[provider.name] = {"status": "error", "count": 0, "message": str(e)}
+                continue
+            results.append(deals)
+            statuses[provider.name] = {"status": "ok", "count": len(deals)}
+        return {"products": merge_deals(results), "providers": statuses, "ms": round((time.monotonic() - started) * 1000)}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=ENGINE_WORKERS, thread_name_prefix="deal-provider")
+    return _executor
+
+_engine = None
+_engine_signature = None
+
+def configured_providers():
+    """Builds the Wix provider plus every affiliate provider whose 'affiliate_key' settings are complete."""
+    settings = get_config().get("deal_providers", {})
+    default_timeout = float(settings.get("timeout", DEFAULT_PROVIDER_TIMEOUT))
+    timeouts = settings.get("timeouts", {})
+    providers = [WixProvider(timeout=float(timeouts.get("wix", default_timeout)))]
+    for affiliate in get_settings_view('affiliate_key'):
+        provider_class = AFFILIATE_PROVIDERS.get(affiliate["key_type"])
+        if provider_class is None:
+            continue
+        if not provider_class.is_configured(affiliate["fields"]):
+            logging.warning(f"UX Issue - {affiliate['key_type']} config incomplete, skipping deal provider")
+            continue
+        providers.append(provider_class(
+            affiliate["fields"],
+            timeout=float(timeouts.get(provider_class.name, default_timeout)),
+            batch_window=float(settings.get("batch_window", DEFAULT_BATCH_WINDOW))
+        ))
+    return providers
+
+def get_deals_engine():
+    """Returns the engine for the current config, rebuilding it when config.json changes."""
+    global _engine, _engine_signature
+    config = get_config()
+    if _engine is None or _engine_signature is not config:
+        with _executor_lock:
+            if _engine is None or _engine_signature is not config:
+                ttl = float(config.get("deal_providers", {}).get("cache_ttl", DEFAULT_PROVIDER_CACHE_TTL))
+                _engine = DealsEngine(configured_providers(), cache_ttl=ttl)
+                _engine_signature = config
+    return _engine
+
+def search_all_discounted(category_id, min_discount_percent=DEFAULT_MIN_DISCOUNT, exclude=()):
+    """
+    Searches every configured provider (except those named in exclude) for discounted products in a category.
+    Returns {"products": [...], "providers": {...}}; providers that fail or time out are skipped.
+    """
     try:
-        if all(config.get("amazon_uk", {}).values()):
-            amazon = AmazonApi(
-                config["amazon_uk"]["ACCESS_KEY"],
-                config["amazon_uk"]["SECRET_KEY"],
-                config["amazon_uk"]["ASSOCIATE_TAG"],
-                config["amazon_uk"]["COUNTRY"]
-            )
-            search_result = amazon.search_items(BrowseNodeId=category_id, ItemCount=10)
-            if not search_result:
-                logging.warning(f"UX Issue - No discounted products found for category_id: {category_id}")
-            items = [{"id": item.asin, "title": item.item_info.title.display_value} for item in search_result]
-            return items
-        else:
-            logging.warning(f"UX Issue - Amazon config incomplete for category_id: {category_id}")
-            return []
+        return get_deals_engine().search(category_id, min_discount_percent, exclude)
     except Exception as e:
-        logging.error(f"Security Issue - Failed to search discounted products for category_id {category_id}: {str(e)}", exc_info=True)
-        return []  # Return empty list to maintain UX
\ No newline at end of file
+        logging.error(f"UX Issue - Failed to search discounted products for category_id {category_id}: {str(e)}", exc_info=True)
+        return {"products": [], "providers": {}}  # Return empty result to maintain UX
+
+def detail_batch_stats():
+    """Returns each configured provider's detail batcher counters."""
+    return {provider.name: provider.batcher.stats() for provider in get_deals_engine().providers if provider.batcher is not None}
@@ -0,0 +1,27 @@
+# utils/referrals.py
+import logging
+from utils.config import get_config
+
+# Share of an order's commission attributed to each referral level, nearest first
+DEFAULT_COMMISSION_RATES = (1.0,)
+
+def commission_rates():
+    """
+    Returns the per-level commission rates from the "referral" entry in config.json.
+    Levels past MAX_REFERRAL_DEPTH aren't rolled up, so rates beyond it attribute nothing.
+    """
+    rates = get_config().get("referral", {}).get("commission_rates", DEFAULT_COMMISSION_RATES)
+    try:
+        return tuple(float(rate) for rate in rates)
+    except (TypeError, ValueError):
+        logging.error(f"Invalid referral commission_rates in config: {rates}, using defaults")
+        return DEFAULT_COMMISSION_RATES
+
+def commission_level(tree, event):
+    """
+    Returns the referral level at which an event counts for the owner of tree ({user_id: level}):
+    the nearer of the source and destination users, or None if neither is in the tree.
+    """
+    properties = event.get("properties", {})
+    levels = [tree[user_id] for user_id in (properties.get("source_user_id"), properties.get("destination_user_id")) if user_id in tree]
+    return min(levels) if levels else None
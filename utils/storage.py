@@ -0,0 +1,94 @@
+# utils/storage.py
+import os
+import json
+import time
+import logging
+import tempfile
+from contextlib import contextmanager
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+LOCK_TIMEOUT = 10.0
+READ_RETRIES = 5
+RETRY_DELAY = 0.05
+
+@contextmanager
+def file_lock(path, timeout=LOCK_TIMEOUT):
+    """
+    Holds an exclusive cross-process lock on a hidden '.<name>.lock' file next to path
+    for the duration of the block.
+    Uses msvcrt on Windows (IIS/FastCGI workers) and fcntl elsewhere.
+    Raises TimeoutError if the lock can't be acquired within timeout seconds.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    lock_path = os.path.join(directory, f".{name}.lock")
+    deadline = time.monotonic() + timeout
+    with open(lock_path, 'a+') as lock_file:
+        while True:
+            try:
+                if os.name == 'nt':
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                else:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Timed out waiting for lock on {path}")
+                time.sleep(RETRY_DELAY)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def atomic_write_json(path, data, indent=4):
+    """
+    Writes data as JSON to path so readers only ever see the old or the new file.
+    The content goes to a temporary file in the same directory, is fsynced, and is then
+    renamed over path while holding the file lock, serialising writers across processes.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with file_lock(path):
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=indent)
+                f.flush()
+                os.fsync(f.fileno())
+            for attempt in range(READ_RETRIES):
+                try:
+                    os.replace(temp_path, path)
+                    break
+                except PermissionError:
+                    # Windows refuses to replace a file another process has open; retry briefly
+                    if attempt == READ_RETRIES - 1:
+                        raise
+                    time.sleep(RETRY_DELAY)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+def read_json(path, retries=READ_RETRIES):
+    """
+    Reads a JSON file, retrying when the content is truncated or the file is briefly
+    unavailable mid-rename. Raises FileNotFoundError if path doesn't exist and
+    json.JSONDecodeError if the file is still invalid after all retries.
+    """
+    for attempt in range(retries):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, PermissionError) as e:
+            if attempt == retries - 1:
+                raise
+            logging.debug(f"Partial read of {path} ({str(e)}), retrying")
+            time.sleep(RETRY_DELAY * (attempt + 1))
@@ -1,50 +1,367 @@
 import os
 import json
+import copy
 import string
 import random
 import logging
+import sqlite3
+import threading
+from types import MappingProxyType
+from utils.storage import read_json, atomic_write_json
 
 USERS_SETTINGS_FILE = "users_settings.json"
+USERS_DB_FILE = "users_settings.db"
+MAX_REFERRAL_DEPTH = 5
+
+class UserStore:
+    """
+    Process-resident copy of the users settings, persisted in SQLite (WAL mode).
+    Each user is one row, so saving a user is a single-row upsert committed atomically
+    instead of a rewrite of every record. Every write stamps the row with a new revision;
+    other workers' changes are picked up by reading only the rows newer than the last
+    revision this process has seen, so lookups by user_id stay O(1) dict reads.
+    Records handed out are deep copies; callers persist changes through put() or replace_all().
+    Secondary indexes on email, role, referrer and stripe_account_id are rebuilt on load
+    and maintained on every save. The referrer edges form a referral graph; multi-level
+    chains and trees walked from it are memoised until an edge changes.
+    """
+
+    def __init__(self, db_path, json_path=None):
+        self.db_path = db_path
+        self.json_path = json_path
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._initialized = False
+        self._users = {}
+        self._revision = 0
+        self._by_email = {}
+        self._by_role = {}
+        self._by_referrer = {}
+        self._referrer_of = {}
+        self._by_stripe_account = {}
+        self._graph_cache = {}
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _initialize(self):
+        with self._lock:
+            if self._initialized:
+                return
+            conn = self._connection()
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "user_id TEXT PRIMARY KEY, settings TEXT, revision INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS users_revision ON users (revision)")
+            self._initialized = True
+            empty = conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+            if empty and self.json_path and os.path.exists(self.json_path):
+                # One-shot migration from the legacy JSON file
+                count = self.import_json(self.json_path)
+                logging.info(f"Imported {count} users from {self.json_path} into {self.db_path}")
+
+    def _index_user(self, user_id, settings):
+        email = (settings.get("email_address") or "").lower()
+        if email:
+            # Ordered set of user IDs per address: the first indexed is the one lookups return
+            self._by_email.setdefault(email, {})[user_id] = None
+        for role in settings.get("permissions") or []:
+            self._by_role.setdefault(role, set()).add(user_id)
+        referrer = settings.get("referrer")
+        if referrer:
+            self._by_referrer.setdefault(referrer, set()).add(user_id)
+            self._referrer_of[user_id] = referrer
+        stripe_account_id = settings.get("stripe_account_id")
+        if stripe_account_id:
+            self._by_stripe_account.setdefault(stripe_account_id, {})[user_id] = None
+
+    def _unindex_user(self, user_id, settings, replacement=None):
+        """
+        Removes user_id from the indexes for its old settings. Unique keys that replacement (the new settings)
+        keeps are left in place, so an updated user doesn't lose its place among users sharing an email.
+        """
+        replacement = replacement or {}
+        email = (settings.get("email_address") or "").lower()
+        if email != (replacement.get("email_address") or "").lower():
+            self._drop_key(self._by_email, email, user_id)
+        for role in settings.get("permissions") or []:
+            self._by_role.get(role, set()).discard(user_id)
+        referrer = settings.get("referrer")
+        if referrer:
+            self._by_referrer.get(referrer, set()).discard(user_id)
+            self._referrer_of.pop(user_id, None)
+        stripe_account_id = settings.get("stripe_account_id")
+        if stripe_account_id != replacement.get("stripe_account_id"):
+            self._drop_key(self._by_stripe_account, stripe_account_id, user_id)
+
+    @staticmethod
+    def _drop_key(index, key, user_id):
+        """Removes user_id from a unique-key index, keeping the key for any other user that shares it."""
+        user_ids = index.get(key)
+        if user_ids is not None:
+            user_ids.pop(user_id, None)
+            if not user_ids:
+                del index[key]
+
+    def _first_with_key(self, index, key):
+        with self._lock:
+            return next(iter(index.get(key, ())), None)
+
+    def _refresh(self):
+        if not self._initialized:
+            self._initialize()
+        conn = self._connection()
+        latest = conn.execute("SELECT COALESCE(MAX(revision), 0) FROM users").fetchone()[0]
+        if latest == self._revision:
+            return
+        with self._lock:
+            rows = conn.execute(
+                "SELECT user_id, settings, revision FROM users WHERE revision > ? ORDER BY revision",
+                (self._revision,)
+            ).fetchall()
+            users = dict(self._users)
+            graph_changed = False
+            for user_id, settings_json, revision in rows:
+                previous = users.pop(user_id, None)
+                settings = None
+                if settings_json is not None:
+                    settings = json.loads(settings_json)
+                    # Ensure all user records have a phone_number field
+                    if 'phone_number' not in settings:
+                        settings['phone_number'] = None
+                if previous is not None:
+                    self._unindex_user(user_id, previous, settings)
+                if settings is not None:
+                    users[user_id] = settings
+                    self._index_user(user_id, settings)
+                if (previous or {}).get("referrer") != (settings or {}).get("referrer"):
+                    graph_changed = True
+                self._revision = max(self._revision, revision)
+            self._users = users
+            if graph_changed:
+                self._graph_cache = {}
+            logging.debug(f"Applied {len(rows)} user changes, store at revision {self._revision}")
+
+    def _write(self, changes):
+        """
+        Commits {user_id: settings_or_None} in one transaction; None deletes the user.
+        """
+        if not self._initialized:
+            self._initialize()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            revision = conn.execute("SELECT COALESCE(MAX(revision), 0) FROM users").fetchone()[0]
+            for user_id, settings in changes.items():
+                revision += 1
+                conn.execute(
+                    "INSERT INTO users (user_id, settings, revision) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET settings = excluded.settings, revision = excluded.revision",
+                    (user_id, json.dumps(settings) if settings is not None else None, revision)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            self._refresh()
+
+    def get(self, user_id):
+        """Returns a copy of one user's settings, or None if the user doesn't exist."""
+        self._refresh()
+        user = self._users.get(user_id)
+        return copy.deepcopy(user) if user is not None else None
+
+    def get_value(self, user_id, key, default=None):
+        """Returns a copy of a single field of one user's settings without copying the whole record."""
+        self._refresh()
+        return copy.deepcopy(self._users.get(user_id, {}).get(key, default))
+
+    def fields(self, user_ids, fields):
+        """
+        Returns {user_id: {field: value}} for those of user_ids that exist, after a single refresh.
+        Meant for scalar fields on hot paths; values are not copied.
+        """
+        self._refresh()
+        users = self._users
+        return {user_id: {field: users[user_id].get(field) for field in fields} for user_id in set(user_ids) if user_id in users}
+
+    def exists(self, user_id):
+        self._refresh()
+        return user_id in self._users
+
+    def all(self):
+        """Returns a copy of every user's settings keyed by user_id."""
+        self._refresh()
+        return copy.deepcopy(self._users)
+
+    def update_fields(self, user_id, compute):
+        """
+        Sets only the fields compute(settings) returns ({field: value}, empty for no change) on the stored row,
+        reading and writing it in one write transaction so saves of other fields in between aren't lost.
+        Returns a copy of the settings as they were before, or None if the user doesn't exist.
+        """
+        if not self._initialized:
+            self._initialize()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT settings FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None or row[0] is None:
+                conn.execute("ROLLBACK")
+                return None
+            settings = json.loads(row[0])
+            before = copy.deepcopy(settings)
+            fields = compute(before)
+            if fields:
+                settings.update(fields)
+                revision = conn.execute("SELECT COALESCE(MAX(revision), 0) FROM users").fetchone()[0] + 1
+                conn.execute(
+                    "UPDATE users SET settings = ?, revision = ? WHERE user_id = ?",
+                    (json.dumps(settings), revision, user_id)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            self._refresh()
+        return before
+
+    def put(self, user_id, user_settings):
+        """Adds or replaces one user's settings and commits that single row."""
+        self._write({user_id: user_settings})
+
+    def replace_all(self, users_settings):
+        """
+        Replaces every user's settings. Only records that differ from the store are written,
+        and users missing from users_settings are deleted.
+        """
+        self._refresh()
+        current = self._users
+        changes = {uid: settings for uid, settings in users_settings.items() if current.get(uid) != settings}
+        changes.update({uid: None for uid in current if uid not in users_settings})
+        if changes:
+            self._write(changes)
+
+    def import_json(self, path):
+        """Loads a users_settings.json file into the store. Returns the number of users imported."""
+        users_settings = read_json(path)
+        self._write(users_settings)
+        return len(users_settings)
+
+    def export_json(self, path):
+        """Writes every user to path in the users_settings.json format. Returns the number of users."""
+        users_settings = self.all()
+        atomic_write_json(path, users_settings)
+        return len(users_settings)
+
+    def find_by_email(self, email):
+        """Returns (user_id, settings) for the given email address, or None."""
+        self._refresh()
+        user_id = self._first_with_key(self._by_email, (email or "").strip().lower())
+        return (user_id, self.get(user_id)) if user_id else None
+
+    def find_all_by_email(self, email):
+        """Returns [(user_id, settings), ...] for every user with the given email address, first indexed first."""
+        self._refresh()
+        with self._lock:
+            user_ids = list(self._by_email.get((email or "").strip().lower(), ()))
+        entries = [(user_id, self.get(user_id)) for user_id in user_ids]
+        return [(user_id, settings) for user_id, settings in entries if settings is not None]
+
+    def find_by_stripe_account(self, stripe_account_id):
+        """Returns (user_id, settings) for the given Stripe account ID, or None."""
+        self._refresh()
+        user_id = self._first_with_key(self._by_stripe_account, stripe_account_id)
+        return (user_id, self.get(user_id)) if user_id else None
+
+    def user_ids_with_role(self, role):
+        """Returns the IDs of users holding the given permission."""
+        self._refresh()
+        with self._lock:
+            return sorted(self._by_role.get(role, ()))
+
+    def referees_of(self, referrer_id):
+        """Returns the IDs of users whose referrer is referrer_id."""
+        self._refresh()
+        with self._lock:
+            return set(self._by_referrer.get(referrer_id, ()))
+
+    def referral_chain(self, user_id, max_depth=MAX_REFERRAL_DEPTH):
+        """
+        Returns the referrers above user_id as a tuple of (referrer_id, level), where level 1 is
+        the direct referrer, level 2 that user's referrer and so on. Stops at max_depth or a cycle.
+        """
+        self._refresh()
+        with self._lock:
+            key = ("chain", user_id, max_depth)
+            chain = self._graph_cache.get(key)
+            if chain is None:
+                chain, seen, current = [], {user_id}, user_id
+                while len(chain) < max_depth:
+                    current = self._referrer_of.get(current)
+                    if not current or current in seen:
+                        break
+                    seen.add(current)
+                    chain.append((current, len(chain) + 1))
+                chain = tuple(chain)
+                self._graph_cache[key] = chain
+            return chain
+
+    def referral_tree(self, referrer_id, max_depth=MAX_REFERRAL_DEPTH):
+        """
+        Returns a read-only {user_id: level} of everyone referrer_id referred directly (level 1)
+        or through their referees (level 2 and up), to max_depth levels.
+        """
+        self._refresh()
+        with self._lock:
+            key = ("tree", referrer_id, max_depth)
+            tree = self._graph_cache.get(key)
+            if tree is None:
+                levels, frontier = {}, [referrer_id]
+                for level in range(1, max_depth + 1):
+                    frontier = [
+                        referee for user_id in frontier for referee in self._by_referrer.get(user_id, ())
+                        if referee not in levels and referee != referrer_id
+                    ]
+                    if not frontier:
+                        break
+                    for referee in frontier:
+                        levels.setdefault(referee, level)
+                tree = MappingProxyType(levels)
+                self._graph_cache[key] = tree
+            return tree
+
+user_store = UserStore(USERS_DB_FILE, json_path=USERS_SETTINGS_FILE)
 
 def load_users_settings():
     """
-    Loads all user settings from the JSON file.
+    Loads all user settings from the user store.
     Returns an empty dict if the file doesn't exist or is invalid.
     Ensures each user's settings have a 'phone_number' field.
     """
     try:
-        if os.path.exists(USERS_SETTINGS_FILE):
-            with open(USERS_SETTINGS_FILE, 'r') as f:
-                users_settings = json.load(f)
-                # Ensure all user records have a phone_number field
-                for user_id, settings in users_settings.items():
-                    if 'phone_number' not in settings:
-                        settings['phone_number'] = None
-                # Redact sensitive data in logs
-                log_settings = {uid: {k: "[REDACTED]" if k in ["password"] else v for k, v in s.items()} for uid, s in users_settings.items()}
-                logging.debug(f"Loaded users settings: {json.dumps(log_settings)}")
-                return users_settings
-        else:
-            logging.warning("UX Issue - Users settings file not found, returning empty dict")
-            return {}
-    except json.JSONDecodeError as e:
-        logging.error(f"Security Issue - Invalid users settings file format: {str(e)}", exc_info=True)
-        return {}
+        return user_store.all()
     except Exception as e:
         logging.error(f"UX Issue - Failed to load users settings: {str(e)}", exc_info=True)
         return {}
 
 def save_users_settings(users_settings):
     """
-    Saves all user settings to the JSON file.
+    Saves all user settings to the user store, writing only the records that changed.
     Raises an exception if saving fails.
     """
     try:
-        with open(USERS_SETTINGS_FILE, 'w') as f:
-            json.dump(users_settings, f, indent=4)
-        # Redact sensitive data in logs
-        log_settings = {uid: {k: "[REDACTED]" if k in ["password"] else v for k, v in s.items()} for uid, s in users_settings.items()}
-        logging.debug(f"Saved users settings: {json.dumps(log_settings)}")
+        user_store.replace_all(users_settings)
+        logging.debug(f"Saved users settings for {len(users_settings)} users")
     except Exception as e:
         logging.error(f"UX Issue - Failed to save users settings: {str(e)}", exc_info=True)
         raise  # Re-raise to alert calling code
@@ -56,9 +373,10 @@ def get_user_settings(user_id):
     Ensures 'phone_number' is present in the returned settings.
     """
     try:
-        user_settings = load_users_settings().get(user_id, {})
+        user_settings = user_store.get(user_id)
         if not user_settings:
             logging.warning(f"UX Issue - No settings found for user {user_id}")
+            return {}
         # Ensure phone_number is included
         if 'phone_number' not in user_settings:
             user_settings['phone_number'] = None
@@ -78,11 +396,9 @@ def save_user_settings(user_id, user_settings):
     Raises an exception if saving fails.
     """
     try:
-        all_users_settings = load_users_settings()
         if 'phone_number' not in user_settings:
             user_settings['phone_number'] = None
-        all_users_settings[user_id] = user_settings
-        save_users_settings(all_users_settings)
+        user_store.put(user_id, user_settings)
         # Redact sensitive data for logging
         log_settings = {k: "[REDACTED]" if k in ["password"] else v for k, v in user_settings.items()}
         logging.debug(f"Saved settings for user {user_id}: {json.dumps(log_settings)}")
@@ -90,6 +406,87 @@ def save_user_settings(user_id, user_settings):
         logging.error(f"UX Issue - Failed to save settings for user {user_id}: {str(e)}", exc_info=True)
         raise
 
+def get_user_value(user_id, key, default=None):
+    """
+    Retrieves a single field of a user's settings, or default if the user or field is missing.
+    """
+    return user_store.get_value(user_id, key, default)
+
+def record_login(user_id, ip_address, timestamp):
+    """
+    Stores this login as the user's last_login and moves the prior one to previous_login,
+    so the "last login" notice can be shown without querying PostHog.
+    Returns the prior login record ({"timestamp", "ip_address"}), or None if none was recorded.
+    """
+    def login_fields(settings):
+        fields = {"last_login": {"timestamp": timestamp, "ip_address": ip_address}}
+        if settings.get("last_login"):
+            fields["previous_login"] = settings["last_login"]
+        return fields
+
+    before = user_store.update_fields(user_id, login_fields)
+    return before.get("last_login") if before else None
+
+def update_user_fields(user_id, compute):
+    """
+    Atomically sets the fields compute(settings) returns on one user, leaving the rest of the record as stored.
+    Returns the settings as they were before, or None if the user doesn't exist.
+    """
+    return user_store.update_fields(user_id, compute)
+
+def get_user_fields(user_ids, fields):
+    """
+    Retrieves selected scalar fields for several users at once.
+    Returns {user_id: {field: value}}; users that don't exist are left out.
+    """
+    return user_store.fields(user_ids, fields)
+
+def find_user_by_email(email):
+    """
+    Looks up a user by email address (case-insensitive).
+    Returns a (user_id, settings) tuple, or None if no user has that email.
+    """
+    return user_store.find_by_email(email)
+
+def find_users_by_email(email):
+    """
+    Looks up every user sharing an email address (case-insensitive).
+    Returns a list of (user_id, settings) tuples, empty if no user has that email.
+    """
+    return user_store.find_all_by_email(email)
+
+def find_user_by_stripe_account(stripe_account_id):
+    """
+    Looks up a user by Stripe account ID.
+    Returns a (user_id, settings) tuple, or None if no user has that account.
+    """
+    return user_store.find_by_stripe_account(stripe_account_id)
+
+def get_users_by_role(role):
+    """
+    Retrieves every user holding the given permission.
+    Returns a dict of settings keyed by user_id.
+    """
+    return {user_id: user_store.get(user_id) for user_id in user_store.user_ids_with_role(role)}
+
+def get_referees(referrer_id):
+    """
+    Returns the set of user IDs whose 'referrer' is referrer_id.
+    """
+    return user_store.referees_of(referrer_id)
+
+def get_referral_chain(user_id, max_depth=MAX_REFERRAL_DEPTH):
+    """
+    Returns the referrers above user_id as a tuple of (referrer_id, level), nearest first.
+    """
+    return user_store.referral_chain(user_id, max_depth)
+
+def get_referral_tree(referrer_id, max_depth=MAX_REFERRAL_DEPTH):
+    """
+    Returns a read-only {user_id: level} of the users referrer_id referred, directly or indirectly.
+    """
+    return user_store.referral_tree(referrer_id, max_depth)
+
 def generate_code():
     """
     Generates a random 8-character code (7 characters + checksum).
@@ -116,4 +513,18 @@ def generate_code():
         return result
     except Exception as e:
         logging.error(f"UX Issue - Failed to generate code: {str(e)}", exc_info=True)
-        return ""  # Return empty string as fallback
\ No newline at end of file
+        return ""  # Return empty string as fallback
+
+if __name__ == '__main__':
+    # One-shot import/export between users_settings.json and the SQLite user store:
+    #   python -m utils.users import [path]
+    #   python -m utils.users export [path]
+    import sys
+    if len(sys.argv) < 2 or sys.argv[1] not in ('import', 'export'):
+        print("Usage: python -m utils.users import|export [path]")
+        sys.exit(1)
+    json_path = sys.argv[2] if len(sys.argv) > 2 else USERS_SETTINGS_FILE
+    if sys.argv[1] == 'import':
+        print(f"Imported {user_store.import_json(json_path)} users from {json_path}")
+    else:
+        print(f"Exported {user_store.export_json(json_path)} users to {json_path}")
@@ -1,46 +1,364 @@
 # utils/wix.py
-import requests
-from utils.users import load_users_settings
+import re
+import json
+import time
+from datetime import datetime, timedelta, timezone
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.users import get_user_settings
+from utils.config import get_config
+from utils.catalog import CatalogCache
+from utils.outbound import outbound
+from utils.http import get_session
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; normalization falls back to plain Python
+    np = None
+
+WIX_API = "https://www.wixapis.com"
+TOKEN_URL = f"{WIX_API}/oauth2/token"
+COLLECTIONS_URL = f"{WIX_API}/stores-reader/v1/collections/query"
+PRODUCTS_URL = f"{WIX_API}/stores/v1/products/query"
+
+PAGE_LIMIT = 100  # Largest page the Wix stores query endpoints return
+MAX_PAGES = 100  # Wix rejects offsets past 10,000; larger stores need numericId paging
+FETCH_WORKERS = 6  # Concurrent collection fetches per catalog
+REQUEST_TIMEOUT = 15
+TOKEN_EXPIRY_MARGIN = 60  # Refresh cached tokens this many seconds before Wix expires them
+DEFAULT_TOKEN_TTL = 3600  # Used if the token response has no expires_in
+DEFAULT_RECONCILE_SECONDS = 86400  # Full catalog downloads, which also catch deleted products
+CURSOR_OVERLAP_SECONDS = 300  # Delta queries look back this far past the high-water mark
+
+_catalog_cache_lock = threading.Lock()
+_tokens = {}  # client_id -> (access_token, expires_at)
+_tokens_lock = threading.Lock()
+_catalog_cache = None
+
+# Product fields kept in cached catalogs; descriptions, options, variants and media galleries are dropped
+CATALOG_PRODUCT_FIELDS = (
+    "id", "name", "numericId", "lastUpdated", "visible", "sku", "price", "priceData",
+    "discount", "discountedPrice", "stock", "productPageUrl", "collectionIds"
+)
+
+class WixClient:
+    """
+    Reads one Wix store, identified by its OAuth client ID, through the shared pooled session.
+    Anonymous access tokens are cached per client ID until shortly before they expire, queries
+    are paged to the end instead of stopping at the first 100 results, and products for several
+    collections are fetched concurrently (at most FETCH_WORKERS at a time).
+    """
+
+    def __init__(self, client_id, max_workers=FETCH_WORKERS):
+        self.client_id = client_id
+        self.max_workers = max_workers
+
+    def access_token(self, refresh=False):
+        """Returns a cached anonymous access token for this client ID, fetching a new one when needed."""
+        now = time.time()
+        cached = _tokens.get(self.client_id)
+        if cached and not refresh and cached[1] > now:
+            return cached[0]
+        with _tokens_lock:
+            cached = _tokens.get(self.client_id)
+            if cached and not refresh and cached[1] > time.time():
+                return cached[0]
+            response = outbound("wix").request(
+                "POST", TOKEN_URL, session=get_session(retry_posts=True),
+                json={"clientId": self.client_id, "grantType": "anonymous"},
+                timeout=REQUEST_TIMEOUT
+            )
+            if response.status_code != 200:
+                raise Exception(f"Failed to get Wix access token: {response.text}")
+            token_data = response.json()
+            expires_in = int(token_data.get("expires_in", DEFAULT_TOKEN_TTL))
+            _tokens[self.client_id] = (token_data["access_token"], time.time() + max(0, expires_in - TOKEN_EXPIRY_MARGIN))
+            return token_data["access_token"]
+
+    def post(self, url, payload):
+        """Posts a query with this client's token, retrying once with a fresh token if Wix rejects it."""
+        for attempt in range(2):
+            headers = {"Authorization": f"Bearer {self.access_token(refresh=attempt > 0)}"}
+            response = outbound("wix").request("POST", url, session=get_session(retry_posts=True), headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
+            if response.status_code != 401:
+                break
+        if response.status_code != 200:
+            raise Exception(f"Wix query {url} failed ({response.status_code}): {response.text}")
+        return response.json()
+
+    def query_all(self, url, result_key, query=None, **options):
+        """
+        Pages through a Wix query endpoint with limit/offset and returns every item under result_key.
+        query holds the filter/sort part of the query; options are extra top-level request fields.
+        """
+        items = []
+        for page in range(MAX_PAGES):
+            payload = {"query": dict(query or {}, paging={"limit": PAGE_LIMIT, "offset": page * PAGE_LIMIT}), **options}
+            batch = self.post(url, payload).get(result_key, [])
+            items.extend(batch)
+            if len(batch) < PAGE_LIMIT:
+                return items
+        logging.warning(f"Wix query {url} stopped after {MAX_PAGES} pages for client {self.client_id}")
+        return items
+
+    def collections(self, include_system=False):
+        """Returns every collection in the store; default/system collections (id 00000000-...) are skipped unless requested."""
+        collections = self.query_all(COLLECTIONS_URL, "collections", includeNumberOfProducts=True)
+        if include_system:
+            return collections
+        return [collection for collection in collections if not collection["id"].startswith("00000000")]
+
+    def products(self, filter=None, sort=None):
+        """Returns every product matching filter (a dict, as in the Wix query language)."""
+        query = {}
+        if filter:
+            query["filter"] = json.dumps(filter)
+        if sort:
+            query["sort"] = json.dumps(sort)
+        return self.query_all(PRODUCTS_URL, "products", query)
+
+    def collection_products(self, collection_id):
+        """Returns every product in one collection."""
+        return self.products({"collections.id": {"$hasSome": [collection_id]}})
+
+    def products_by_collection(self, collections):
+        """
+        Fetches the products of each collection concurrently.
+        Returns [(collection, products)] in the order the collections were given.
+        """
+        collections = list(collections)
+        if not collections:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(collections))) as executor:
+            results = executor.map(lambda collection: self.collection_products(collection["id"]), collections)
+            return list(zip(collections, results))
 
 def get_wix_access_token(client_id):
     """Obtain an access token from Wix using the client ID."""
-    token_url = "https://www.wixapis.com/oauth2/token"
-    payload = {"clientId": client_id, "grantType": "anonymous"}
-    headers = {"Content-Type": "application/json"}
-    response = requests.post(token_url, json=payload, headers=headers)
-    if response.status_code == 200:
-        return response.json()["access_token"]
-    else:
-        raise Exception(f"Failed to get Wix access token: {response.text}")
-
-def fetch_wix_collections(access_token):
-    """Fetch collections from Wix using the access token."""
-    collections_url = "https://www.wixapis.com/stores-reader/v1/collections/query"
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {access_token}"}
-    query_payload = {"query": {"paging": {"limit": 100}}, "includeNumberOfProducts": True}
-    response = requests.post(collections_url, headers=headers, json=query_payload)
-    if response.status_code == 200:
-        return response.json()["collections"]
-    else:
-        raise Exception(f"Failed to fetch Wix collections: {response.text}")
+    return WixClient(client_id).access_token()
 
-def fetch_wix_products_for_collection(access_token, collection_id):
+def fetch_wix_collections(client_id):
+    """Fetch collections from Wix, paging through all of them."""
+    return WixClient(client_id).collections(include_system=True)
+
+def fetch_wix_products_for_collection(client_id, collection_id):
     """Fetch products for a specific collection from Wix."""
-    products_url = "https://www.wixapis.com/stores/v1/products/query"
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {access_token}"}
-    filter_str = '{"collections.id": {"$hasSome": ["' + collection_id + '"]}}'
-    query_payload = {"query": {"filter": filter_str, "paging": {"limit": 100}}}
-    response = requests.post(products_url, headers=headers, json=query_payload)
-    if response.status_code == 200:
-        return response.json()["products"]
+    return WixClient(client_id).collection_products(collection_id)
+
+def compact_product(product):
+    """Returns the subset of a Wix product that cached catalogs keep."""
+    compact = {field: product[field] for field in CATALOG_PRODUCT_FIELDS if field in product}
+    thumbnail_url = product.get("media", {}).get("mainMedia", {}).get("thumbnail", {}).get("url")
+    if thumbnail_url:
+        compact["media"] = {"mainMedia": {"thumbnail": {"url": thumbnail_url}}}
+    return compact
+
+def fetch_catalog(client_id):
+    """
+    Downloads a store's catalog: {"collections": [{"id", "name"}], "members": {collection_id: [product_id]},
+    "products": {product_id: compact product}}. Products in several collections are stored once.
+    """
+    client = WixClient(client_id)
+    collections = client.collections()
+    members = {}
+    products = {}
+    for collection, items in client.products_by_collection(collections):
+        members[collection["id"]] = [product["id"] for product in items]
+        for product in items:
+            products.setdefault(product["id"], compact_product(product))
+    return {
+        "collections": [{"id": collection["id"], "name": collection["name"]} for collection in collections],
+        "members": members,
+        "products": products
+    }
+
+def _high_water_mark(products):
+    """Returns the latest lastUpdated among products (Wix ISO timestamps compare as text), or None."""
+    return max((product["lastUpdated"] for product in products.values() if product.get("lastUpdated")), default=None)
+
+def _delta_since(cursor):
+    moment = datetime.fromisoformat(cursor.replace("Z", "+00:00")) - timedelta(seconds=CURSOR_OVERLAP_SECONDS)
+    return moment.astimezone(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+def sync_catalog(client_id, previous=None, reconcile_seconds=DEFAULT_RECONCILE_SECONDS):
+    """
+    Brings a store's catalog up to date. With a previous copy that has a lastUpdated cursor and was
+    reconciled within reconcile_seconds, only products updated since the cursor are queried and merged,
+    plus the products of any new collection; otherwise the whole catalog is downloaded. Deleted or hidden
+    products only disappear on those full reconciliations.
+    """
+    now = time.time()
+    if not previous or not previous.get("cursor") or now - previous.get("reconciled_at", 0) > reconcile_seconds:
+        catalog = fetch_catalog(client_id)
+        catalog.update(cursor=_high_water_mark(catalog["products"]), reconciled_at=now, sync={"mode": "full", "changed": len(catalog["products"])})
+        return catalog
+
+    client = WixClient(client_id)
+    collections = client.collections()
+    collection_ids = {collection["id"] for collection in collections}
+    products = dict(previous["products"])
+    members = {collection_id: ids for collection_id, ids in previous["members"].items() if collection_id in collection_ids}
+    for collection, items in client.products_by_collection(c for c in collections if c["id"] not in members):
+        members[collection["id"]] = [product["id"] for product in items]
+        for product in items:
+            products[product["id"]] = compact_product(product)
+
+    changed = client.products({"lastUpdated": {"$gt": _delta_since(previous["cursor"])}}, sort=[{"lastUpdated": "asc"}])
+    if changed:
+        for product in changed:
+            products[product["id"]] = compact_product(product)
+        # Re-file changed products under the collections they now belong to
+        moved = {product["id"]: set(product["collectionIds"]) for product in changed if "collectionIds" in product}
+        for collection_id, ids in members.items():
+            kept = [product_id for product_id in ids if product_id not in moved]
+            kept += [product_id for product_id, targets in moved.items() if collection_id in targets]
+            members[collection_id] = kept
+    return {
+        "collections": [{"id": collection["id"], "name": collection["name"]} for collection in collections],
+        "members": members,
+        "products": products,
+        "cursor": _high_water_mark(products) or previous["cursor"],
+        "reconciled_at": previous["reconciled_at"],
+        "sync": {"mode": "delta", "changed": len(changed)}
+    }
+
+def _load_catalog(client_id, previous):
+    settings = get_config().get("catalog", {})
+    return sync_catalog(client_id, previous, float(settings.get("RECONCILE_SECONDS", DEFAULT_RECONCILE_SECONDS)))
+
+def _get_catalog_cache():
+    """Returns the catalog cache, configured from the "catalog" entry in config.json."""
+    global _catalog_cache
+    if _catalog_cache is None:
+        with _catalog_cache_lock:
+            if _catalog_cache is None:
+                settings = get_config().get("catalog", {})
+                _catalog_cache = CatalogCache(
+                    _load_catalog,
+                    settings.get("CACHE_DIR", "catalog_cache"),
+                    fresh_seconds=float(settings.get("FRESH_SECONDS", 900)),
+                    max_stale_seconds=float(settings.get("MAX_STALE_SECONDS", 7 * 86400)),
+                    refresh_interval=float(settings.get("REFRESH_INTERVAL", 300))
+                )
+    return _catalog_cache
+
+def get_catalog(client_id):
+    """Returns the cached catalog for a store (see fetch_catalog), loading it only if there is no usable copy."""
+    return _get_catalog_cache().get(client_id)
+
+def refresh_catalog(client_id):
+    """Queues an immediate reload of a store's catalog and returns a Future for it."""
+    return _get_catalog_cache().nudge(client_id)
+
+def catalog_stats():
+    return _get_catalog_cache().stats()
+
+def iter_catalog_products(catalog, collection_ids=None):
+    """Yields (collection, product) pairs in collection order, optionally only for the given collection IDs."""
+    products = catalog["products"]
+    for collection in catalog["collections"]:
+        if collection_ids is not None and collection["id"] not in collection_ids:
+            continue
+        for product_id in catalog["members"].get(collection["id"], []):
+            product = products.get(product_id)
+            if product is not None:
+                yield collection, product
+
+def get_user_wix_client_id(user_id):
+    """Returns the Wix client ID (API_TOKEN) from a user's wixStore settings, or None."""
+    user = get_user_settings(user_id)
+    if not user:
+        return None
+    return user.get("settings", {}).get("api_key", {}).get("wixStore", {}).get("API_TOKEN")
+
+_PRICE_JUNK = re.compile(r"[^\d.,-]")
+
+def parse_price(value, default=0.0):
+    """
+    Converts a numeric price, or a formatted one such as "£1,299.00" or "1.299,00 €", to a float.
+    In formatted prices the last separator followed by one or two digits is the decimal point.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if not isinstance(value, str):
+        return default
+    text = _PRICE_JUNK.sub("", value)
+    last = max(text.rfind("."), text.rfind(","))
+    if last != -1 and len(text) - last - 1 in (1, 2):
+        text = text[:last].replace(".", "").replace(",", "") + "." + text[last + 1:]
     else:
-        raise Exception(f"Failed to fetch Wix products for collection {collection_id}: {response.text}")
+        text = text.replace(".", "").replace(",", "")
+    try:
+        return float(text)
+    except ValueError:
+        return default
+
+def _price_fields(product):
+    """Returns (original price, price charged, currency) from a product's numeric price data."""
+    price = product.get("price") or product.get("priceData") or {}
+    formatted = price.get("formatted", {})
+    original = price.get("price")
+    original = parse_price(formatted.get("price")) if original is None else float(original)
+    current = price.get("discountedPrice")
+    current = parse_price(formatted.get("discountedPrice"), original) if current is None else float(current)
+    return original, current, price.get("currency", "")
+
+def _discount_percents(original, current):
+    if np is not None:
+        original = np.asarray(original, dtype=float)
+        current = np.asarray(current, dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percents = np.where(original > current, (original - current) / original * 100, 0.0)
+        return np.round(percents, 2).tolist()
+    return [round((o - c) / o * 100, 2) if o > c else 0.0 for o, c in zip(original, current)]
+
+def _stock_quantities(tracked, quantities):
+    if np is not None:
+        return np.where(np.asarray(tracked, dtype=bool), np.asarray(quantities, dtype=np.int64), -1).tolist()
+    return [quantity if track else -1 for track, quantity in zip(tracked, quantities)]
+
+def normalize_products(entries, user_id=None):
+    """
+    Turns (collection, Wix product) pairs into product records for the API, a whole batch at a time.
+    Prices come from the numeric price fields: original_price is the list price and current_price
+    the discounted price charged (formatted strings are only parsed when numbers are missing).
+    Discounts and stock are computed column-wise, with numpy when it is installed.
+    Product URLs carry ?referer=<user_id> when user_id is given.
+    """
+    entries = list(entries)
+    prices = [_price_fields(product) for _, product in entries]
+    original = [price[0] for price in prices]
+    current = [price[1] for price in prices]
+    stock = [product.get("stock") or {} for _, product in entries]
+    tracked = [item.get("trackInventory", item.get("trackQuantity", False)) for item in stock]
+    quantities = [int(item.get("quantity") or 0) for item in stock]
+    discounts = _discount_percents(original, current)
+    qty = _stock_quantities(tracked, quantities)
+    suffix = f"?referer={user_id}" if user_id else ""
+
+    records = []
+    for index, (collection, product) in enumerate(entries):
+        page_url = product.get("productPageUrl", {})
+        records.append({
+            "source": user_id,
+            "id": product.get("id", ""),
+            "title": product.get("name", ""),
+            "product_url": page_url.get("base", "").rstrip("/") + "/" + page_url.get("path", "").lstrip("/") + suffix,
+            "current_price": current[index],
+            "original_price": original[index],
+            "discount_percent": discounts[index],
+            "currency": prices[index][2],
+            "image_url": product.get("media", {}).get("mainMedia", {}).get("thumbnail", {}).get("url", ""),
+            "qty": qty[index],
+            "category": collection["name"],
+            "user_id": user_id
+        })
+    return records
 
 def fetch_user_products(user_id):
-    """Fetch all products for a user from Wix."""
-    users_settings = load_users_settings()
-    user = users_settings.get(user_id)
+    """Fetch all products for a user from their cached Wix catalog."""
+    user = get_user_settings(user_id)
     if not user:
         logging.warning(f"No user found for ID: {user_id}")
         return []  # User not found
@@ -49,36 +367,9 @@ def fetch_user_products(user_id):
     if not wix_client_id:
         logging.warning(f"No Wix API token found for user: {user_id}")
         return []  # No Wix API token found
-    
+
     try:
-        access_token = get_wix_access_token(wix_client_id)
-        collections = fetch_wix_collections(access_token)
-        all_products = []
-        
-        for collection in collections:
-            if collection["id"].startswith("00000000"):
-                continue  # Skip default/system collections
-            products = fetch_wix_products_for_collection(access_token, collection["id"])
-            for product in products:
-                current_price = float(product.get("price", {}).get("formatted", {}).get("price", "0").replace("$", "").replace("£", "").replace(",", "") or 0.0)
-                original_price = float(product.get("discountedPrice", {}).get("formatted", {}).get("price", str(current_price)).replace("$", "").replace("£", "").replace(",", "") or current_price)
-                discount = ((original_price - current_price) / original_price) * 100 if original_price > current_price else 0.0
-                base_url = product.get("productPageUrl", {}).get("base", "").rstrip("/") + "/" + product.get("productPageUrl", {}).get("path", "").lstrip("/")
-                product_url = f"{base_url}?referer={user_id}"
-                all_products.append({
-                    "source": user_id,
-                    "id": product.get("id", ""),
-                    "title": product.get("name", ""),
-                    "product_url": product_url,
-                    "current_price": current_price,
-                    "original_price": original_price,
-                    "discount_percent": round(discount, 2),
-                    "image_url": product.get("media", {}).get("mainMedia", {}).get("thumbnail", {}).get("url", ""),
-                    "qty": int(product.get("stock", {}).get("quantity", 0)) if product.get("stock", {}).get("trackQuantity", False) else -1,
-                    "category": collection["name"],
-                    "user_id": user_id
-                })
-        return all_products
+        return normalize_products(iter_catalog_products(get_catalog(wix_client_id)), user_id)
     except Exception as e:
         logging.error(f"Error fetching products for user {user_id}: {str(e)}")
-        return []
\ No newline at end of file
+        return []